@@ -10,14 +10,35 @@ from flask_login import LoginManager
 from flask_pagedown import PageDown
 from flask_whooshee import Whooshee
 from config import config
+from .counters import CounterBuffer, DedupeWindow
+from .ranking import HotRanking, TopAnswers
+from .cache import Cache
+from .rendering import BodyRenderer
+from .mailqueue import MailQueue
+from .security import PasswordHasher
+from .tokens import TokenService
+from .profiler import QueryProfiler
+from .search import SearchIndexer
 
 
 db = SQLAlchemy()
 moment = Moment()
 bootstrap = Bootstrap()
 mail = Mail()
+mail_queue = MailQueue()
 pagedown = PageDown()
 whooshee = Whooshee()
+search_indexer = SearchIndexer()
+like_counter = CounterBuffer('answers', 'likes_count', 'ZHIHU_LIKE')
+view_counter = CounterBuffer('questions', 'view_count', 'ZHIHU_VIEW')
+recent_views = DedupeWindow()
+hot_ranking = HotRanking()
+top_answers = TopAnswers()
+cache = Cache()
+body_renderer = BodyRenderer()
+password_hasher = PasswordHasher()
+tokens = TokenService()
+query_profiler = QueryProfiler()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -33,9 +54,20 @@ def create_app(config_name):
     moment.init_app(app)
     bootstrap.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
     whooshee.init_app(app)
+    search_indexer.init_app(app)
+    like_counter.init_app(app)
+    view_counter.init_app(app)
+    hot_ranking.init_app(app)
+    top_answers.init_app(app)
+    cache.init_app(app)
+    body_renderer.init_app(app)
+    password_hasher.init_app(app)
+    tokens.init_app(app)
+    query_profiler.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint) #注册蓝本
@@ -10,6 +10,7 @@ from .forms import RegisterForm, LoginForm, ChangePasswordForm, \
 from ..models import User, Topic
 from ..emails import send_mail
 from ..decorators import admin_required
+from ..pagination import KeysetPagination
 
 #每次请求dispatch之前都要经过before函数处理
 #如果用户登录了但是未确认账号，且请求的端点不是auth/static
@@ -177,10 +178,9 @@ def change_email(token):
 @admin_required
 @login_required
 def allusers():
-    page = request.args.get('page', 1, type=int)
-    count = User.query.count()
-    pagination = User.query.order_by(User.username).paginate(
-        page, error_out=False)
+    pagination = KeysetPagination(User.query,
+                    [(User.username, False), (User.id, False)],
+                    cursor=request.args.get('cursor'), per_page=20)
     users = pagination.items
     return render_template('allusers.html', pagination=pagination,
-                           count=count, users=users)
+                           count=pagination.total, users=users)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import binascii
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, make_response, current_app, g, has_app_context
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from werkzeug.contrib.cache import BaseCache, NullCache, FileSystemCache, \
+    MemcachedCache
+from .hooks import call_after_commit
+
+#缓存的页面中CSRF令牌的占位符，取出时换成当前会话的令牌
+CSRF_PLACEHOLDER = '__zhihu_csrf_token__'
+
+
+class LRUCache(BaseCache):
+    """进程内缓存，超过 max_size 项时淘汰最久未使用的，每项有各自的过期时间"""
+
+    def __init__(self, max_size=1000, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires <= time.time():
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (self._expires(timeout), value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (not item[0] or item[0] > time.time()):
+                return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        return True
+
+
+class Cache(object):
+    """页面和模板片段缓存。
+
+    ZHIHU_CACHE_TYPE 选择后端：lru（进程内）、filesystem（ZHIHU_CACHE_DIR）、
+    memcached（ZHIHU_CACHE_SERVERS）或 null（不缓存）。每项缓存带若干标签，
+    键中包含这些标签当前的版本号；invalidate(tag) 更换标签的版本号，
+    带有该标签的旧缓存项从此不会再被读到，随后按过期时间或LRU淘汰。
+    """
+
+    def __init__(self):
+        self.backend = NullCache()
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_CACHE_TYPE', 'lru')
+        app.config.setdefault('ZHIHU_CACHE_DEFAULT_TIMEOUT', 300)
+        app.config.setdefault('ZHIHU_CACHE_MAX_SIZE', 1000)
+        app.config.setdefault('ZHIHU_CACHE_DIR', None)
+        app.config.setdefault('ZHIHU_CACHE_SERVERS', None)
+        cache_type = app.config['ZHIHU_CACHE_TYPE']
+        timeout = app.config['ZHIHU_CACHE_DEFAULT_TIMEOUT']
+        if cache_type == 'lru':
+            self.backend = LRUCache(app.config['ZHIHU_CACHE_MAX_SIZE'], timeout)
+        elif cache_type == 'filesystem':
+            self.backend = FileSystemCache(app.config['ZHIHU_CACHE_DIR'],
+                                           app.config['ZHIHU_CACHE_MAX_SIZE'], timeout)
+        elif cache_type == 'memcached':
+            self.backend = MemcachedCache(app.config['ZHIHU_CACHE_SERVERS'], timeout,
+                                          key_prefix='zhihu:')
+        elif cache_type == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError('Unknown ZHIHU_CACHE_TYPE: %r' % cache_type)
+        app.jinja_env.add_extension(CacheExtension)
+        app.jinja_env.extend(fragment_cache=self)
+
+    @staticmethod
+    def _new_version():
+        return binascii.hexlify(os.urandom(6)).decode('ascii')
+
+    #标签的当前版本号；不存在（从未失效过或已被淘汰）时生成一个新的
+    def _versions(self, tags):
+        versions = []
+        for tag in tags:
+            version = self.backend.get('tag:' + tag)
+            if version is None:
+                self.backend.add('tag:' + tag, self._new_version(), timeout=0)
+                version = self.backend.get('tag:' + tag)
+            versions.append(version or '')
+        #正在渲染缓存的页面时，记下页面中读取过的标签及其最早的版本号
+        recorded = getattr(g, '_cache_versions', None) if has_app_context() else None
+        if recorded is not None:
+            for tag, version in zip(tags, versions):
+                recorded.setdefault(tag, version)
+        return versions
+
+    #版本号拼在一起可能很长，取摘要使键的长度固定（memcached的键不能超过250字节）
+    @staticmethod
+    def _join(key, versions):
+        digest = hashlib.md5(','.join(versions).encode('ascii')).hexdigest()
+        return '%s|%s' % (key, digest)
+
+    def _key(self, key, tags):
+        return self._join(key, self._versions(tags))
+
+    def stamp(self, key, tags=()):
+        """键加上标签当前的版本号。在读取数据之前取得，读取期间标签失效的话，
+        旧数据只会存到已经作废的版本下"""
+        return self._key(key, tags)
+
+    def get(self, key, tags=()):
+        return self.backend.get(self._key(key, tags))
+
+    def set(self, key, value, tags=(), timeout=None):
+        self.backend.set(self._key(key, tags), value, timeout)
+
+    def invalidate(self, *tags):
+        """使带有这些标签的缓存项失效"""
+        for tag in set(tags):
+            self.backend.set('tag:' + tag, self._new_version(), timeout=0)
+
+    def clear(self):
+        self.backend.clear()
+
+    #会话中新增、修改、删除了带cache_tags()的对象时，在提交后使对应的标签失效。
+    #只有关系集合变化（如用户发表了评论）的对象不算修改
+    def on_after_flush(self, session, flush_context):
+        tags = set()
+        dirty = [obj for obj in session.dirty
+                 if session.is_modified(obj, include_collections=False)]
+        for obj in list(session.new) + dirty + list(session.deleted):
+            if hasattr(obj, 'cache_tags'):
+                tags.update(obj.cache_tags())
+        if tags:
+            self.invalidate_on_commit(session, *tags)
+
+    def invalidate_on_commit(self, session, *tags):
+        call_after_commit(session, self.invalidate, *tags)
+
+    def cached_response(self, timeout=None, tags=(), vary=(), unless=None):
+        """缓存视图函数的响应，键包含当前用户、请求路径和vary中列出的cookies。
+        tags可以是视图参数的函数；渲染期间片段等读取过的标签也记为页面的依赖，
+        其中任何一个失效都会使页面失效。unless()为真、非GET请求或有待显示的
+        闪现消息时不使用缓存"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method != 'GET' or session.get('_flashes') or \
+                        (unless is not None and unless()):
+                    return f(*args, **kwargs)
+                user_id = current_user.id if current_user.is_authenticated else 0
+                key = 'view:%s:%s:%s:%s' % (
+                    request.endpoint, user_id, request.full_path,
+                    ':'.join(request.cookies.get(name, '') for name in vary))
+                view_tags = list(tags(**kwargs) if callable(tags) else tags)
+                depends = self.backend.get('depends:' + key) or []
+                cached = self.backend.get(self._key(key, view_tags + depends))
+                if cached is not None:
+                    data, status, mimetype = cached
+                    return make_response(_restore_csrf(data), status,
+                                         {'Content-Type': mimetype})
+                #在渲染之前取得版本号，渲染期间标签失效的话响应存到作废的版本下
+                versions = self._versions(view_tags)
+                outer = getattr(g, '_cache_versions', None)
+                g._cache_versions = recorded = {}
+                try:
+                    response = make_response(f(*args, **kwargs))
+                finally:
+                    g._cache_versions = outer
+                if response.status_code == 200 and not response.direct_passthrough \
+                        and not session.get('_flashes'):
+                    depends = sorted(set(recorded) - set(view_tags))
+                    versions += [recorded[tag] for tag in depends]
+                    self.backend.set(self._join(key, versions),
+                                     (_strip_csrf(response.get_data()), 200,
+                                      response.headers.get('Content-Type')), timeout)
+                    self.backend.set('depends:' + key, depends, timeout)
+                return response
+            return decorated_function
+        return decorator
+
+    def fragment(self, key, timeout, tags, caller):
+        key = self.stamp('fragment:' + key, tags)
+        value = self.backend.get(key)
+        if value is None:
+            value = _strip_csrf(caller())
+            self.backend.set(key, value, timeout)
+        return Markup(_restore_csrf(value))
+
+
+def _csrf_token():
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return None
+    from flask_wtf.csrf import generate_csrf
+    return generate_csrf()
+
+
+def _strip_csrf(data):
+    token = _csrf_token()
+    if not token:
+        return data
+    if isinstance(data, bytes) and not isinstance(token, bytes):
+        token = token.encode('ascii')
+        return data.replace(token, CSRF_PLACEHOLDER.encode('ascii'))
+    return data.replace(token, CSRF_PLACEHOLDER)
+
+
+def _restore_csrf(data):
+    placeholder = CSRF_PLACEHOLDER
+    if isinstance(data, bytes) and not isinstance(placeholder, bytes):
+        placeholder = placeholder.encode('ascii')
+    if placeholder not in data:
+        return data
+    token = _csrf_token() or ''
+    if isinstance(data, bytes) and not isinstance(token, bytes):
+        token = token.encode('ascii')
+    return data.replace(placeholder, token)
+
+
+class CacheExtension(Extension):
+    """模板片段缓存：
+
+        {% cache key, timeout, tags %} ... {% endcache %}
+
+    timeout 为None时使用默认过期时间，tags 是标签列表"""
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        while len(args) < 3:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body). \
+            set_lineno(lineno)
+
+    def _cache(self, key, timeout, tags, caller):
+        return self.environment.fragment_cache.fragment(key, timeout, tags or (), caller)
+
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from sqlalchemy import case
+from .hooks import call_after_commit
+
+
+class CounterBuffer(object):
+    """计数写回缓冲。
+
+    同一行的多次增量先在本进程内存中合并，每隔 interval 秒或累计 size 次增量后，
+    用一条 UPDATE 批量写回 table.column，进程退出时写回剩余的增量。
+    配置项以 prefix 开头：<prefix>_WRITE_BEHIND 为 False 时不启用，
+    调用方直接在事务中更新计数。
+    """
+
+    def __init__(self, table, column, prefix):
+        self.table_name = table
+        self.column_name = column
+        self.prefix = prefix
+        self.app = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._hits = 0
+        self._last_flush = time.time()
+        self._thread = None
+
+    def init_app(self, app):
+        app.config.setdefault(self.prefix + '_WRITE_BEHIND', False)
+        app.config.setdefault(self.prefix + '_FLUSH_INTERVAL', 5)
+        app.config.setdefault(self.prefix + '_FLUSH_SIZE', 100)
+        self.app = app
+        with self._lock:
+            self._pending = {}
+            self._hits = 0
+
+    def _config(self, name):
+        app = current_app if has_app_context() else self.app
+        return app.config[self.prefix + '_' + name]
+
+    @property
+    def enabled(self):
+        return self._config('WRITE_BEHIND')
+
+    def add(self, key, delta=1):
+        """累加一次增量，达到时间或次数阈值时立即写回。通常在提交后调用，
+        写回失败只记录日志，增量留在缓冲中等待下一次写回，不影响已提交的请求"""
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + delta
+            self._hits += 1
+            due = self._hits >= self._config('FLUSH_SIZE') or \
+                time.time() - self._last_flush >= self._config('FLUSH_INTERVAL')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self._flush_at_exit)
+        if due:
+            self._safe_flush()
+
+    def pending(self, key):
+        """尚未写回数据库的增量，用于显示时补上"""
+        with self._lock:
+            return self._pending.get(key, 0)
+
+    def flush(self):
+        """把合并后的增量一次性写回数据库，返回写回的行数"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._hits = 0
+            self._last_flush = time.time()
+        deltas = dict((key, delta) for key, delta in pending.items() if delta)
+        if not deltas:
+            return 0
+        try:
+            if has_app_context():
+                self._execute(deltas)
+            else:
+                with self.app.app_context():
+                    self._execute(deltas)
+        except Exception:
+            #写回失败时把增量放回缓冲，等待下一次写回
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+            raise
+        return len(deltas)
+
+    #每批用一条 UPDATE ... SET c = c + CASE id WHEN .. THEN .. END 写回，
+    #分批是为了不超过SQLite单条语句999个参数的限制
+    def _execute(self, deltas):
+        from . import db
+        table = db.metadata.tables[self.table_name]
+        column = table.c[self.column_name]
+        keys = sorted(deltas)
+        for i in range(0, len(keys), 300):
+            chunk = dict((key, deltas[key]) for key in keys[i:i + 300])
+            db.engine.execute(
+                table.update().where(table.c.id.in_(list(chunk))).
+                    values({column: column + case(chunk, value=table.c.id)}))
+
+    def _run(self):
+        while True:
+            time.sleep(self._config('FLUSH_INTERVAL'))
+            self._safe_flush()
+
+    #后台线程是守护线程，退出时不会等它，由这里写回最后一批增量
+    def _flush_at_exit(self):
+        if self.app is not None:
+            self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            if self.app is not None:
+                self.app.logger.exception('Failed to flush %s.%s' %
+                                          (self.table_name, self.column_name))
+
+    #在会话提交后才计入缓冲，事务回滚时丢弃
+    def add_on_commit(self, session, key, delta=1):
+        call_after_commit(session, self.add, key, delta)
+
+
+class DedupeWindow(object):
+    """记录最近出现过的键，同一个键在 window 秒内只算一次。
+    最多保留 max_size 个键，超出时淘汰最早的"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+
+    def seen(self, key, window):
+        """key在window秒内出现过返回True，否则记录下来并返回False"""
+        now = time.time()
+        with self._lock:
+            last = self._seen.pop(key, None)
+            if last is not None and now - last < window:
+                self._seen[key] = last
+                return True
+            self._seen[key] = now
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+
+#计数列的事务内维护。模型的counters()返回新增或删除该对象时要修改的
+#(计数所在的模型, 行id, 计数列)；多对多关系的增删先用pending_count记下，
+#flush之后统一用 SET c = c + delta 原子地更新
+def pending_count(session, model, obj, column, delta):
+    session.info.setdefault('pending_counts', []).append((model, obj, column, delta))
+
+
+def _change_counts(session, changes):
+    totals = {}
+    for model, id, column, delta in changes:
+        if id is not None:
+            totals[(model, id, column)] = totals.get((model, id, column), 0) + delta
+    expired = session.info.setdefault('expired_counts', set())
+    for (model, id, column), delta in totals.items():
+        if not delta:
+            continue
+        table = model.__table__
+        session.execute(table.update().where(table.c.id == id).
+                        values({column: table.c[column] + delta}))
+        expired.add((model, id, column))
+
+
+def on_after_flush(session, flush_context):
+    changes = []
+    for objects, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if hasattr(obj, 'counters'):
+                changes.extend((model, id, column, sign)
+                               for model, id, column in obj.counters())
+    for model, obj, column, delta in session.info.pop('pending_counts', []):
+        changes.append((model, obj.id, column, delta))
+    _change_counts(session, changes)
+
+
+#更新过的计数属性在会话中过期，下次访问时重新读取；参与搜索排序的计数在提交后
+#重新写入索引。放在所有after_flush之后，晚于新对象按内存中的值生成的文档
+def on_after_flush_postexec(session, flush_context):
+    from . import db, search_indexer
+    for model, id, column in session.info.pop('expired_counts', ()):
+        obj = session.identity_map.get(db.inspect(model).identity_key_from_primary_key((id,)))
+        if obj is not None:
+            session.expire(obj, [column])
+        search_indexer.refresh_column_on_commit(session, model, column, id)
+
+
+def recount(model, column, key):
+    """按key分组统计，重写model的计数列column"""
+    from . import db
+    table = model.__table__
+    counts = db.session.query(key, db.func.count()).filter(key.isnot(None)).\
+        group_by(key).all()
+    db.session.execute(table.update().values({column: 0}))
+    if counts:
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('_id')).
+                values({column: db.bindparam('_count')}),
+            [{'_id': id, '_count': count} for id, count in counts])
+
+
+def recount_all():
+    """重新计算所有冗余计数列（包括回答的likes_count），由调用者提交"""
+    from .models import User, Question, Topic, Answer, Follow, Like, \
+        questions_users, topics_users
+    recount(User, 'followings_count', Follow.follower_id)
+    recount(User, 'followers_count', Follow.followed_id)
+    recount(User, 'answers_count', Answer.user_id)
+    recount(User, 'questions_count', Question.user_id)
+    recount(Question, 'answers_count', Answer.question_id)
+    recount(Question, 'followers_count', questions_users.c.question_id)
+    recount(Topic, 'followers_count', topics_users.c.topic_id)
+    recount(Answer, 'likes_count', Like.answer_id)
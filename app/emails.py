@@ -1,22 +1,114 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import threading
 from flask_mail import Message
-from flask import current_app, render_template
-from . import mail
-from threading import Thread
+from flask import current_app, render_template, request, has_request_context
+from markupsafe import escape
+from . import mail_queue
+
+#模板中用到的对象属性，放入队列时只保存这些属性的值
+MAIL_ATTRIBUTES = ('username', 'email')
+
+
+class Placeholder(object):
+    """渲染骨架时代替模板变量，输出一个占位标记；取属性时得到该属性的占位符"""
+
+    def __init__(self, name, markers):
+        self._name = name
+        self._markers = markers
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return Placeholder('%s.%s' % (self._name, attr), self._markers)
+
+    def __unicode__(self):
+        #只用字母和数字，url_for不会转义
+        return self._markers.setdefault(self._name, u'ZHIHUMAIL%dX' % len(self._markers))
+
+    __str__ = __html__ = __unicode__
+
+
+class MailTemplates(object):
+    """邮件正文的骨架缓存。
+
+    每个模板用占位符渲染一次（txt和html），之后的邮件只把占位标记替换成
+    用户名、令牌等各自的值，html中的值会先转义。骨架按模板和站点地址缓存，
+    模板自动重载（调试模式）时不缓存。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._skeletons = {}
+
+    def clear(self):
+        with self._lock:
+            self._skeletons.clear()
+
+    def skeleton(self, template, base_url, names):
+        key = (template, base_url, tuple(sorted(names)))
+        with self._lock:
+            cached = self._skeletons.get(key)
+        if cached is not None:
+            return cached
+        markers = {}
+        context = dict((name, Placeholder(name, markers)) for name in names)
+        with current_app.test_request_context(base_url=base_url):
+            body = render_template(template + '.txt', **context)
+            html = render_template(template + '.html', **context)
+        cached = body, html, dict((marker, name) for name, marker in markers.items())
+        if not current_app.jinja_env.auto_reload:
+            with self._lock:
+                self._skeletons[key] = cached
+        return cached
+
+    def render(self, template, base_url, values):
+        """返回 (txt正文, html正文)，values是 {'token': ..., 'user.username': ...}"""
+        names = set(name.split('.', 1)[0] for name in values)
+        body, html, markers = self.skeleton(template, base_url, names)
+        for marker, name in markers.items():
+            value = values.get(name, u'')
+            body = body.replace(marker, value)
+            html = html.replace(marker, escape(value))
+        return body, html
+
+mail_templates = MailTemplates()
+
+
+#模板参数中的字符串原样保存，对象（如user）只保存MAIL_ATTRIBUTES中的属性
+def _mail_values(kwargs):
+    values = {}
+    for name, value in kwargs.items():
+        if isinstance(value, basestring):
+            values[name] = value
+            continue
+        for attr in MAIL_ATTRIBUTES:
+            if getattr(value, attr, None) is not None:
+                values['%s.%s' % (name, attr)] = getattr(value, attr)
+    return values
+
+
+def build_message(data):
+    """由队列中保存的数据构造Message，在发送线程中执行"""
+    body, html = data.get('body'), data.get('html')
+    if data.get('template'):
+        body, html = mail_templates.render(data['template'], data['base_url'],
+                                           data['values'])
+    return Message(data['subject'], sender=data['sender'],
+                   recipients=data['recipients'], cc=data.get('cc'),
+                   bcc=data.get('bcc'), reply_to=data.get('reply_to'),
+                   body=body, html=html)
 
-def send_asyn_mail(app, msg):
-    with app.app_context():
-        mail.send(msg)
 
 def send_mail(to, subject, template, **kwargs):
-    app = current_app._get_current_object()
-    msg = Message(current_app.config['ZHIHU_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=current_app.config['ZHIHU_MAIL_SENDER'],
-                  recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_asyn_mail, args=[app, msg])
-    thr.start()
-    return thr
+    """把邮件放入发送队列，返回队列中的id。
+
+    请求中只保存模板名和参数，正文由mail_queue的发送线程用mail_templates渲染"""
+    base_url = request.url_root if has_request_context() else \
+        'http://%s/' % (current_app.config['SERVER_NAME'] or 'localhost')
+    return mail_queue.enqueue_payload(dict(
+        subject=current_app.config['ZHIHU_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+        sender=current_app.config['ZHIHU_MAIL_SENDER'],
+        recipients=[to], template=template, base_url=base_url,
+        values=_mail_values(kwargs)))
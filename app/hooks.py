@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+
+def call_after_commit(session, func, *args):
+    """会话提交成功后再调用func(*args)，事务回滚时丢弃。
+    用于更新进程内的计数缓冲、排行和缓存，保证它们不会反映未提交的数据"""
+    session.info.setdefault('after_commit_calls', []).append((func, args))
+
+
+def on_after_commit(session):
+    for func, args in session.info.pop('after_commit_calls', []):
+        func(*args)
+
+
+def on_after_rollback(session):
+    session.info.pop('after_commit_calls', None)
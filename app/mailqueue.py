@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import json
+import smtplib
+import socket
+import sqlite3
+import threading
+import time
+
+#连接级别的错误：同一批中剩下的邮件也无法再通过这个连接发送
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                     socket.error)
+
+
+class MailQueue(object):
+    """持久化的邮件发送队列。
+
+    邮件先写入SQLite文件 ZHIHU_MAIL_QUEUE 的outbox表，进程重启后未发送的邮件
+    仍会继续发送。最多 ZHIHU_MAIL_WORKERS 个后台线程每次取出
+    ZHIHU_MAIL_BATCH_SIZE 封到期的邮件，同一批只打开一个SMTP连接。发送失败的
+    邮件按指数退避（ZHIHU_MAIL_RETRY_DELAY 起，每次加倍，最长
+    ZHIHU_MAIL_RETRY_MAX_DELAY）重试，超过 ZHIHU_MAIL_MAX_ATTEMPTS 次后标为failed。
+    ZHIHU_MAIL_WORKERS 为0时不启动后台线程，由 drain() 发送（如manage.py send_mails）。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.RLock()
+        self._event = threading.Event()
+        self._conn = None
+        self._threads = []
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = dict(queued=0, sent=0, retried=0, failed=0,
+                           batches=0, connections=0)
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_MAIL_QUEUE', ':memory:')
+        app.config.setdefault('ZHIHU_MAIL_WORKERS', 2)
+        app.config.setdefault('ZHIHU_MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('ZHIHU_MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('ZHIHU_MAIL_RETRY_DELAY', 30)
+        app.config.setdefault('ZHIHU_MAIL_RETRY_MAX_DELAY', 3600)
+        app.config.setdefault('ZHIHU_MAIL_CLAIM_TIMEOUT', 600)
+        app.config.setdefault('ZHIHU_MAIL_POLL_INTERVAL', 5)
+        self.app = app
+        with self._lock:
+            self._reset_stats()
+            self._conn = sqlite3.connect(app.config['ZHIHU_MAIL_QUEUE'], timeout=30,
+                                         isolation_level=None, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'payload TEXT NOT NULL, '
+                "status VARCHAR(16) NOT NULL DEFAULT 'queued', "
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL, '
+                'claimed_at REAL, '
+                'last_error TEXT, '
+                'created REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS ix_outbox_status_next_attempt '
+                               'ON outbox (status, next_attempt)')
+        #上次退出时还有未发送的邮件，启动后台线程接着发送
+        if self.pending():
+            self._start_workers()
+
+    def _execute(self, sql, *args):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def enqueue(self, msg):
+        """把flask_mail.Message放入队列，返回队列中的id"""
+        return self.enqueue_payload(dict(
+            subject=msg.subject, sender=msg.sender, recipients=msg.recipients,
+            cc=msg.cc, bcc=msg.bcc, reply_to=msg.reply_to,
+            body=msg.body, html=msg.html))
+
+    def enqueue_payload(self, data):
+        """放入由emails.build_message构造邮件的数据，正文可以留到发送时再渲染"""
+        payload = json.dumps(data)
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO outbox (payload, next_attempt, created) VALUES (?, ?, ?)',
+                (payload, now, now))
+            self._stats['queued'] += 1
+        self._start_workers()
+        self._event.set()
+        return cursor.lastrowid
+
+    def pending(self):
+        """等待发送（包括等待重试）的邮件数"""
+        return self._execute("SELECT count(*) FROM outbox WHERE status != 'failed'")[0][0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['pending'] = self.pending()
+        stats['dead'] = self._execute(
+            "SELECT count(*) FROM outbox WHERE status = 'failed'")[0][0]
+        return stats
+
+    #取出一批到期的邮件并标为sending；认领超时的邮件（发送进程已退出）重新认领
+    def _claim(self):
+        now = time.time()
+        stale = now - self.app.config['ZHIHU_MAIL_CLAIM_TIMEOUT']
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, payload, attempts FROM outbox "
+                    "WHERE (status = 'queued' AND next_attempt <= ?) "
+                    "OR (status = 'sending' AND claimed_at < ?) "
+                    "ORDER BY next_attempt LIMIT ?",
+                    (now, stale, self.app.config['ZHIHU_MAIL_BATCH_SIZE'])).fetchall()
+                self._conn.executemany(
+                    "UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                    [(now, row[0]) for row in rows])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return rows
+
+    def _delay(self, attempts):
+        return min(self.app.config['ZHIHU_MAIL_RETRY_DELAY'] * 2 ** (attempts - 1),
+                   self.app.config['ZHIHU_MAIL_RETRY_MAX_DELAY'])
+
+    def _sent(self, mail_id):
+        with self._lock:
+            self._conn.execute('DELETE FROM outbox WHERE id = ?', (mail_id,))
+            self._stats['sent'] += 1
+
+    def _failed(self, mail_id, attempts, error):
+        attempts += 1
+        with self._lock:
+            if attempts >= self.app.config['ZHIHU_MAIL_MAX_ATTEMPTS']:
+                self._conn.execute(
+                    "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? "
+                    "WHERE id = ?", (attempts, error, mail_id))
+                self._stats['failed'] += 1
+            else:
+                self._conn.execute(
+                    "UPDATE outbox SET status = 'queued', attempts = ?, last_error = ?, "
+                    "next_attempt = ? WHERE id = ?",
+                    (attempts, error, time.time() + self._delay(attempts), mail_id))
+                self._stats['retried'] += 1
+        if attempts >= self.app.config['ZHIHU_MAIL_MAX_ATTEMPTS']:
+            self.app.logger.error('Giving up mail %d after %d attempts: %s',
+                                  mail_id, attempts, error)
+
+    def _message(self, payload):
+        from .emails import build_message
+        return build_message(json.loads(payload))
+
+    def _send_batch(self, rows):
+        from . import mail
+        remaining = list(rows)
+        try:
+            with mail.connect() as connection:
+                with self._lock:
+                    self._stats['batches'] += 1
+                    if connection.host is not None:
+                        self._stats['connections'] += 1
+                while remaining:
+                    mail_id, payload, attempts = remaining[0]
+                    try:
+                        connection.send(self._message(payload))
+                    except CONNECTION_ERRORS:
+                        raise
+                    except Exception as e:
+                        self._failed(mail_id, attempts, repr(e))
+                    else:
+                        self._sent(mail_id)
+                    remaining.pop(0)
+        except Exception as e:
+            #连接失败或中途断开，这一批剩下的邮件都稍后重试
+            self.app.logger.warning('Mail connection failed: %r', e)
+            for mail_id, _, attempts in remaining:
+                self._failed(mail_id, attempts, repr(e))
+
+    def drain(self):
+        """在当前线程发送所有到期的邮件，返回处理的邮件数"""
+        count = 0
+        with self.app.app_context():
+            while True:
+                rows = self._claim()
+                if not rows:
+                    return count
+                self._send_batch(rows)
+                count += len(rows)
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.app.config['ZHIHU_MAIL_WORKERS']:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            self._event.wait(self.app.config['ZHIHU_MAIL_POLL_INTERVAL'])
+            self._event.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.app.logger.exception('Failed to send queued mails')
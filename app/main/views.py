@@ -2,102 +2,99 @@
 # -*-coding:utf-8 -*-
 
 from flask import render_template, flash, redirect, url_for, abort, \
-    make_response,request, current_app, g
+    make_response,request, current_app, g, jsonify
 from flask_login import login_required, current_user
-from flask_sqlalchemy import get_debug_queries
 from . import main
-from .. import login_manager, db
-from ..models import User, Topic, Question, Answer, Comment, Permission, Like
+from .. import login_manager, db, hot_ranking, top_answers, cache, query_profiler, \
+    search_indexer
+from ..models import User, Topic, Question, Answer, Comment, Permission, Like, \
+    Feed, Follow, answer_topics
+from ..pagination import KeysetPagination, OffsetPagination
+from ..viewmodels import load_answer_views, load_like_answers, answer_view
 from .forms import EditProfileForm, AddTopicForm, AskingForm, AnswerForm, \
     CommentForm
 from ..decorators import permission_required, admin_required
-from datetime import datetime, timedelta
+from datetime import timedelta
+from sqlalchemy.exc import IntegrityError
 
-question_views = 0
+#模板中通过answer_view(answer)读取批量加载的回答统计数据
+main.add_app_template_global(answer_view)
 
-#请求结束时调用，把查询时间超过限定值的SQL语句记录日志
-@main.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >= current_app.config['ZHIHU_SLOW_DB_QUERY_TIME']:
-            current_app.logger.warning('Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n'
-                % (query.statement, query.parameters, query.duration,
-                   query.context))
-    return response
-
-#首页；根据cookies判断要看的内容和页数
+#首页；根据cookies判断要看的内容和游标。未登录用户看到的页面是相同的（最高赞），整页缓存
 @main.route('/')
+@cache.cached_response(tags=['answers', 'top-answers'], vary=['cursor'],
+                       unless=lambda: current_user.is_authenticated)
 def index():
     choice = int(request.cookies.get('choice', '3'))
     if not current_user.is_authenticated:
         choice = 3
-    page = int(request.cookies.get('page', '1'))
+    cursor = request.cookies.get('cursor')
     if choice == 2:
         answers = []
-        pagination = current_user.likes_followings.\
-            paginate(page, per_page=10, error_out=False)
+        pagination = KeysetPagination(current_user.likes_followings,
+                        [(Like.timestamp, True), (Like.id, True)],
+                        cursor=cursor, per_page=10)
         likes = pagination.items
     elif choice == 1:
-        pagination = current_user.answers_followings.\
-            paginate(page, per_page=10, error_out=False)
+        pagination = KeysetPagination(current_user.answers_followings,
+                        [(Feed.timestamp, True), (Feed.answer_id, True)],
+                        cursor=cursor, per_page=10,
+                        key=lambda answer: [answer.timestamp, answer.id])
         answers = pagination.items
         likes = []
     elif choice == 0:
-        pagination = current_user.answers_interested_topics.\
-            paginate(page, per_page=10, error_out=False)
-        answers = pagination.items
+        pagination = KeysetPagination(current_user.answers_interested_topics,
+                        [(answer_topics.c.timestamp, True), (answer_topics.c.answer_id, True)],
+                        cursor=cursor, per_page=10)
+        answers = _answers_by_ids([row.answer_id for row in pagination.items])
         likes = []
     else:
-        pagination = Answer.query.order_by(Answer.likes_count).\
-            paginate(page, per_page=10, error_out=False)
+        pagination = KeysetPagination(Answer.query,
+                        [(Answer.likes_count, True), (Answer.timestamp, True), (Answer.id, True)],
+                        cursor=cursor, per_page=10, cache=top_answers)
         answers = pagination.items
         likes = []
+    load_answer_views(answers)
+    load_like_answers(likes)
     return render_template('index.html', answers=answers,
                     likes=likes,choice=choice, pagination=pagination)
 
+#切换首页的内容，游标存入cookies
+def _show_choice(choice):
+    resp = make_response(redirect(url_for('.index')))
+    resp.set_cookie('choice', choice, max_age=30 * 24 * 60 * 60)
+    resp.set_cookie('cursor', request.args.get('cursor', ''))
+    return resp
+
 @main.route('/answers-interested-topics')
 @login_required
 def show_answers_interested_topics():
-    PageNum = request.args.get('page', 1, type=int)
-    resp = make_response(redirect(url_for('.index',)))
-    resp.set_cookie('choice', '0', max_age=30 * 24 * 60 * 60)
-    resp.set_cookie('page', str(PageNum))
-    return resp
+    return _show_choice('0')
 
 @main.route('/answers-followings')
 @login_required
 def show_answers_followings():
-    PageNum = request.args.get('page', 1, type=int)
-    resp = make_response(redirect(url_for('.index')))
-    resp.set_cookie('choice', '1', max_age=30 * 24 * 60 * 60)
-    resp.set_cookie('page', str(PageNum))
-    return resp
+    return _show_choice('1')
 
 @main.route('/likes-followings')
 @login_required
 def show_likes_followings():
-    PageNum = request.args.get('page', 1, type=int)
-    resp = make_response(redirect(url_for('.index')))
-    resp.set_cookie('choice', '2', max_age=30 * 24 * 60 * 60)
-    resp.set_cookie('page', str(PageNum))
-    return resp
+    return _show_choice('2')
 
 @main.route('/all-answers')
 def show_all():
-    PageNum = request.args.get('page', 1, type=int)
-    resp = make_response(redirect(url_for('.index')))
-    resp.set_cookie('choice', '3', max_age=30 * 24 * 60 * 60)
-    resp.set_cookie('page', str(PageNum))
-    return resp
+    return _show_choice('3')
 
 #个人页面，默认为个人的点赞动态
 @main.route('/people/<username>/activities')
 @login_required
 def profile(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    pagination = user.personal_likes.paginate(page, per_page=10, error_out=False)
+    pagination = KeysetPagination(user.personal_likes,
+                    [(Like.timestamp, True), (Like.id, True)],
+                    cursor=request.args.get('cursor'), per_page=10)
     likes = pagination.items
+    load_like_answers(likes)
     return render_template('main/profile_activities.html',
                            pagination=pagination,user=user, likes=likes)
 
@@ -105,10 +102,12 @@ def profile(username):
 @main.route('/people/<username>/answers')
 @login_required
 def people_answers(username):
-    page = request.args.get('page', 1, type=int)
     user = User.query.filter_by(username=username).first_or_404()
-    pagination = user.personal_answers.paginate(page, per_page=10, error_out=False)
+    pagination = KeysetPagination(user.personal_answers,
+                    [(Answer.timestamp, True), (Answer.id, True)],
+                    cursor=request.args.get('cursor'), per_page=10)
     answers = pagination.items
+    load_answer_views(answers)
     return render_template('main/profile_answers.html',
                            pagination=pagination,user=user, answers=answers)
 
@@ -125,14 +124,26 @@ def people_asks(username):
 @login_required
 def followings(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('main/followings.html', user=user)
+    pagination = KeysetPagination(user.followings,
+                    [(Follow.timestamp, True), (Follow.followed_id, True)],
+                    cursor=request.args.get('cursor'), per_page=20)
+    follows = pagination.items
+    following_ids = current_user.following_ids_among(f.followed_id for f in follows)
+    return render_template('main/followings.html', user=user, follows=follows,
+                           pagination=pagination, following_ids=following_ids)
 
 #关注该用户的人
 @main.route('/people/<username>/followers')
 @login_required
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
-    return render_template('main/followers.html', user=user)
+    pagination = KeysetPagination(user.followers,
+                    [(Follow.timestamp, True), (Follow.follower_id, True)],
+                    cursor=request.args.get('cursor'), per_page=20)
+    follows = pagination.items
+    following_ids = current_user.following_ids_among(f.follower_id for f in follows)
+    return render_template('main/followers.html', user=user, follows=follows,
+                           pagination=pagination, following_ids=following_ids)
 
 #关注的话题
 @main.route('/people/<username>/following/topics')
@@ -185,6 +196,7 @@ def editprofile():
 #话题广场，包含网站所有话题
 @main.route('/topics')
 @login_required
+@cache.cached_response(tags=['topics'])
 def topic_square():
     topics = Topic.query.all()
     return render_template('topic_square.html', topics=topics)
@@ -205,11 +217,15 @@ def add_topic():
 #话题的动态，按照最新时间排布话题的所有回答
 @main.route('/topic/<int:id>/hot')
 @login_required
+@cache.cached_response(tags=lambda id: ['topic:%d' % id])
 def topic_dynamics(id):
-    page = request.args.get('page',1,type=int)
     topic = Topic.query.get_or_404(id)
-    pagination = topic.all_answers.paginate(page, per_page=10, error_out=False)
+    pagination = KeysetPagination(topic.all_answers,
+                    [(answer_topics.c.timestamp, True), (answer_topics.c.answer_id, True)],
+                    cursor=request.args.get('cursor'), per_page=10,
+                    key=lambda answer: [answer.timestamp, answer.id])
     answers = pagination.items
+    load_answer_views(answers)
     return render_template('topic_dynamics.html',pagination=pagination,
                            answers=answers, topic=topic)
 
@@ -229,7 +245,14 @@ def topic_unanswered(id):
 @login_required
 def topic_followers(id):
     topic = Topic.query.get_or_404(id)
-    return render_template('topic_followers.html', topic=topic)
+    pagination = KeysetPagination(topic.followers, [(User.id, False)],
+                    cursor=request.args.get('cursor'), per_page=20)
+    followers = pagination.items
+    following_ids = current_user.following_ids_among(u.id for u in followers)
+    answer_counts = topic.answer_counts_of(u.id for u in followers)
+    return render_template('topic_followers.html', topic=topic, followers=followers,
+                           pagination=pagination, following_ids=following_ids,
+                           answer_counts=answer_counts)
 
 #提问
 @main.route('/asking', methods=['GET', 'POST'])
@@ -259,8 +282,8 @@ def question(id):
     if not current_user.can(Permission.WRITE_ARTICLES):
         abort(403)
     question = Question.query.get_or_404(id)
-    global question_views
-    question_views += 1
+    if request.method == 'GET':
+        question.add_view(current_user._get_current_object())
     if form.validate_on_submit():
         answer = Answer(body=form.body.data,
                         question=question,
@@ -270,8 +293,10 @@ def question(id):
         flash(u'成功提交回答')
         return redirect(url_for('main.question', id=question.id))
 
-    return render_template('main/question.html', question=question,
-                           form=form, question_views=question_views)
+    answers = question.answers.all()
+    load_answer_views(answers)
+    return render_template('main/question.html', question=question, answers=answers,
+                           form=form, question_views=question.views)
 
 #单个回答的页面
 @main.route('/question/<int:id_que>/answer/<int:id_ans>', methods=['GET', 'POST'])
@@ -401,7 +426,13 @@ def follow_question(id):
 @login_required
 def question_followers(id):
     question = Question.query.get_or_404(id)
-    return render_template('main/question_followers.html', question=question)
+    pagination = KeysetPagination(question.followers, [(User.id, False)],
+                    cursor=request.args.get('cursor'), per_page=20)
+    followers = pagination.items
+    following_ids = current_user.following_ids_among(u.id for u in followers)
+    return render_template('main/question_followers.html', question=question,
+                           followers=followers, pagination=pagination,
+                           following_ids=following_ids)
 
 #取关问题
 @main.route('/question/<int:id>/unfollow')
@@ -421,12 +452,12 @@ def unfollow_question(id):
 @permission_required(Permission.COMMENT)
 def like_answer(id):
     answer = Answer.query.get_or_404(id)
-    count = answer.likes.count()
-    like = Like(answer=answer, user=current_user._get_current_object())
-    db.session.add(like)
-    answer.likes_count = count + 1
-    db.session.add(answer)
-    return redirect(url_for('main.question', id=answer.question.id))
+    try:
+        answer.like(current_user._get_current_object())
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    return redirect(url_for('main.question', id=answer.question_id))
 
 #取消赞同回答
 @main.route('/answer/<int:id>/dislike')
@@ -434,38 +465,44 @@ def like_answer(id):
 @permission_required(Permission.COMMENT)
 def dislike_answer(id):
     answer = Answer.query.get_or_404(id)
-    like = answer.likes.filter_by(user_id=current_user.id).first()
-    if like:
-        db.session.delete(like)
-    return redirect(url_for('main.question', id=answer.question.id))
+    answer.unlike(current_user._get_current_object())
+    db.session.commit()
+    return redirect(url_for('main.question', id=answer.question_id))
+
+#按排好的id用一次IN查询取出回答，保持ids的顺序
+def _answers_by_ids(ids):
+    answers = dict((answer.id, answer) for answer in
+                   Answer.query.filter(Answer.id.in_(ids))) if ids else {}
+    return [answers[id] for id in ids if id in answers]
+
+#按排好的id取出一页回答，ids比per_page多一个时还有下一页
+def _answers_page(ids, offset, per_page):
+    answers = _answers_by_ids(ids[:per_page])
+    load_answer_views(answers)
+    return OffsetPagination(answers, offset, per_page, len(ids) > per_page)
+
+#从热度排行中取出一页回答
+def _hot_answers(window, per_page=20):
+    offset = OffsetPagination.offset_of(request.args.get('cursor'))
+    return _answers_page(hot_ranking.top(window, offset, per_page + 1), offset, per_page)
 
 #显示每天最热的回答
 @main.route('/explore/daily-hot')
 @login_required
 def daily_hot():
-    page = request.args.get('page', 1, type=int)
-    in_one_day = datetime.utcnow() - timedelta(days=1)
-    pagination = Answer.query.filter(Answer.timestamp > in_one_day).filter(
-        Answer.likes_count > 0).order_by(Answer.timestamp.desc()).\
-        paginate(page, error_out=False)
-    answers_daily_hot = pagination.items
+    pagination = _hot_answers(timedelta(days=1))
     return render_template('main/daily_hot.html',
                            pagination=pagination,
-                           answers_daily_hot=answers_daily_hot)
+                           answers_daily_hot=pagination.items)
 
 #显示每月最热回答
 @main.route('/explore/monthly-hot')
 @login_required
 def monthly_hot():
-    page = request.args.get('page', 1, type=int)
-    in_a_month = datetime.utcnow() - timedelta(days=30)
-    pagination = Answer.query.filter(Answer.timestamp > in_a_month).\
-        filter(Answer.likes_count > 0).order_by(Answer.timestamp.desc()).\
-        paginate(page, error_out=False)
-    answers_monthly_hot = pagination.items
+    pagination = _hot_answers(timedelta(days=30))
     return render_template('/main/monthly_hot.html',
                            pagination=pagination,
-                           answers_monthly_hot=answers_monthly_hot)
+                           answers_monthly_hot=pagination.items)
 
 #搜索回答
 @main.route('/search', methods=['GET', 'POST'])
@@ -475,10 +512,46 @@ def search():
         return redirect(url_for('main.index'))
     return redirect(url_for('main.search_results', query=g.search_form.search.data))
 
-#搜索回答并按时间降序排列
+#搜索回答，按相关度、赞同数和发布时间排序，从索引的命中中取出一页
 @main.route('/search_results/<query>')
 @login_required
 def search_results(query):
-    answers = Answer.query.whooshee_search(query.encode('utf-8'))\
-        .order_by(Answer.timestamp.desc()).limit(30)
-    return render_template('search.html', answers=answers, query=query)
+    offset = OffsetPagination.offset_of(request.args.get('cursor'))
+    pagination = _answers_page(search_indexer.search(Answer, query, offset, 21), offset, 20)
+    related = search_indexer.federated(query, [Question, Topic, User], limit=5)
+    return render_template('search.html', answers=pagination.items,
+                           pagination=pagination, query=query, related=related)
+
+#联合搜索的类型：模型和转换成JSON的函数
+SUGGEST_TYPES = {
+    'questions': (Question, lambda q: dict(
+        id=q.id, title=q.title, url=url_for('main.question', id=q.id))),
+    'topics': (Topic, lambda t: dict(
+        id=t.id, name=t.name, url=url_for('main.topic_dynamics', id=t.id))),
+    'users': (User, lambda u: dict(
+        id=u.id, username=u.username, description=u.description,
+        url=url_for('main.profile', username=u.username))),
+}
+
+#联合搜索问题、话题和用户，返回JSON。types选择要搜索的类型（逗号分隔），
+#prefix=1时最后一个词按前缀匹配，供提问框在输入时查找相似的问题
+@main.route('/search/suggest')
+@login_required
+def search_suggest():
+    query = request.args.get('q', '').strip()
+    types = [name for name in request.args.get('types', 'questions,topics,users').split(',')
+             if name in SUGGEST_TYPES]
+    limit = max(min(request.args.get('limit', 5, type=int), 20), 1)
+    if not query:
+        return jsonify(dict((name, []) for name in types))
+    results = search_indexer.federated(query, [SUGGEST_TYPES[name][0] for name in types],
+                                       limit, prefix=request.args.get('prefix') == '1')
+    return jsonify(dict((name, [SUGGEST_TYPES[name][1](obj) for obj in objects])
+                        for name, objects in results.items()))
+
+#管理员查看采样得到的SQL查询统计
+@main.route('/admin/query-stats')
+@login_required
+@admin_required
+def query_stats():
+    return jsonify(query_profiler.stats())
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-from . import db, login_manager, whooshee
+from . import db, login_manager, like_counter, view_counter, \
+    recent_views, hot_ranking, top_answers, cache, body_renderer, password_hasher, \
+    tokens, search_indexer
+from . import hooks, counters
 from flask_login import UserMixin, current_user, AnonymousUserMixin
-from flask import request, current_app
-from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from flask import request, current_app, g
 import hashlib, forgery_py
+from collections import namedtuple
 from random import seed, randint
 from sqlalchemy.exc import IntegrityError
-from markdown import markdown
-import bleach
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 
 
 class Permission(object):
@@ -21,6 +24,10 @@ class Permission(object):
     MODERATE_COMMENTS = 0x08
     ADMINISTER = 0x80
 
+#角色表的只读快照：permissions是 {角色id: 权限}，default_id是默认角色，
+#administrator_id是拥有全部权限的角色
+RoleTable = namedtuple('RoleTable', ['permissions', 'default_id', 'administrator_id'])
+
 class Follow(db.Model):
     """关注用户/被关注用户 表格"""
     __tablename__  = 'follows'
@@ -29,11 +36,95 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     timestamp = db.Column(db.DateTime(), default=datetime.utcnow)
 
+    #关注变化后关注方的关注列表缓存失效
+    def cache_tags(self):
+        return ['following:%d' % self.follower_id]
+
+    def counters(self):
+        return [(User, self.follower_id, 'followings_count'),
+                (User, self.followed_id, 'followers_count')]
+
+class Feed(db.Model):
+    """首页"关注人的回答"推送表格。回答提交时写入作者每个关注者的一行（写扩散），
+    读取时只需按 (user_id, timestamp) 索引顺序扫描，无需连接follows表"""
+    __tablename__ = 'feeds'
+    __table_args__ = (db.Index('ix_feeds_user_timestamp', 'user_id', 'timestamp', 'answer_id'),)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    answer_id = db.Column(db.Integer, db.ForeignKey('answers.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    timestamp = db.Column(db.DateTime())
+
+    #把回答推送给作者当前的所有关注者
+    @staticmethod
+    def push_answers(session, answer_ids):
+        session.execute(Feed.__table__.insert().from_select(
+            ['user_id', 'answer_id', 'author_id', 'timestamp'],
+            db.select([Follow.follower_id, Answer.id, Answer.user_id, Answer.timestamp]).
+                where(Follow.followed_id == Answer.user_id).
+                where(Answer.id.in_(answer_ids))))
+
+    #关注后补上被关注者已有的回答
+    @staticmethod
+    def add_author(session, user_id, author_id, exclude_answer_ids=()):
+        select = db.select([db.literal(user_id), Answer.id, Answer.user_id, Answer.timestamp]).\
+            where(Answer.user_id == author_id)
+        if exclude_answer_ids:
+            select = select.where(~Answer.id.in_(exclude_answer_ids))
+        session.execute(Feed.__table__.insert().from_select(
+            ['user_id', 'answer_id', 'author_id', 'timestamp'], select))
+
+    #取关后移除被取关者的回答
+    @staticmethod
+    def remove_author(session, user_id, author_id):
+        session.execute(Feed.__table__.delete().where(db.and_(
+            Feed.user_id == user_id, Feed.author_id == author_id)))
+
+    @staticmethod
+    def remove_answers(session, answer_ids):
+        session.execute(Feed.__table__.delete().where(Feed.answer_id.in_(answer_ids)))
+
+    #重建推送表格，user为空时重建所有用户
+    @staticmethod
+    def rebuild(user=None):
+        delete = Feed.__table__.delete()
+        select = db.select([Follow.follower_id, Answer.id, Answer.user_id, Answer.timestamp]).\
+            where(Follow.followed_id == Answer.user_id)
+        if user is not None:
+            delete = delete.where(Feed.user_id == user.id)
+            select = select.where(Follow.follower_id == user.id)
+        db.session.execute(delete)
+        db.session.execute(Feed.__table__.insert().from_select(
+            ['user_id', 'answer_id', 'author_id', 'timestamp'], select))
+        db.session.commit()
+
+    #每次flush后根据新增的回答和关注关系的变化维护推送表格
+    @staticmethod
+    def on_after_flush(session, flush_context):
+        new_answer_ids = [obj.id for obj in session.new if isinstance(obj, Answer)]
+        for obj in session.new:
+            if isinstance(obj, Follow):
+                Feed.add_author(session, obj.follower_id, obj.followed_id, new_answer_ids)
+        if new_answer_ids:
+            Feed.push_answers(session, new_answer_ids)
+        for obj in session.deleted:
+            if isinstance(obj, Follow):
+                Feed.remove_author(session, obj.follower_id, obj.followed_id)
+
+    #要删除的回答在flush之前移出推送表格，否则DELETE answers会违反外键约束
+    @staticmethod
+    def on_before_flush(session, flush_context, instances):
+        deleted_answer_ids = [obj.id for obj in session.deleted if isinstance(obj, Answer)]
+        if deleted_answer_ids:
+            Feed.remove_answers(session, deleted_answer_ids)
+
 #问题/关注问题的用户表格
 questions_users = db.Table('questions_users',
                     db.Column('question_id', db.Integer, db.ForeignKey('questions.id')),
                     db.Column('follower_id', db.Integer, db.ForeignKey('users.id')))
 
+@search_indexer.register_model('title', 'body', popularity='followers_count',
+                                recency='timestamp')
 class Question(db.Model):
     """问题表格。每个问题可能关联多个话题，有多个关注者，有多个回答。"""
     __tablename__ = 'questions'
@@ -43,12 +134,46 @@ class Question(db.Model):
     body = db.Column(db.Text())
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     timestamp = db.Column(db.DateTime(), default=datetime.utcnow)
+    view_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    answers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     followers = db.relationship('User',
                                 secondary=questions_users,
                                 backref=db.backref('questions_following', lazy='dynamic'),
                                 lazy='dynamic')
     answers = db.relationship('Answer', backref='question', lazy='dynamic')
 
+    def counters(self):
+        return [(User, self.user_id, 'questions_count')]
+
+    #关注者增删时在flush后更新followers_count
+    @staticmethod
+    def on_followers_changed(delta):
+        def listener(question, user, initiator):
+            counters.pending_count(db.session(), Question, question, 'followers_count', delta)
+        return listener
+
+    #记录一次浏览。同一用户在去重窗口内的重复浏览不计；
+    #开启写回缓冲时只在内存中累加，由缓冲定期批量写回
+    def add_view(self, user=None):
+        window = current_app.config['ZHIHU_VIEW_DEDUPE_WINDOW']
+        if window and user is not None and \
+                recent_views.seen((user.id, self.id), window):
+            return False
+        if view_counter.enabled:
+            view_counter.add(self.id)
+        else:
+            questions = Question.__table__
+            db.session.execute(questions.update().where(questions.c.id == self.id).
+                               values(view_count=questions.c.view_count + 1))
+            db.session.expire(self, ['view_count'])
+        return True
+
+    #包括尚未写回的浏览数
+    @property
+    def views(self):
+        return self.view_count + view_counter.pending(self.id)
+
     #生成大量虚拟问题
     @staticmethod
     def generate_fake(count=500):
@@ -73,6 +198,7 @@ class Question(db.Model):
 
 
 
+@search_indexer.register_model('username', 'description', popularity='followers_count')
 class User(UserMixin, db.Model):
     """模型中最关键的，用户表格。"""
     __tablename__ = 'users'
@@ -91,6 +217,10 @@ class User(UserMixin, db.Model):
     working_experience = db.Column(db.Text)
     education_experience = db.Column(db.Text)
     gender = db.Column(db.String(32))
+    followings_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    answers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    questions_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     questions_asked = db.relationship('Question',backref='author', lazy='dynamic')
     answers = db.relationship('Answer', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
@@ -136,11 +266,12 @@ class User(UserMixin, db.Model):
     #构造方法。实例化用户时，设置用户角色和avatar_hash用于头像
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        if self.role is None and self.role_id is None:
+            roles = Role.table()
             if self.email == current_app.config['ZHIHU_ADMIN']:
-                self.role = Role.query.filter_by(permissions=0xff).first()
+                self.role_id = roles.administrator_id
             else:
-                self.role = Role.query.filter_by(default=True).first()
+                self.role_id = roles.default_id
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = hashlib.md5(self.email.encode('utf-8')).hexdigest()
 
@@ -150,10 +281,16 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
+    #校验成功且散列的算法或参数与当前配置不同时，按当前配置重新散列
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.password = password
+            db.session.add(self)
+        return True
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -165,9 +302,13 @@ class User(UserMixin, db.Model):
         return '{url}/{hash}?s={size}&d={default}&r={rating}'.format(
             url=url, hash=hash, size=size, default=default, rating=rating)
 
+    #按角色表快照检查权限，不查询数据库
     def can(self, permissions):
-        return self.role is not None and \
-               (self.role.permissions & permissions) == permissions
+        if self.role_id is not None:
+            granted = Role.table().permissions.get(self.role_id, 0)
+        else:
+            granted = self.role.permissions if self.role is not None else 0
+        return (granted & permissions) == permissions
 
     def is_administer(self):
         return self.can(Permission.ADMINISTER)
@@ -182,11 +323,73 @@ class User(UserMixin, db.Model):
         if not self.is_following(user):
             f = Follow(follower=self, followed=user)
             db.session.add(f)
+            self._forget_following_ids()
 
     def unfollow(self, user):
         f = self.followings.filter_by(followed_id=user.id).first()
         if f:
             db.session.delete(f)
+            self._forget_following_ids()
+
+    #该用户关注的所有用户的id。同一请求内只查询一次；ZHIHU_FOLLOWING_CACHE_TIMEOUT
+    #大于0时还在缓存中保留这么多秒，关注关系变化后失效
+    def following_ids(self):
+        loaded = getattr(g, 'following_ids', None)
+        if loaded is None:
+            loaded = g.following_ids = {}
+        if self.id not in loaded:
+            timeout = current_app.config.get('ZHIHU_FOLLOWING_CACHE_TIMEOUT', 0)
+            key, tags = 'following_ids:%d' % self.id, ['following:%d' % self.id]
+            ids = cache.get(key, tags) if timeout else None
+            if ids is None:
+                ids = frozenset(followed_id for followed_id, in db.session.query(
+                    Follow.followed_id).filter(Follow.follower_id == self.id))
+                if timeout:
+                    cache.set(key, ids, tags, timeout)
+            loaded[self.id] = ids
+        return loaded[self.id]
+
+    #用户资料、密码、邮箱、确认状态等变化后，提交时使用户快照失效
+    def cache_tags(self):
+        return ['user:%d' % self.id] if self.id is not None else []
+
+    #快照中的列：密码散列不进入缓存，计数列由counters直接更新，这些列用到时再加载
+    @staticmethod
+    def snapshot_columns():
+        return [attr.key for attr in db.inspect(User).column_attrs
+                if attr.key != 'password_hash' and not attr.key.endswith('_count')]
+
+    @staticmethod
+    def load(user_id):
+        """按id取用户，供user_loader使用。用户的列快照在缓存中保留
+        ZHIHU_USER_CACHE_TIMEOUT 秒，命中时直接构造会话中的对象，不查询users表"""
+        timeout = current_app.config.get('ZHIHU_USER_CACHE_TIMEOUT', 0)
+        user = db.session.identity_map.get(identity_key(User, user_id))
+        if user is not None or not timeout:
+            return user or User.query.get(user_id)
+        stamp = cache.stamp('user:%d' % user_id, ['user:%d' % user_id])
+        columns = cache.backend.get(stamp)
+        if columns is None:
+            user = User.query.get(user_id)
+            if user is not None:
+                cache.backend.set(stamp, dict((key, getattr(user, key))
+                                              for key in User.snapshot_columns()), timeout)
+            return user
+        user = db.inspect(User).class_manager.new_instance()
+        for key, value in columns.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        db.session.add(user)
+        db.session.expire(user, [attr.key for attr in db.inspect(User).column_attrs
+                                 if attr.key not in columns])
+        return user
+
+    #列表页面一次取出当前用户关注了其中哪些人
+    def following_ids_among(self, ids):
+        return self.following_ids() & set(ids)
+
+    def _forget_following_ids(self):
+        getattr(g, 'following_ids', {}).pop(self.id, None)
 
     def is_following_topic(self, topic):
         return topic in self.topics
@@ -216,28 +419,52 @@ class User(UserMixin, db.Model):
 
     #用户在某一话题下的回答数量
     def answers_of_topic(self, topic):
-        answer_counts = 0
-        for answer in self.answers:
-            if topic in answer.question.topics:
-                answer_counts += 1
-        return answer_counts
+        return self.answer_counts_by_topic().get(topic.id, 0)
+
+    #用户在各个话题下的回答数量 {topic_id: count}，一次GROUP BY查询得到；
+    #结果在缓存中按用户保存，用户发布或删除回答、回答所属问题的话题变化后失效
+    def answer_counts_by_topic(self):
+        stamp = cache.stamp('topic_counts:%d' % self.id, ['user-answers:%d' % self.id])
+        counts = cache.backend.get(stamp)
+        if counts is None:
+            counts = dict(db.session.query(answer_topics.c.topic_id, db.func.count()).
+                          join(Answer, Answer.id == answer_topics.c.answer_id).
+                          filter(Answer.user_id == self.id).
+                          group_by(answer_topics.c.topic_id))
+            cache.backend.set(stamp, counts)
+        return counts
+
+    #回答最多的几个话题，[(topic, count)]；从缓存的各话题回答数中取前几个，
+    #再用一次IN查询取出话题
+    def top_topics(self, limit=5):
+        counts = sorted(self.answer_counts_by_topic().items(),
+                        key=lambda item: (-item[1], item[0]))[:limit]
+        if not counts:
+            return []
+        topics = dict((topic.id, topic) for topic in
+                      Topic.query.filter(Topic.id.in_([id for id, _ in counts])))
+        return [(topics[id], count) for id, count in counts if id in topics]
 
     #判断用户是否赞过回答
     def have_liked(self, answer):
         return answer.likes.filter_by(user_id=current_user.id).first() is not None
 
-    #找出用户关注的全部话题下的所有回答并按照时间降序排列
+    #找出用户关注的全部话题下的所有回答 (answer_id, timestamp) 并按照时间降序排列。
+    #只在answer_topics上查询，属于多个关注话题的回答按answer_id分组只出现一次，
+    #分页之后再取出这一页的回答
     @property
     def answers_interested_topics(self):
-        return db.session.query(Answer).join(Question).filter(
-            Question.topics.any(Topic.followers.any(User.id ==
-                    self.id))).order_by(Answer.timestamp.desc())
+        followed = db.select([topics_users.c.topic_id]).where(topics_users.c.user_id == self.id)
+        return db.session.query(answer_topics.c.answer_id, answer_topics.c.timestamp).\
+            filter(answer_topics.c.topic_id.in_(followed)).\
+            group_by(answer_topics.c.answer_id, answer_topics.c.timestamp).\
+            order_by(answer_topics.c.timestamp.desc(), answer_topics.c.answer_id.desc())
 
-    #找出关注的所有人的回答并按时间降序排列
+    #找出关注的所有人的回答，从推送表格读取，配合KeysetPagination按时间降序分页
     @property
     def answers_followings(self):
-        return Answer.query.join(Follow, Follow.followed_id == Answer.user_id).\
-            filter(Follow.follower_id == self.id).order_by(Answer.timestamp.desc())
+        return Answer.query.join(Feed, Feed.answer_id == Answer.id).\
+            filter(Feed.user_id == self.id)
 
     #找出关注的所有人的赞同并按时间降序排列
     @property
@@ -265,49 +492,35 @@ class User(UserMixin, db.Model):
 
     #为注册用户生产令牌
     def generate_confirm_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'confirm':self.id})
+        return tokens.dumps('confirm', {'confirm':self.id}, expiration)
 
     #验证注册用户的令牌
     def confirm(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        if data.get('confirm') != self.id:
+        data = tokens.loads('confirm', token)
+        if data is None or data.get('confirm') != self.id:
             return False
         self.confirmed = True
         db.session.add(self)
         return True
 
     def generate_reset_password_token(self, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'reset':self.id})
+        return tokens.dumps('reset', {'reset':self.id}, expiration)
 
     def confirm_reset_password(self, token, new_password):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        if data.get('reset') != self.id:
+        data = tokens.loads('reset', token)
+        if data is None or data.get('reset') != self.id:
             return False
         self.password = new_password
         db.session.add(self)
         return True
 
     def generate_change_email(self, email, expiration=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expiration)
-        return s.dumps({'change-email':self.id, 'email':email})
+        return tokens.dumps('change-email', {'change-email':self.id, 'email':email},
+                            expiration)
 
     def confirm_change_email(self, token):
-        s = Serializer(current_app.config['SECRET_KEY'])
-        try:
-            data = s.loads(token)
-        except:
-            return False
-        if data.get('change-email') != self.id:
+        data = tokens.loads('change-email', token)
+        if data is None or data.get('change-email') != self.id:
             return False
         new_email = data.get('email')
         if new_email is None:
@@ -321,7 +534,7 @@ class User(UserMixin, db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return User.load(int(user_id))
 
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
@@ -333,6 +546,9 @@ class AnonymousUser(AnonymousUserMixin):
     def have_liked(self, answer):
         return False
 
+    def following_ids_among(self, ids):
+        return set()
+
 login_manager.anonymous_user = AnonymousUser
 
 
@@ -364,6 +580,38 @@ class Role(db.Model):
             role.default = roles[r][1]
             db.session.add(role)
         db.session.commit()
+        Role.refresh_table()
+
+    #角色和权限很少变化，每个app只加载一次，之后can()不再查询
+    @staticmethod
+    def table():
+        table = current_app.extensions.get('zhihu_roles')
+        if table is None:
+            table = Role.refresh_table()
+        return table
+
+    @staticmethod
+    def refresh_table():
+        rows = db.session.query(Role.id, Role.permissions, Role.default).all()
+        table = RoleTable(
+            permissions=dict((role_id, permissions or 0) for role_id, permissions, _ in rows),
+            default_id=next((role_id for role_id, _, default in rows if default), None),
+            administrator_id=next((role_id for role_id, permissions, _ in rows
+                                   if permissions == 0xff), None))
+        current_app.extensions['zhihu_roles'] = table
+        return table
+
+    @staticmethod
+    def forget_table():
+        current_app.extensions.pop('zhihu_roles', None)
+
+    #角色被修改后，提交时丢弃快照，下次使用时重新加载
+    @staticmethod
+    def on_after_flush(session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(obj, Role):
+                hooks.call_after_commit(session, Role.forget_table)
+                return
 
     def __repr__(self):
         return '<Role:{}>'.format(self.name)
@@ -378,7 +626,15 @@ topics_questions = db.Table('topics_questions',
                     db.Column('topic_id', db.Integer, db.ForeignKey('topics.id')),
                     db.Column('question_id', db.Integer, db.ForeignKey('questions.id')))
 
+#回答/话题表格，由问题的话题冗余而来，按话题查找回答时只需一次索引连接
+answer_topics = db.Table('answer_topics',
+                db.Column('answer_id', db.Integer, db.ForeignKey('answers.id'), primary_key=True),
+                db.Column('topic_id', db.Integer, db.ForeignKey('topics.id'), primary_key=True),
+                db.Column('timestamp', db.DateTime()),
+                db.Index('ix_answer_topics_topic_timestamp', 'topic_id', 'timestamp', 'answer_id'))
+
 
+@search_indexer.register_model('name', 'description', popularity='followers_count')
 class Topic(db.Model):
     """话题模型。一个话题有多个关注的用户，多个问题"""
     __tablename__ = 'topics'
@@ -386,6 +642,7 @@ class Topic(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True)
     description = db.Column(db.Text())
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     #话题关注者
     followers = db.relationship('User',
@@ -399,12 +656,37 @@ class Topic(db.Model):
                             backref=db.backref('topics', lazy='dynamic'),
                             lazy='dynamic')
 
+    #修改话题后需要失效的缓存标签
+    def cache_tags(self):
+        return ['topics', 'topic:%d' % self.id]
+
+    #关注或取关话题后，在flush后更新followers_count；
+    #话题页面上的关注状态和关注人数随之失效
+    @staticmethod
+    def on_followers_changed(delta):
+        def listener(topic, user, initiator):
+            counters.pending_count(db.session(), Topic, topic, 'followers_count', delta)
+            if topic.id is not None:
+                cache.invalidate_on_commit(db.session(), 'topic:%d' % topic.id)
+        return listener
+
+    #一批用户在该话题下的回答数量 {user_id: count}
+    def answer_counts_of(self, user_ids):
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        return dict(db.session.query(Answer.user_id, db.func.count()).
+                    join(answer_topics, answer_topics.c.answer_id == Answer.id).
+                    filter(answer_topics.c.topic_id == self.id,
+                           Answer.user_id.in_(user_ids)).
+                    group_by(Answer.user_id))
+
     #找出一个话题下所有的回答并按时间降序排列
     @property
     def all_answers(self):
-        return db.session.query(Answer).join(Question).filter(
-            Question.topics.any(Topic.id == self.id)).order_by(
-            Answer.timestamp.desc())
+        return Answer.query.join(answer_topics, answer_topics.c.answer_id == Answer.id).\
+            filter(answer_topics.c.topic_id == self.id).order_by(
+            answer_topics.c.timestamp.desc(), answer_topics.c.answer_id.desc())
 
     #生成大量虚拟话题
     @staticmethod
@@ -423,7 +705,7 @@ class Topic(db.Model):
             except IntegrityError:
                 db.session.rollback()
 
-@whooshee.register_model('body')
+@search_indexer.register_model('body', popularity='likes_count', recency='timestamp')
 class Answer(db.Model):
     """回答模型。一个回答从属于一个问题，一个作者。
     一个回答可能有多个赞同和评论。
@@ -437,7 +719,7 @@ class Answer(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     comments = db.relationship('Comment', backref='answer', lazy='dynamic')
     likes = db.relationship('Like', backref='answer', lazy='dynamic')
-    likes_count = db.Column(db.Integer)
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     body_html = db.Column(db.Text)
 
     #生成大量虚拟回答
@@ -460,17 +742,195 @@ class Answer(db.Model):
             except IntegrityError:
                 db.session.rollback()
 
-    #定义回答允许使用的标签
+    #回答、赞同或评论变化后需要失效的缓存标签
+    def cache_tags(self):
+        return ['answer:%d' % self.id]
+
+    #回答片段依赖的标签：片段中还显示作者的名字、简介和头像，作者修改资料后
+    #（User.cache_tags）同样失效。作者的标签不放进cache_tags()，否则发表回答
+    #就会使作者所有回答的片段和用户快照失效
+    def fragment_tags(self):
+        if self.user_id is None:
+            return self.cache_tags()
+        return self.cache_tags() + ['user:%d' % self.user_id]
+
+    def counters(self):
+        return [(User, self.user_id, 'answers_count'),
+                (Question, self.question_id, 'answers_count')]
+
+    #赞同回答。已经赞同过返回False；赞同和likes_count的递增在同一事务中完成。
+    #并发时唯一索引保证不会重复赞同，冲突的一方在提交时得到IntegrityError
+    def like(self, user):
+        likes = Like.__table__
+        result = db.session.execute(likes.insert().from_select(
+            ['answer_id', 'user_id', 'timestamp', 'unread'],
+            db.select([db.literal(self.id), db.literal(user.id),
+                       db.literal(datetime.utcnow()), db.literal(True)]).
+                where(~db.exists().where(db.and_(likes.c.answer_id == self.id,
+                                                 likes.c.user_id == user.id)))))
+        if not result.rowcount:
+            return False
+        self.change_likes_count(1)
+        return True
+
+    #取消赞同。没有赞同过返回False
+    def unlike(self, user):
+        likes = Like.__table__
+        result = db.session.execute(likes.delete().where(db.and_(
+            likes.c.answer_id == self.id, likes.c.user_id == user.id)))
+        if not result.rowcount:
+            return False
+        self.change_likes_count(-1)
+        return True
+
+    #在SQL中原子地增减likes_count；开启写回缓冲时改为提交后计入缓冲。
+    #热度排行在提交后增量更新，最高赞的排序可能变化时使首页失效
+    def change_likes_count(self, delta):
+        hooks.call_after_commit(db.session(), hot_ranking.change_likes,
+                                self.id, delta, self.timestamp)
+        likes = self.likes_count + like_counter.pending(self.id) + delta
+        if top_answers.ranks(self.id, likes):
+            cache.invalidate_on_commit(db.session(), 'top-answers')
+        hooks.call_after_commit(db.session(), top_answers.invalidate)
+        cache.invalidate_on_commit(db.session(), *self.cache_tags())
+        search_indexer.refresh_on_commit(db.session(), Answer, self.id)
+        if like_counter.enabled:
+            like_counter.add_on_commit(db.session(), self.id, delta)
+            return
+        answers = Answer.__table__
+        db.session.execute(answers.update().where(answers.c.id == self.id).
+                           values(likes_count=answers.c.likes_count + delta))
+        db.session.expire(self, ['likes_count'])
+
+    #正文变化时重新渲染body_html；开启延迟渲染时交给后台线程
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i',  'li', 'ol', 'ul', 'pre', 'strong', 'h1',
-                        'h2', 'h3', 'h4', 'p', 'br']
-        target.body_html = bleach.linkify(bleach.clean(markdown(
-            value, output_format = 'html'), tags=allowed_tags, strip=True))
+        if body_renderer.deferred:
+            body_renderer.defer(target)
+        else:
+            target.body_html = body_renderer.render(value)
+
+    #问题的话题变化时记录下来，flush之后再同步answer_topics
+    @staticmethod
+    def on_question_topics_changed(added):
+        def listener(topic, question, initiator):
+            session = db.object_session(question)
+            if session is not None and db.inspect(question).has_identity:
+                session.info.setdefault('question_topics', []).append(
+                    (question, topic, added))
+        return listener
+
+    #要删除的回答在flush之前移出answer_topics，否则DELETE answers会违反外键约束；
+    #同时使这些回答所在话题的回答列表失效
+    @staticmethod
+    def on_before_flush(session, flush_context, instances):
+        deleted_answer_ids = [obj.id for obj in session.deleted if isinstance(obj, Answer)]
+        if not deleted_answer_ids:
+            return
+        topic_ids = [row[0] for row in session.execute(
+            db.select([answer_topics.c.topic_id]).distinct().
+                where(answer_topics.c.answer_id.in_(deleted_answer_ids)))]
+        if topic_ids:
+            cache.invalidate_on_commit(session, *['topic:%d' % id for id in topic_ids])
+        session.execute(answer_topics.delete().where(
+            answer_topics.c.answer_id.in_(deleted_answer_ids)))
+
+    #每次flush后根据新增的回答和问题的话题变化维护answer_topics，
+    #并使首页和受影响话题的回答列表失效
+    @staticmethod
+    def on_after_flush(session, flush_context):
+        new_answer_ids = [obj.id for obj in session.new if isinstance(obj, Answer)]
+        deleted_answer_ids = [obj.id for obj in session.deleted if isinstance(obj, Answer)]
+        topic_ids = set()
+        authors = set(obj.user_id for obj in list(session.new) + list(session.deleted)
+                      if isinstance(obj, Answer) and obj.user_id is not None)
+        for question, topic, added in session.info.pop('question_topics', []):
+            topic_ids.add(topic.id)
+            answers = Answer.__table__
+            authors.update(row[0] for row in session.execute(
+                db.select([answers.c.user_id]).distinct().
+                    where(answers.c.question_id == question.id).
+                    where(answers.c.user_id.isnot(None))))
+            if added:
+                select = db.select([answers.c.id, db.literal(topic.id), answers.c.timestamp]).\
+                    where(answers.c.question_id == question.id)
+                if new_answer_ids:
+                    select = select.where(~answers.c.id.in_(new_answer_ids))
+                session.execute(answer_topics.insert().from_select(
+                    ['answer_id', 'topic_id', 'timestamp'], select))
+            else:
+                session.execute(answer_topics.delete().where(db.and_(
+                    answer_topics.c.topic_id == topic.id,
+                    answer_topics.c.answer_id.in_(db.select([answers.c.id]).where(
+                        answers.c.question_id == question.id)))))
+        if authors:
+            cache.invalidate_on_commit(session, *['user-answers:%d' % id for id in authors])
+        if new_answer_ids:
+            hooks.call_after_commit(session, top_answers.invalidate)
+            session.execute(answer_topics.insert().from_select(
+                ['answer_id', 'topic_id', 'timestamp'],
+                db.select([Answer.id, topics_questions.c.topic_id, Answer.timestamp]).
+                    where(topics_questions.c.question_id == Answer.question_id).
+                    where(Answer.id.in_(new_answer_ids))))
+            topic_ids.update(row[0] for row in session.execute(
+                db.select([answer_topics.c.topic_id]).distinct().
+                    where(answer_topics.c.answer_id.in_(new_answer_ids))))
+        if new_answer_ids or deleted_answer_ids:
+            cache.invalidate_on_commit(session, 'answers')
+        if topic_ids:
+            cache.invalidate_on_commit(session, *['topic:%d' % id for id in topic_ids])
+        if deleted_answer_ids:
+            hooks.call_after_commit(session, hot_ranking.discard, deleted_answer_ids)
+            hooks.call_after_commit(session, top_answers.invalidate)
+
+    #根据topics_questions重建answer_topics
+    @staticmethod
+    def rebuild_topic_index():
+        db.session.execute(answer_topics.delete())
+        db.session.execute(answer_topics.insert().from_select(
+            ['answer_id', 'topic_id', 'timestamp'],
+            db.select([Answer.id, topics_questions.c.topic_id, Answer.timestamp]).
+                where(topics_questions.c.question_id == Answer.question_id)))
+        db.session.commit()
+
+#首页"最高赞"的排序索引
+db.Index('ix_answers_likes_count_timestamp', Answer.likes_count.desc(),
+         Answer.timestamp.desc(), Answer.id.desc())
 
 #监听回答，一旦有新回答就调用on_changed_body函数
 db.event.listen(Answer.body, 'set', Answer.on_changed_body)
+db.event.listen(db.session, 'after_flush', body_renderer.on_after_flush)
+
+#监听会话，新回答/关注变化随同一事务写入推送表格
+db.event.listen(db.session, 'before_flush', Feed.on_before_flush)
+db.event.listen(db.session, 'after_flush', Feed.on_after_flush)
+
+#计数缓冲、热度排行等进程内状态在事务提交后才更新，回滚时丢弃
+db.event.listen(db.session, 'after_commit', hooks.on_after_commit)
+db.event.listen(db.session, 'after_rollback', hooks.on_after_rollback)
+
+#监听问题的话题和新回答，维护answer_topics
+db.event.listen(Topic.questions, 'append', Answer.on_question_topics_changed(True))
+db.event.listen(Topic.questions, 'remove', Answer.on_question_topics_changed(False))
+db.event.listen(db.session, 'before_flush', Answer.on_before_flush)
+db.event.listen(db.session, 'after_flush', Answer.on_after_flush)
+
+#监听会话，回答、赞同、评论、话题变化后使相关的页面和片段缓存失效
+db.event.listen(db.session, 'after_flush', cache.on_after_flush)
+db.event.listen(Topic.followers, 'append', Topic.on_followers_changed(1))
+db.event.listen(Topic.followers, 'remove', Topic.on_followers_changed(-1))
+
+#监听会话和关注关系，在同一事务中维护各计数列
+db.event.listen(Question.followers, 'append', Question.on_followers_changed(1))
+db.event.listen(Question.followers, 'remove', Question.on_followers_changed(-1))
+db.event.listen(db.session, 'after_flush', counters.on_after_flush)
+db.event.listen(db.session, 'after_flush_postexec', counters.on_after_flush_postexec)
+
+#监听会话，角色变化后重新加载角色表快照
+db.event.listen(db.session, 'after_flush', Role.on_after_flush)
+
+#监听会话，被索引的字段变化后在提交时放入全文索引的更新队列
+db.event.listen(db.session, 'after_flush', search_indexer.on_after_flush)
 
 class Comment(db.Model):
     """评论模型类"""
@@ -482,6 +942,11 @@ class Comment(db.Model):
     answer_id = db.Column(db.Integer, db.ForeignKey('answers.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
+    def cache_tags(self):
+        if self.answer_id is None:
+            return []
+        return ['answer:%d' % self.answer_id]
+
     #生成虚拟评论
     @staticmethod
     def generate_fake(count=4000):
@@ -506,6 +971,7 @@ class Comment(db.Model):
 class Like(db.Model):
     """赞同模型类，一个赞同从属于一个回答/一个作者"""
     __tablename__ = 'likes'
+    __table_args__ = (db.Index('ix_likes_answer_user', 'answer_id', 'user_id', unique=True),)
 
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime(), default=datetime.utcnow)
@@ -513,6 +979,11 @@ class Like(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     unread = db.Column(db.Boolean, default=True)
 
+    def cache_tags(self):
+        if self.answer_id is None:
+            return []
+        return ['answer:%d' % self.answer_id]
+
     @staticmethod
     def generate_fake(count=10000):
 
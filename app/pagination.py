@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(_DATETIME_FORMAT)
+    return value
+
+
+def _decode_value(column, value):
+    if value is not None and column.type.python_type is datetime:
+        return datetime.strptime(value, _DATETIME_FORMAT)
+    return value
+
+
+def encode_cursor(direction, values):
+    """把翻页方向和排序键的值编码成URL安全的字符串"""
+    data = json.dumps([direction, [_encode_value(v) for v in values]])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """解析游标，格式不正确时返回(None, None)"""
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        direction, values = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            raise ValueError(cursor)
+        return direction, [_decode_value(column, value)
+                           for (column, _), value in zip(columns, values)]
+    except (TypeError, ValueError):
+        return None, None
+
+
+def _seek(columns, values):
+    """构造 (c1, c2, ...) 在给定排序方向上严格位于 (v1, v2, ...) 之后的条件"""
+    column, descending = columns[0]
+    value = values[0]
+    after = column < value if descending else column > value
+    if len(columns) == 1:
+        return after
+    return or_(after, and_(column == value, _seek(columns[1:], values[1:])))
+
+
+class KeysetPagination(object):
+    """游标分页。
+
+    按 columns 给出的排序列定位到上一页的最后一行（或下一页的第一行）之后继续读取，
+    不使用OFFSET，深翻页的代价与第一页相同。columns 是 (列, 是否降序) 的列表，
+    最后一列必须唯一（通常是主键）。key 从结果行中取出与 columns 对应的值，
+    默认按列名取属性。cache 的 page(direction, values, per_page) 能直接给出
+    这一页时（见 ranking.TopAnswers）不再查询。
+    """
+
+    def __init__(self, query, columns, cursor=None, per_page=10, key=None, cache=None):
+        self.columns = columns
+        self.per_page = per_page
+        self.key = key or (lambda item: [getattr(item, c.key) for c, _ in columns])
+        query = query.order_by(None)
+        self._query = query
+        self._total = None
+
+        direction, values = decode_cursor(cursor, columns) if cursor else (None, None)
+        cached = cache.page(direction, values, per_page) if cache is not None else None
+        if cached is not None:
+            self.items, self._keys, self.has_prev, self.has_next = cached
+            return
+        backwards = direction == 'prev'
+        order = columns
+        if backwards:
+            order = [(c, not descending) for c, descending in columns]
+        if values is not None:
+            query = query.filter(_seek(order, values))
+        query = query.order_by(*[c.desc() if descending else c.asc()
+                                 for c, descending in order])
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev, self.has_next = more, True
+        else:
+            self.has_prev, self.has_next = values is not None, more
+        self.items = items
+        self._keys = None
+
+    def _key_at(self, index):
+        if self._keys is not None:
+            return self._keys[index]
+        return self.key(self.items[index])
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor('next', self._key_at(-1))
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor('prev', self._key_at(0))
+
+    #总数需要一次额外的COUNT查询，只在确实用到时才执行
+    @property
+    def total(self):
+        if self._total is None:
+            self._total = self._query.count()
+        return self._total
+
+
+class OffsetPagination(object):
+    """内存中排好序的结果（如热度排行）的分页，游标即偏移量，
+    与KeysetPagination提供相同的属性，可以直接用于cursor_widget"""
+
+    def __init__(self, items, offset, per_page, has_next):
+        self.items = items
+        self.offset = offset
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = offset > 0
+
+    @staticmethod
+    def offset_of(cursor):
+        try:
+            return max(int(cursor), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def next_cursor(self):
+        return str(self.offset + self.per_page) if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        return str(max(self.offset - self.per_page, 0)) if self.has_prev else None
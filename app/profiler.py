@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import bisect
+import random
+import re
+import threading
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#每个请求的查询数和数据库耗时（毫秒）直方图的分界
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+TIME_BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(statement):
+    """去掉字面量、把IN (?, ?, ...)合并成一个占位符后的语句，相同形状的查询指纹相同"""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def _histogram(buckets):
+    return [0] * (len(buckets) + 1)
+
+
+class QueryProfiler(object):
+    """SQL查询的采样统计。
+
+    按 ZHIHU_QUERY_SAMPLE_RATE 的比例抽取请求，记录其中每条语句的指纹和耗时，
+    汇总成每个端点的查询数/耗时直方图和每个指纹的次数、总耗时、最长耗时。
+    同一请求中同一指纹执行超过 ZHIHU_QUERY_N_PLUS_ONE 次记为一次N+1；
+    有N+1或超过 ZHIHU_SLOW_DB_QUERY_TIME 秒的语句时，为这个请求记一行日志。
+    最多保留 ZHIHU_QUERY_MAX_FINGERPRINTS 个指纹，统计由 /admin/query-stats 查看。
+    """
+
+    _listening = False
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_QUERY_SAMPLE_RATE', 1.0)
+        app.config.setdefault('ZHIHU_QUERY_N_PLUS_ONE', 10)
+        app.config.setdefault('ZHIHU_QUERY_MAX_FINGERPRINTS', 500)
+        app.config.setdefault('ZHIHU_SLOW_DB_QUERY_TIME', 0.5)
+        self.app = app
+        self.reset()
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+        #监听所有引擎，只注册一次；不在被抽中的请求中执行的语句直接跳过
+        if not QueryProfiler._listening:
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+            QueryProfiler._listening = True
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+            self._statements = {}
+            self._fingerprints = {}
+
+    def _start(self):
+        if random.random() < self.app.config['ZHIHU_QUERY_SAMPLE_RATE']:
+            g._query_profile = []
+
+    @staticmethod
+    def _profile():
+        return getattr(g, '_query_profile', None) if has_request_context() else None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._profile() is not None:
+            context._query_start = time.time()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = self._profile()
+        start = getattr(context, '_query_start', None)
+        if profile is not None and start is not None:
+            profile.append((statement, time.time() - start))
+
+    #语句到指纹的缓存，同样的语句只做一次正则替换
+    def _fingerprint(self, statement):
+        fp = self._fingerprints.get(statement)
+        if fp is None:
+            fp = fingerprint(statement)
+            if len(self._fingerprints) < self.app.config['ZHIHU_QUERY_MAX_FINGERPRINTS'] * 4:
+                self._fingerprints[statement] = fp
+        return fp
+
+    def _finish(self, exc=None):
+        profile = getattr(g, '_query_profile', None)
+        if profile is None:
+            return
+        g._query_profile = None
+        endpoint = request.endpoint or '<unknown>'
+        slow_time = self.app.config['ZHIHU_SLOW_DB_QUERY_TIME']
+        counts, slow = {}, []
+        total = 0.0
+        with self._lock:
+            for statement, duration in profile:
+                fp = self._fingerprint(statement)
+                counts[fp] = counts.get(fp, 0) + 1
+                total += duration
+                if duration >= slow_time:
+                    slow.append((fp, duration))
+                self._record_statement(fp, endpoint, duration, duration >= slow_time)
+            repeated = dict((fp, n) for fp, n in counts.items()
+                            if n > self.app.config['ZHIHU_QUERY_N_PLUS_ONE'])
+            self._record_endpoint(endpoint, len(profile), total, repeated)
+        if slow or repeated:
+            self.app.logger.warning(
+                'Query profile %s %s: %d queries in %.1fms, slow: %r, repeated: %r',
+                endpoint, request.path, len(profile), total * 1000,
+                [(fp, round(duration * 1000, 1)) for fp, duration in slow],
+                repeated)
+
+    def _record_statement(self, fp, endpoint, duration, slow):
+        stats = self._statements.get(fp)
+        if stats is None:
+            if len(self._statements) >= self.app.config['ZHIHU_QUERY_MAX_FINGERPRINTS']:
+                fp = '<other>'
+                stats = self._statements.get(fp)
+            if stats is None:
+                stats = self._statements[fp] = dict(count=0, time=0.0, max=0.0,
+                                                    slow=0, endpoints={})
+        stats['count'] += 1
+        stats['time'] += duration
+        stats['max'] = max(stats['max'], duration)
+        stats['slow'] += int(slow)
+        stats['endpoints'][endpoint] = stats['endpoints'].get(endpoint, 0) + 1
+
+    def _record_endpoint(self, endpoint, count, total, repeated):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = dict(
+                requests=0, queries=0, time=0.0, max_queries=0,
+                query_histogram=_histogram(COUNT_BUCKETS),
+                time_histogram=_histogram(TIME_BUCKETS), n_plus_one={})
+        stats['requests'] += 1
+        stats['queries'] += count
+        stats['time'] += total
+        stats['max_queries'] = max(stats['max_queries'], count)
+        stats['query_histogram'][bisect.bisect_left(COUNT_BUCKETS, count)] += 1
+        stats['time_histogram'][bisect.bisect_left(TIME_BUCKETS, total * 1000)] += 1
+        for fp, n in repeated.items():
+            stats['n_plus_one'][fp] = max(stats['n_plus_one'].get(fp, 0), n)
+
+    def stats(self):
+        """汇总结果；直方图第i格是不超过 buckets[i] 的请求数，最后一格是更大的"""
+        with self._lock:
+            endpoints = dict((endpoint, dict(stats, n_plus_one=dict(stats['n_plus_one']),
+                                             query_histogram=list(stats['query_histogram']),
+                                             time_histogram=list(stats['time_histogram'])))
+                             for endpoint, stats in self._endpoints.items())
+            statements = sorted(
+                (dict(stats, fingerprint=fp, endpoints=dict(stats['endpoints']))
+                 for fp, stats in self._statements.items()),
+                key=lambda stats: stats['time'], reverse=True)
+        return dict(sample_rate=self.app.config['ZHIHU_QUERY_SAMPLE_RATE'],
+                    count_buckets=COUNT_BUCKETS, time_buckets_ms=TIME_BUCKETS,
+                    endpoints=endpoints, statements=statements)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import bisect
+import calendar
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+#热度的时间起点，只影响分数的绝对值，不影响排序
+EPOCH = calendar.timegm(datetime(2017, 1, 1).utctimetuple())
+DAY = 24 * 60 * 60
+
+
+def _seconds(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class HotRanking(object):
+    """回答热度排行，常驻内存，赞同增删时增量更新。
+
+    热度 score = log10(赞同数) + (发布时间 - EPOCH) / gravity，即发布时间每晚
+    gravity 秒，需要多十倍的赞同才能排在同样的位置。分数与当前时间无关，
+    所以排序只需在赞同变化时局部调整。回答按发布日期分桶，每个桶按热度降序保存；
+    查询任意时间窗口时只归并窗口内的几个桶，不扫描answers/likes表。
+
+    只保留最近 ZHIHU_HOT_MAX_DAYS 天内有赞同的回答。首次使用后启动一个后台线程，
+    每隔 ZHIHU_HOT_PERSIST_INTERVAL 秒写入 ZHIHU_HOT_SNAPSHOT 快照（启动时从快照恢复），
+    每隔 ZHIHU_HOT_REFRESH_INTERVAL 秒按likes_count重建一次，以合并其他进程的赞同；
+    请求线程只做增量更新。重建期间的增量会被重建的结果覆盖，由下一次重建补上。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.RLock()
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self._answers = {}
+        self._buckets = {}
+        self._loaded = False
+        self._last_persist = self._last_refresh = time.time()
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_HOT_GRAVITY', 45000)
+        app.config.setdefault('ZHIHU_HOT_MAX_DAYS', 31)
+        app.config.setdefault('ZHIHU_HOT_SNAPSHOT', None)
+        app.config.setdefault('ZHIHU_HOT_PERSIST_INTERVAL', 60)
+        app.config.setdefault('ZHIHU_HOT_REFRESH_INTERVAL', 600)
+        self.app = app
+        with self._lock:
+            self._reset()
+
+    def score(self, created, likes):
+        return math.log10(max(likes, 1)) + \
+            (created - EPOCH) / float(self.app.config['ZHIHU_HOT_GRAVITY'])
+
+    def _insert(self, answer_id, created, likes):
+        self._discard(answer_id)
+        if likes <= 0 or created < time.time() - self.app.config['ZHIHU_HOT_MAX_DAYS'] * DAY:
+            return
+        entry = (-self.score(created, likes), answer_id)
+        self._answers[answer_id] = (created, likes, entry)
+        bisect.insort(self._buckets.setdefault(int(created // DAY), []), entry)
+
+    def _discard(self, answer_id):
+        old = self._answers.pop(answer_id, None)
+        if old is None:
+            return
+        day = int(old[0] // DAY)
+        bucket = self._buckets[day]
+        del bucket[bisect.bisect_left(bucket, old[2])]
+        if not bucket:
+            del self._buckets[day]
+
+    def change_likes(self, answer_id, delta, created):
+        """回答的赞同数变化了delta，created为回答的发布时间"""
+        with self._lock:
+            #刚从数据库重建的排行已经包含了这次已提交的变化
+            if self._ensure_loaded() and not self._write_behind():
+                return
+            old = self._answers.get(answer_id)
+            likes = (old[1] if old else 0) + delta
+            self._insert(answer_id, _seconds(created), likes)
+            self._maintain()
+
+    def discard(self, answer_ids):
+        """回答被删除后移出排行"""
+        with self._lock:
+            for answer_id in answer_ids:
+                self._discard(answer_id)
+
+    def top(self, window, offset=0, limit=20):
+        """最近window（timedelta）内发布的回答按热度降序的id列表"""
+        with self._lock:
+            self._ensure_loaded()
+            self._maintain()
+            since = time.time() - window.total_seconds()
+            days = [day for day in self._buckets if day >= int(since // DAY)]
+            merged = heapq.merge(*[self._buckets[day] for day in days])
+            ids = (answer_id for _, answer_id in merged
+                   if self._answers[answer_id][0] >= since)
+            return list(islice(ids, offset, offset + limit))
+
+    def likes(self, answer_id):
+        entry = self._answers.get(answer_id)
+        return entry[1] if entry else 0
+
+    def _write_behind(self):
+        return self.app.config.get('ZHIHU_LIKE_WRITE_BEHIND', False)
+
+    #首次使用时加载排行，从数据库重建时返回True
+    def _ensure_loaded(self):
+        if self._loaded:
+            return False
+        path = self.app.config['ZHIHU_HOT_SNAPSHOT']
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for answer_id, (created, likes) in json.load(f).items():
+                    self._insert(int(answer_id), created, likes)
+            self._loaded = True
+            return False
+        self.rebuild()
+        return True
+
+    def rebuild(self):
+        """按likes_count从数据库重建，只读取时间窗口内有赞同的回答"""
+        from . import db
+        from .models import Answer
+        answers = Answer.__table__
+        since = datetime.utcnow() - timedelta(days=self.app.config['ZHIHU_HOT_MAX_DAYS'])
+        rows = db.engine.execute(
+            db.select([answers.c.id, answers.c.timestamp, answers.c.likes_count]).
+                where(answers.c.timestamp > since).where(answers.c.likes_count > 0)).fetchall()
+        with self._lock:
+            self._answers = {}
+            self._buckets = {}
+            for answer_id, created, likes in rows:
+                self._insert(answer_id, _seconds(created), likes)
+            self._loaded = True
+            self._last_refresh = time.time()
+
+    def persist(self):
+        path = self.app.config['ZHIHU_HOT_SNAPSHOT']
+        if not path:
+            return
+        with self._lock:
+            data = dict((str(answer_id), [created, likes])
+                        for answer_id, (created, likes, _) in self._answers.items())
+            self._last_persist = time.time()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+    #丢弃超出保留天数的桶
+    def _prune(self):
+        oldest = int((time.time() - self.app.config['ZHIHU_HOT_MAX_DAYS'] * DAY) // DAY)
+        for day in [day for day in self._buckets if day < oldest]:
+            for _, answer_id in self._buckets.pop(day):
+                self._answers.pop(answer_id, None)
+
+    def _maintain(self):
+        self._prune()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    #重建要读取整个时间窗口内的回答，放在后台线程中，不占用请求线程和排行的锁
+    def _run(self):
+        while True:
+            time.sleep(max(min(self.app.config['ZHIHU_HOT_REFRESH_INTERVAL'],
+                               self.app.config['ZHIHU_HOT_PERSIST_INTERVAL']), 1))
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                self.app.logger.exception('Failed to refresh the hot ranking')
+
+    def refresh(self):
+        """到期时从数据库重建排行、写入快照"""
+        now = time.time()
+        if now - self._last_refresh >= self.app.config['ZHIHU_HOT_REFRESH_INTERVAL']:
+            self.rebuild()
+        if now - self._last_persist >= self.app.config['ZHIHU_HOT_PERSIST_INTERVAL']:
+            self.persist()
+
+
+class TopAnswers(object):
+    """首页"最高赞"前几页的缓存。
+
+    缓存按 (likes_count, timestamp, id) 降序排在最前面的
+    ZHIHU_TOP_CACHE_PAGES * per_page 条回答的排序键，落在这一范围内的翻页
+    只按主键取回答，不再排序。赞同数变化、回答增删后在提交时失效，
+    ZHIHU_TOP_CACHE_TIMEOUT 秒后也会过期，以合并写回缓冲和其他进程的变化。
+    作为KeysetPagination的cache参数使用。失效后仍记下最近一次加载的范围，
+    ranks() 据此判断一次赞同是否会改变这一范围内的排序。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._rows = None
+        self._complete = False
+        self._loaded_at = 0
+        self._version = 0
+        self._ranked = None
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_TOP_CACHE_PAGES', 5)
+        app.config.setdefault('ZHIHU_TOP_CACHE_TIMEOUT', 60)
+        self.app = app
+        self.invalidate()
+        with self._lock:
+            self._ranked = None
+
+    def invalidate(self, *args):
+        with self._lock:
+            self._rows = None
+            self._version += 1
+
+    def _load(self, limit):
+        from . import db
+        from .models import Answer
+        with self._lock:
+            rows = self._rows
+            if rows is not None and (self._complete or len(rows) >= limit) and \
+                    time.time() - self._loaded_at < self.app.config['ZHIHU_TOP_CACHE_TIMEOUT']:
+                return rows, self._complete
+            version = self._version
+        rows = [tuple(row) for row in db.session.query(
+            Answer.likes_count, Answer.timestamp, Answer.id).
+            order_by(Answer.likes_count.desc(), Answer.timestamp.desc(),
+                     Answer.id.desc()).limit(limit)]
+        complete = len(rows) < limit
+        with self._lock:
+            #加载期间缓存已经失效的话，这次的结果可能是旧的，不保存
+            if version == self._version:
+                self._rows, self._complete = rows, complete
+                self._loaded_at = time.time()
+                self._ranked = (frozenset(row[2] for row in rows),
+                                rows[-1][0] if rows else 0, complete)
+        return rows, complete
+
+    def ranks(self, answer_id, likes):
+        """赞同数变为likes的回答是否在最近一次加载的范围内，或者会排进这一范围；
+        还没有加载过时返回True"""
+        with self._lock:
+            ranked = self._ranked
+        if ranked is None:
+            return True
+        ids, lowest, complete = ranked
+        return complete or answer_id in ids or likes >= lowest
+
+    def page(self, direction, values, per_page):
+        """从缓存中取出一页，返回 (回答列表, 排序键列表, has_prev, has_next)；
+        这一页不在缓存范围内时返回None"""
+        from .models import Answer
+        limit = self.app.config['ZHIHU_TOP_CACHE_PAGES'] * per_page + 1
+        rows, complete = self._load(limit)
+        if values is None:
+            start = 0
+        else:
+            try:
+                position = rows.index(tuple(values))
+            except ValueError:
+                return None
+            start = position + 1 if direction == 'next' else max(position - per_page, 0)
+        end = start + per_page if values is None or direction == 'next' else position
+        if end >= len(rows) and not complete:
+            return None
+        keys = rows[start:end]
+        answers = dict((answer.id, answer) for answer in
+                       Answer.query.filter(Answer.id.in_([key[2] for key in keys]))) \
+            if keys else {}
+        if len(answers) != len(keys):
+            return None
+        has_next = end < len(rows) if direction != 'prev' else True
+        return [answers[key[2]] for key in keys], [list(key) for key in keys], \
+            start > 0, has_next
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import hashlib
+import threading
+import bleach
+from markdown import markdown
+from flask import current_app, has_app_context
+from .cache import LRUCache
+from .hooks import call_after_commit
+
+#回答允许使用的标签
+ALLOWED_TAGS = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                'em', 'i', 'li', 'ol', 'ul', 'pre', 'strong', 'h1',
+                'h2', 'h3', 'h4', 'p', 'br']
+
+
+def render_body(body):
+    """把Markdown正文转换成清理过的HTML。模块级函数，可以交给进程池执行"""
+    if body is None:
+        return None
+    return bleach.linkify(bleach.clean(markdown(body, output_format='html'),
+                                       tags=ALLOWED_TAGS, strip=True))
+
+
+def body_hash(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+class BodyRenderer(object):
+    """回答正文的渲染。
+
+    渲染结果按正文的SHA1缓存在进程内（ZHIHU_RENDER_CACHE_SIZE 项），
+    相同的正文只渲染一次。ZHIHU_RENDER_DEFERRED 为True时，请求中只清空
+    body_html，提交后由后台线程渲染并写回；渲染完成前模板显示原始正文。
+    ZHIHU_RENDER_WORKER 为False时不启动后台线程，由 drain() 渲染队列中的回答。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._cache = LRUCache(1000, 0)
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._queue = []
+        self._event = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_RENDER_DEFERRED', False)
+        app.config.setdefault('ZHIHU_RENDER_WORKER', True)
+        app.config.setdefault('ZHIHU_RENDER_CACHE_SIZE', 1000)
+        self.app = app
+        self._cache = LRUCache(app.config['ZHIHU_RENDER_CACHE_SIZE'], 0)
+        with self._lock:
+            self._queue = []
+
+    @property
+    def deferred(self):
+        app = current_app if has_app_context() else self.app
+        return app is not None and app.config['ZHIHU_RENDER_DEFERRED']
+
+    def render(self, body):
+        """带缓存的render_body"""
+        if body is None:
+            return None
+        key = body_hash(body)
+        html = self._cache.get(key)
+        if html is None:
+            html = render_body(body)
+            self._cache.set(key, html)
+        return html
+
+    def remember(self, body, html):
+        """记下在别处（如进程池中）渲染的结果"""
+        self._cache.set(body_hash(body), html)
+
+    #延迟渲染时先清空body_html并做标记，flush之后取得id，提交后再加入后台队列
+    def defer(self, answer):
+        answer.body_html = None
+        answer._render_pending = True
+
+    def on_after_flush(self, session, flush_context):
+        answer_ids = []
+        for obj in list(session.new) + list(session.dirty):
+            if getattr(obj, '_render_pending', False):
+                obj._render_pending = False
+                answer_ids.append(obj.id)
+        if answer_ids:
+            call_after_commit(session, self.enqueue, *answer_ids)
+
+    def enqueue(self, *answer_ids):
+        with self._lock:
+            self._queue.extend(answer_ids)
+            if not self.app.config['ZHIHU_RENDER_WORKER']:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._event.set()
+
+    def drain(self):
+        """渲染队列中所有的回答并写回body_html，返回写回的行数。
+        后台线程正在写回时等它完成"""
+        with self._drain_lock:
+            with self._lock:
+                answer_ids, self._queue = self._queue, []
+            if not answer_ids:
+                return 0
+            if has_app_context():
+                return self._update(answer_ids)
+            with self.app.app_context():
+                return self._update(answer_ids)
+
+    #只在正文未被再次修改时写回，避免旧的渲染结果覆盖新的
+    def _update(self, answer_ids):
+        from . import db, cache
+        answers = db.metadata.tables['answers']
+        rows = db.engine.execute(db.select([answers.c.id, answers.c.body]).
+                                 where(answers.c.id.in_(set(answer_ids)))).fetchall()
+        updated = 0
+        for answer_id, body in rows:
+            result = db.engine.execute(
+                answers.update().where(answers.c.id == answer_id).
+                    where(answers.c.body == body).values(body_html=self.render(body)))
+            updated += result.rowcount
+            cache.invalidate('answer:%d' % answer_id)
+        return updated
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            try:
+                self.drain()
+            except Exception:
+                if self.app is not None:
+                    self.app.logger.exception('Failed to render answers')
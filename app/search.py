@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import calendar
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing import cpu_count
+from flask import has_app_context
+from sqlalchemy import inspect
+from whoosh import fields, qparser, scoring
+from whoosh.analysis import Tokenizer, Token, LowercaseFilter
+from whoosh.writing import AsyncWriter, CLEAR
+from flask_whooshee import AbstractWhoosheerMeta, Whooshee
+from .hooks import call_after_commit
+
+#中日韩字符：假名、CJK统一表意文字及扩展A、兼容表意文字、韩文音节
+_CJK = u'぀-ヿ㐀-䶿一-鿿豈-﫿가-힯'
+_TOKENS = re.compile(u'[%s]+|[^\\W%s]+' % (_CJK, _CJK), re.UNICODE)
+_CJK_RUN = re.compile(u'[%s]' % _CJK)
+#以英文字母或数字结尾的查询，补全时最后一个词按前缀匹配
+_PARTIAL_WORD = re.compile(u'[^\\W%s]$' % _CJK, re.UNICODE)
+
+#队列中表示“提交后从数据库重新读取这一行”的文档
+RELOAD = object()
+
+
+class CJKTokenizer(Tokenizer):
+    """英文和数字按单词切分；连续的中日韩字符切成单字和相邻两字的二元组，
+    搜索时只用二元组（单独一个字时用单字），不需要词典就能匹配任意位置的词"""
+
+    def __call__(self, value, positions=False, chars=False, keeporiginal=False,
+                 removestops=True, start_pos=0, start_char=0, tokenize=True,
+                 mode='', **kwargs):
+        t = Token(positions, chars, removestops=removestops, mode=mode, **kwargs)
+        pos = start_pos
+        for match in _TOKENS.finditer(value):
+            text = match.group()
+            if not _CJK_RUN.match(text):
+                grams = [(0, text)]
+            elif len(text) == 1:
+                grams = [(0, text)]
+            else:
+                grams = []
+                for i in range(len(text)):
+                    if mode != 'query':
+                        grams.append((i, text[i]))
+                    if i + 1 < len(text):
+                        grams.append((i, text[i:i + 2]))
+            for offset, gram in grams:
+                t.text = gram
+                t.boost = 1.0
+                t.stopped = False
+                if keeporiginal:
+                    t.original = gram
+                if positions:
+                    t.pos = pos + offset
+                if chars:
+                    t.startchar = start_char + match.start() + offset
+                    t.endchar = t.startchar + len(gram)
+                yield t
+            pos += len(text) if _CJK_RUN.match(text) else 1
+
+
+def cjk_analyzer():
+    return CJKTokenizer() | LowercaseFilter()
+
+
+def jieba_analyzer():
+    from jieba.analyse import ChineseAnalyzer
+    return ChineseAnalyzer()
+
+
+#ZHIHU_SEARCH_ANALYZER 可选的分词方式
+ANALYZERS = {'cjk': cjk_analyzer, 'jieba': jieba_analyzer}
+
+
+def _unique_field(whoosheer):
+    return next(name for name, field in whoosheer.schema.items() if field.unique)
+
+
+def _document(whoosheer, values):
+    """把列的值转换成Whoosh文档：文本字段统一为unicode，时间转换成UTC秒数，
+    空的数值字段不写入"""
+    doc = {}
+    for name, field in whoosheer.schema.items():
+        value = values[name]
+        if isinstance(field, fields.NUMERIC):
+            if isinstance(value, datetime):
+                value = calendar.timegm(value.utctimetuple())
+            if value is not None:
+                doc[name] = value
+        else:
+            doc[name] = u'' if value is None else unicode(value)
+    return doc
+
+
+class BlendedBM25F(scoring.BM25F):
+    """BM25F的文本相关度乘上热度（如赞同数）和发布时间的加权：
+    score * (1 + popularity_weight * ln(1 + 热度)) * (1 - recency_weight + recency_weight * 0.5 ** (天数 / half_life))
+    两个信号从索引的popularity、recency列中读取，没有对应列的索引只按BM25F排序"""
+
+    use_final = True
+
+    def __init__(self, popularity, recency, popularity_weight, recency_weight, half_life,
+                 now=None, **kwargs):
+        scoring.BM25F.__init__(self, **kwargs)
+        self.popularity = popularity
+        self.recency = recency
+        self.popularity_weight = popularity_weight
+        self.recency_weight = recency_weight
+        self.half_life = half_life * 86400.0
+        self.now = now or time.time()
+        self._columns = None
+
+    def _column(self, reader, name):
+        if name and name in reader.schema and reader.schema[name].column_type:
+            return reader.column_reader(name)
+        return None
+
+    def final(self, searcher, docnum, score):
+        if self._columns is None or self._columns[0] is not searcher:
+            reader = searcher.reader()
+            self._columns = (searcher, self._column(reader, self.popularity),
+                             self._column(reader, self.recency))
+        _, popularity, timestamp = self._columns
+        if popularity is not None:
+            score *= 1 + self.popularity_weight * math.log1p(max(popularity[docnum] or 0, 0))
+        if timestamp is not None and timestamp[docnum]:
+            age = max(self.now - timestamp[docnum], 0)
+            score *= 1 - self.recency_weight + \
+                self.recency_weight * 0.5 ** (age / self.half_life)
+        return score
+
+
+class SearchIndexer(object):
+    """全文索引的注册、后台更新和搜索。
+
+    register_model 为模型建立索引（沿用flask_whooshee的索引存储），文本字段使用
+    ZHIHU_SEARCH_ANALYZER 选择的分词方式，popularity、recency列作为排序用的数值列，
+    在文本变化和reindex时更新；
+    赞同数、关注数这类在SQL中直接累加的计数在提交后从数据库重新读取。
+    flask_whooshee在每次插入/修改时同步打开写入器并争用索引的写锁，这里关闭它的
+    自动更新（WHOOSHEE_ENABLE_INDEXING），改为在flush时记下文本字段有变化的
+    对象，事务提交后放入进程内的队列，由一个后台线程每 ZHIHU_INDEX_BATCH_DELAY
+    秒取出最多 ZHIHU_INDEX_BATCH_SIZE 个变化，合并同一文档的多次修改后用
+    AsyncWriter 一次提交；提交时合并小的段，每 ZHIHU_INDEX_OPTIMIZE_INTERVAL 秒
+    把所有段合并成一个。写锁被其他进程占用时AsyncWriter在后台重试，下一批等它完成，
+    保证修改按顺序写入。ZHIHU_INDEX_ASYNC 为False时在提交的线程中写入索引。
+    队列只在进程内，进程退出时未写入的变化和批量插入的数据由 reindex() 补上。
+    """
+
+    def __init__(self):
+        self.app = None
+        self.whoosheers = []
+        self.analyzer = cjk_analyzer()
+        self._lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self._queue = []
+        self._event = threading.Event()
+        self._thread = None
+        self._writer = None
+        self._optimized = time.time()
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_INDEX_ASYNC', True)
+        app.config.setdefault('ZHIHU_INDEX_BATCH_SIZE', 500)
+        app.config.setdefault('ZHIHU_INDEX_BATCH_DELAY', 1.0)
+        app.config.setdefault('ZHIHU_INDEX_OPTIMIZE_INTERVAL', 3600)
+        app.config.setdefault('ZHIHU_INDEX_WRITER_TIMEOUT', 2)
+        app.config.setdefault('ZHIHU_SEARCH_ANALYZER', 'cjk')
+        app.config.setdefault('ZHIHU_SEARCH_POPULARITY_WEIGHT', 0.2)
+        app.config.setdefault('ZHIHU_SEARCH_RECENCY_WEIGHT', 0.3)
+        app.config.setdefault('ZHIHU_SEARCH_HALF_LIFE', 30)
+        self.app = app
+        self._optimized = time.time()
+        with self._lock:
+            self._queue = []
+        try:
+            self.analyzer = ANALYZERS[app.config['ZHIHU_SEARCH_ANALYZER']]()
+        except ImportError:
+            app.logger.warning('jieba is not installed, falling back to the cjk analyzer')
+            self.analyzer = cjk_analyzer()
+        for whoosheer in self.whoosheers:
+            self._build_schema(whoosheer)
+
+    def _build_schema(self, whoosheer):
+        schema = {whoosheer.primary: fields.NUMERIC(stored=True, unique=True)}
+        for name in whoosheer.text_fields:
+            schema[name] = fields.TEXT(analyzer=self.analyzer)
+        for name in (whoosheer.popularity, whoosheer.recency):
+            if name:
+                schema[name] = fields.NUMERIC(bits=64, sortable=True)
+        whoosheer.schema = fields.Schema(**schema)
+
+    def register_model(self, *text_fields, **kwargs):
+        """为模型建立全文索引的类装饰器，用法与whooshee.register_model相同；
+        popularity给出表示热度的计数列，recency给出发布时间列，都参与排序"""
+        from . import whooshee
+
+        def inner(model):
+            class ModelWhoosheer(AbstractWhoosheerMeta):
+                pass
+            ModelWhoosheer.index_subdir = model.__tablename__
+            ModelWhoosheer.models = [model]
+            ModelWhoosheer.primary = model.__table__.primary_key.columns.values()[0].name
+            ModelWhoosheer.text_fields = text_fields
+            ModelWhoosheer.popularity = kwargs.get('popularity')
+            ModelWhoosheer.recency = kwargs.get('recency')
+            ModelWhoosheer._is_model_whoosheer = True
+            self._build_schema(ModelWhoosheer)
+            self.whoosheers.append(ModelWhoosheer)
+            whooshee.register_whoosheer(ModelWhoosheer)
+            model._whoosheer_ = ModelWhoosheer
+            model.whoosh_search = ModelWhoosheer.search
+            return model
+        return inner
+
+    #字段或分词方式改变后，空的索引直接按新的结构重建，已有数据的索引需要reindex
+    def index(self, whoosheer, recreate=False):
+        index = Whooshee.get_or_create_index(self.app, whoosheer)
+        if index.schema != whoosheer.schema:
+            if recreate or index.is_empty():
+                index = index.storage.create_index(whoosheer.schema, indexname=index.indexname)
+                self.app.extensions['whooshee']['whoosheers_indexes'][whoosheer] = index
+            elif not getattr(index, '_outdated_warned', False):
+                index._outdated_warned = True
+                self.app.logger.warning('Search index %s is outdated, run manage.py reindex',
+                                        whoosheer.index_subdir)
+        return index
+
+    #flush时对象的修改历史还在，只记下文本字段确实变化了的对象
+    def on_after_flush(self, session, flush_context):
+        changes = []
+        for whoosheer in self.whoosheers:
+            names = whoosheer.schema.names()
+            for obj in list(session.new) + list(session.dirty):
+                if type(obj) not in whoosheer.models:
+                    continue
+                state = inspect(obj)
+                if obj in session.new or any(state.attrs[name].history.has_changes()
+                                             for name in whoosheer.text_fields):
+                    values = dict((name, getattr(obj, name)) for name in names)
+                    changes.append((whoosheer, getattr(obj, whoosheer.primary),
+                                    _document(whoosheer, values)))
+            for obj in session.deleted:
+                if type(obj) in whoosheer.models:
+                    changes.append((whoosheer, getattr(obj, whoosheer.primary), None))
+        if changes:
+            call_after_commit(session, self.enqueue, *changes)
+
+    def refresh_on_commit(self, session, model, *keys):
+        """提交后从数据库重新读取这些行写入索引，用于在SQL中直接更新的排序列"""
+        call_after_commit(session, self.enqueue,
+                          *[(model._whoosheer_, key, RELOAD) for key in keys])
+
+    def refresh_column_on_commit(self, session, model, column, *keys):
+        """column是model参与排序的列时，提交后重新写入这些行"""
+        whoosheer = getattr(model, '_whoosheer_', None)
+        if whoosheer is not None and column in (whoosheer.popularity, whoosheer.recency):
+            self.refresh_on_commit(session, model, *keys)
+
+    def enqueue(self, *changes):
+        """放入 (whoosheer, 主键, 文档) 形式的变化，文档为None表示删除"""
+        with self._lock:
+            self._queue.extend(changes)
+        if not self.app.config['ZHIHU_INDEX_ASYNC']:
+            self.drain()
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        self._event.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue)
+
+    def drain(self):
+        """在当前线程写入队列中所有的变化，返回写入的文档数"""
+        if not has_app_context():
+            with self.app.app_context():
+                return self.drain()
+        count = 0
+        with self._drain_lock:
+            while True:
+                with self._lock:
+                    size = self.app.config['ZHIHU_INDEX_BATCH_SIZE']
+                    changes, self._queue = self._queue[:size], self._queue[size:]
+                if not changes:
+                    break
+                count += self._write(changes)
+            if time.time() - self._optimized >= self.app.config['ZHIHU_INDEX_OPTIMIZE_INTERVAL']:
+                self.optimize()
+        return count
+
+    def _load(self, whoosheer, keys):
+        """从数据库读取一批行的文档，已删除的行为None"""
+        from . import db
+        table = whoosheer.models[0].__table__
+        names = whoosheer.schema.names()
+        docs = dict.fromkeys(keys)
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            for row in db.engine.execute(
+                    db.select([table.c[name] for name in names]).
+                    where(table.c[whoosheer.primary].in_(keys[i:i + 500]))):
+                docs[row[whoosheer.primary]] = _document(whoosheer, dict(zip(names, row)))
+        return docs
+
+    #同一文档在一批中的多次修改只保留最后一次
+    def _write(self, changes):
+        batches = {}
+        for whoosheer, key, doc in changes:
+            batches.setdefault(whoosheer, {})[key] = doc
+        for whoosheer, docs in batches.items():
+            reload = [key for key, doc in docs.items() if doc is RELOAD]
+            if reload:
+                docs.update(self._load(whoosheer, reload))
+            writer = self._async_writer(whoosheer)
+            names = writer.index.schema.names()
+            for key, doc in docs.items():
+                if doc is None:
+                    writer.delete_by_term(whoosheer.primary, key)
+                else:
+                    writer.update_document(**dict((name, value) for name, value in doc.items()
+                                                  if name in names))
+            writer.commit()
+        return sum(len(docs) for docs in batches.values())
+
+    #上一次提交还在等待写锁时先等它完成
+    def _async_writer(self, whoosheer):
+        if self._writer is not None and self._writer.is_alive():
+            self._writer.join()
+        self._writer = AsyncWriter(self.index(whoosheer), writerargs=dict(
+            timeout=self.app.config['ZHIHU_INDEX_WRITER_TIMEOUT']))
+        return self._writer
+
+    def optimize(self):
+        """把每个索引的所有段合并成一个"""
+        for whoosheer in self.whoosheers:
+            self._async_writer(whoosheer).commit(optimize=True)
+        self._optimized = time.time()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.app.config['ZHIHU_INDEX_OPTIMIZE_INTERVAL'])
+            time.sleep(self.app.config['ZHIHU_INDEX_BATCH_DELAY'])
+            self._event.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.app.logger.exception('Failed to update the search index')
+
+    def reindex(self, processes=None, batch_size=1000):
+        """从数据库重建所有索引，返回索引的文档数。
+
+        按主键顺序分块读取被索引的列（不加载ORM对象），交给Whoosh的多进程写入器
+        在processes个进程中分词，各进程写成单独的段；提交时替换掉原有的段，
+        重建期间搜索仍使用旧的索引（索引结构改变时除外）。内存中的索引只用一个进程"""
+        from . import db
+        if processes is None:
+            processes = cpu_count()
+        if self.app.extensions['whooshee']['memory_storage']:
+            processes = 1
+        total = 0
+        for whoosheer in self.whoosheers:
+            table = whoosheer.models[0].__table__
+            key = table.c[whoosheer.primary]
+            names = whoosheer.schema.names()
+            writer = self.index(whoosheer, recreate=True).writer(
+                procs=processes, multisegment=processes > 1,
+                timeout=self.app.config['ZHIHU_INDEX_WRITER_TIMEOUT'])
+            try:
+                last = None
+                while True:
+                    query = db.select([table.c[name] for name in names]). \
+                        order_by(key).limit(batch_size)
+                    if last is not None:
+                        query = query.where(key > last)
+                    rows = db.session.execute(query).fetchall()
+                    if not rows:
+                        break
+                    for row in rows:
+                        writer.add_document(**_document(whoosheer, dict(zip(names, row))))
+                    last = rows[-1][whoosheer.primary]
+                    total += len(rows)
+            except Exception:
+                writer.cancel()
+                raise
+            writer.commit(mergetype=CLEAR)
+        self._optimized = time.time()
+        return total
+
+    def _parse(self, whoosheer, index, query, prefix):
+        if not isinstance(query, unicode):
+            query = query.decode('utf-8')
+        query = query.strip()
+        if prefix and _PARTIAL_WORD.search(query):
+            query = query.lower() + u'*'
+        #不用OrGroup.factory()的协调加分：whoosh的CoordMatcher在Python 2下做整数除法，
+        #所有得分都变成0，排序列也就不起作用了
+        parser = qparser.MultifieldParser(whoosheer.text_fields, index.schema,
+                                          group=qparser.OrGroup)
+        return parser.parse(query)
+
+    def search(self, model, query, offset=0, limit=10, prefix=False):
+        """在model的索引中按BM25F和排序列的加权结果搜索，返回第offset个起最多limit个
+        命中的主键。只对前offset+limit个命中排序，不取出全部匹配的行。
+        prefix为True时最后一个英文单词按前缀匹配，用于输入时的自动补全"""
+        whoosheer = model._whoosheer_
+        index = self.index(whoosheer)
+        weighting = BlendedBM25F(whoosheer.popularity, whoosheer.recency,
+                                 self.app.config['ZHIHU_SEARCH_POPULARITY_WEIGHT'],
+                                 self.app.config['ZHIHU_SEARCH_RECENCY_WEIGHT'],
+                                 self.app.config['ZHIHU_SEARCH_HALF_LIFE'])
+        with index.searcher(weighting=weighting) as searcher:
+            hits = searcher.search(self._parse(whoosheer, index, query, prefix),
+                                   limit=offset + limit)
+            return [hit[whoosheer.primary] for hit in hits[offset:offset + limit]]
+
+    def federated(self, query, models=None, limit=5, prefix=False):
+        """在多个模型的索引中分别搜索，返回 表名 -> 按排名排列的对象 的OrderedDict；
+        不同模型的得分不可比较，各自取前limit个，每个模型一次IN查询"""
+        results = OrderedDict()
+        for model in models or [whoosheer.models[0] for whoosheer in self.whoosheers]:
+            ids = self.search(model, query, 0, limit, prefix)
+            key = getattr(model, model._whoosheer_.primary)
+            objects = dict((getattr(obj, model._whoosheer_.primary), obj) for obj in
+                           model.query.filter(key.in_(ids))) if ids else {}
+            results[model.__tablename__] = [objects[id] for id in ids if id in objects]
+        return results
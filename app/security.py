@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from multiprocessing.pool import ThreadPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+
+class PasswordHasher(object):
+    """密码散列。
+
+    ZHIHU_PASSWORD_METHOD 选择算法：pbkdf2:<摘要>（迭代 ZHIHU_PASSWORD_ITERATIONS 次）
+    或argon2（需要安装argon2-cffi，未安装时退回pbkdf2）。已保存的散列与当前配置的
+    算法或参数不同时，needs_rehash() 为真，登录成功后按新配置重新散列。
+    散列和校验在 ZHIHU_PASSWORD_POOL_SIZE 个线程的线程池中执行，
+    登录高峰时同时计算散列的请求不超过这个数目；为0时在当前线程执行。
+    """
+
+    def __init__(self):
+        self.app = None
+        self._pool = None
+        self._argon2 = None
+
+    def init_app(self, app):
+        app.config.setdefault('ZHIHU_PASSWORD_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('ZHIHU_PASSWORD_ITERATIONS', 50000)
+        app.config.setdefault('ZHIHU_PASSWORD_POOL_SIZE', 4)
+        self.app = app
+        self._argon2 = None
+        if app.config['ZHIHU_PASSWORD_METHOD'] == 'argon2':
+            if argon2 is not None:
+                self._argon2 = argon2.PasswordHasher()
+            else:
+                app.logger.warning('argon2-cffi is not installed, '
+                                   'falling back to pbkdf2:sha256')
+        if self._pool is not None:
+            self._pool.close()
+        size = app.config['ZHIHU_PASSWORD_POOL_SIZE']
+        self._pool = ThreadPool(size) if size else None
+
+    @property
+    def method(self):
+        """当前使用的算法和参数，与pbkdf2散列开头的格式相同"""
+        if self._argon2 is not None:
+            return 'argon2'
+        method = self.app.config['ZHIHU_PASSWORD_METHOD']
+        if method == 'argon2':
+            method = 'pbkdf2:sha256'
+        return '%s:%d' % (method, self.app.config['ZHIHU_PASSWORD_ITERATIONS'])
+
+    def _run(self, func, *args):
+        if self._pool is None:
+            return func(*args)
+        return self._pool.apply_async(func, args).get()
+
+    def _hash(self, password):
+        if self._argon2 is not None:
+            return self._argon2.hash(password)
+        return generate_password_hash(password, method=self.method)
+
+    def _verify(self, stored, password):
+        if stored.startswith('$argon2'):
+            if argon2 is None:
+                return False
+            try:
+                return argon2.PasswordHasher().verify(stored, password)
+            except argon2.exceptions.VerificationError:
+                return False
+            except argon2.exceptions.InvalidHash:
+                return False
+        return check_password_hash(stored, password)
+
+    def hash(self, password):
+        return self._run(self._hash, password)
+
+    def verify(self, stored, password):
+        if not stored:
+            return False
+        return self._run(self._verify, stored, password)
+
+    def needs_rehash(self, stored):
+        if self._argon2 is not None:
+            return not stored.startswith('$argon2') or self._argon2.check_needs_rehash(stored)
+        return stored.split('$', 1)[0] != self.method
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""压力测试用的大批量虚拟数据。
+
+各表的行在进程池中按批生成：每批用 (种子, 表名, 批号) 决定随机数，同样的参数
+总是得到同样的数据。生成时只用预先确定的id范围，不再逐行查询随机的用户和问题；
+主进程用executemany按批插入，每批一个事务。插入绕过了ORM的会话监听，
+计数列、answer_topics、推送表格、热度排行和全文索引在最后统一重建。
+"""
+
+import hashlib
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import forgery_py
+from forgery_py.dictionaries_loader import get_dictionary
+
+#生成数据时各进程共用的参数，由Pool的initializer设置
+_context = {}
+
+
+def _init_worker(context):
+    _context.clear()
+    _context.update(context)
+
+
+def _rng(table, batch):
+    """每批独立的随机数；forgery_py使用全局的random，一并设置种子"""
+    batch_seed = int(hashlib.md5('%s:%s:%s' % (_context['seed'], table, batch)).
+                     hexdigest()[:8], 16)
+    random.seed(batch_seed)
+    return random.Random(batch_seed)
+
+
+def _timestamp(rnd, days=None):
+    days = days or _context['days']
+    return _context['now'] - timedelta(seconds=rnd.randint(0, days * 24 * 3600))
+
+
+#forgery_py.name.first_name() 会把女性名字追加到缓存的男性名字列表上，
+#结果取决于之前调用的次数，这里去重排序后自己选
+def _first_names():
+    if 'first_names' not in _context:
+        _context['first_names'] = sorted(set(
+            name.strip().lower() for name in
+            get_dictionary('male_first_names') + get_dictionary('female_first_names')))
+    return _context['first_names']
+
+
+def _pick(rnd, ids):
+    """从 (起始id, 个数) 表示的连续id范围中随机取一个"""
+    start, count = ids
+    return start + rnd.randrange(count)
+
+
+def _users(batch, start, stop):
+    rnd = _rng('users', batch)
+    rows = []
+    for id in range(start, stop):
+        email = 'seed%d@example.com' % id
+        rows.append(dict(
+            id=id, username='%s%d' % (rnd.choice(_first_names()), id), email=email,
+            password_hash=_context['password_hash'], confirmed=True,
+            role_id=_context['role_id'],
+            avatar_hash=hashlib.md5(email.encode('utf-8')).hexdigest(),
+            about_me=forgery_py.lorem_ipsum.sentence(),
+            description=forgery_py.lorem_ipsum.words(rnd.randint(2, 6))[:128],
+            location=forgery_py.address.city(),
+            profession=forgery_py.lorem_ipsum.title()[:128],
+            gender=forgery_py.personal.gender()))
+    return 'users', rows
+
+
+def _topics(batch, start, stop):
+    rnd = _rng('topics', batch)
+    return 'topics', [dict(id=id, name='%s%d' % (forgery_py.lorem_ipsum.word(), id),
+                           description=forgery_py.lorem_ipsum.sentences(rnd.randint(1, 3)))
+                      for id in range(start, stop)]
+
+
+def _questions(batch, start, stop):
+    rnd = _rng('questions', batch)
+    rows, links = [], []
+    for id in range(start, stop):
+        rows.append(dict(id=id, title=u'%s #%d' % (forgery_py.lorem_ipsum.title(), id),
+                         body=forgery_py.lorem_ipsum.sentences(rnd.randint(1, 4)),
+                         user_id=_pick(rnd, _context['users']),
+                         timestamp=_timestamp(rnd), view_count=rnd.randint(0, 1000)))
+        topic_start, topic_count = _context['topics']
+        for topic_id in rnd.sample(xrange(topic_start, topic_start + topic_count),
+                                   min(rnd.randint(1, 3), topic_count)):
+            links.append(dict(topic_id=topic_id, question_id=id))
+    return 'questions', rows, 'topics_questions', links
+
+
+def _answers(batch, start, stop):
+    rnd = _rng('answers', batch)
+    return 'answers', [dict(id=id, body=forgery_py.lorem_ipsum.paragraph(),
+                            user_id=_pick(rnd, _context['users']),
+                            question_id=_pick(rnd, _context['questions']),
+                            timestamp=_timestamp(rnd), likes_count=0)
+                       for id in range(start, stop)]
+
+
+def _comments(batch, start, stop):
+    rnd = _rng('comments', batch)
+    return 'comments', [dict(id=id, body=forgery_py.lorem_ipsum.sentence(),
+                             user_id=_pick(rnd, _context['users']),
+                             answer_id=_pick(rnd, _context['answers']),
+                             timestamp=_timestamp(rnd))
+                        for id in range(start, stop)]
+
+
+#赞同数服从长尾分布：大多数回答只有几个赞同，少数回答有很多
+def _likes(batch, start, stop):
+    rnd = _rng('likes', batch)
+    user_start, user_count = _context['users']
+    rows = []
+    for answer_id in range(start, stop):
+        count = min(int(_context['likes'] * rnd.paretovariate(2) / 2), user_count)
+        for user_id in rnd.sample(xrange(user_start, user_start + user_count), count):
+            rows.append(dict(answer_id=answer_id, user_id=user_id, unread=False,
+                             timestamp=_timestamp(rnd, days=7)))
+    return 'likes', rows
+
+
+def _follows(batch, start, stop):
+    rnd = _rng('follows', batch)
+    user_start, user_count = _context['users']
+    topic_start, topic_count = _context['topics']
+    follows, topics = [], []
+    for follower_id in range(start, stop):
+        count = min(rnd.randint(0, 2 * _context['follows']), user_count - 1)
+        for followed_id in rnd.sample(xrange(user_start, user_start + user_count), count + 1):
+            if followed_id != follower_id and count > 0:
+                follows.append(dict(follower_id=follower_id, followed_id=followed_id,
+                                    timestamp=_timestamp(rnd)))
+        for topic_id in rnd.sample(xrange(topic_start, topic_start + topic_count),
+                                   min(rnd.randint(1, 5), topic_count)):
+            topics.append(dict(topic_id=topic_id, user_id=follower_id))
+    return 'follows', follows, 'topics_users', topics
+
+
+def _next_id(table):
+    from . import db
+    return (db.session.query(db.func.max(table.c.id)).scalar() or 0) + 1
+
+
+def _insert(tables, result, inserted):
+    """插入一批生成的行，每批一个事务；inserted累计各表插入的行数"""
+    from . import db
+    with db.engine.begin() as conn:
+        for name, rows in zip(result[::2], result[1::2]):
+            if rows:
+                conn.execute(tables[name].insert(), rows)
+            inserted[name] = inserted.get(name, 0) + len(rows)
+
+
+def seed(users=1000, topics=100, questions=5000, answers=50000, comments=50000,
+         likes=3, follows=20, processes=None, batch_size=2000, random_seed=2017,
+         days=60, log=None):
+    """生成虚拟数据并追加到当前数据库，返回各表插入的行数"""
+    from . import db, password_hasher
+    from .models import Role, User, Topic, Question, Answer, Comment, Like, Follow, \
+        topics_questions, topics_users
+    tables = dict((table.name, table) for table in (
+        User.__table__, Topic.__table__, Question.__table__, Answer.__table__,
+        Comment.__table__, Like.__table__, Follow.__table__,
+        topics_questions, topics_users))
+    log = log or (lambda message: None)
+    Role.insert_roles()
+
+    ranges = {}
+    for name, count in (('users', users), ('topics', topics), ('questions', questions),
+                        ('answers', answers), ('comments', comments)):
+        ranges[name] = (_next_id(tables[name]), count)
+    context = dict(seed=random_seed, now=datetime.utcnow(), days=days, likes=likes,
+                   follows=follows, password_hash=password_hasher.hash('password'),
+                   role_id=Role.table().default_id, **ranges)
+
+    #后面的阶段引用前面阶段的id，按顺序执行；每个阶段内的各批并行生成
+    stages = [(_users, ranges['users']), (_topics, ranges['topics']),
+              (_questions, ranges['questions']), (_answers, ranges['answers']),
+              (_comments, ranges['comments']), (_likes, ranges['answers']),
+              (_follows, ranges['users'])]
+    inserted = {}
+    #processes为0时在当前进程生成，结果与并行生成相同
+    if processes == 0:
+        _init_worker(context)
+        pool, imap = None, itertools.imap
+    else:
+        pool = Pool(processes, initializer=_init_worker, initargs=(context,))
+        imap = pool.imap
+    try:
+        for generate, (start, count) in stages:
+            begin, before = time.time(), sum(inserted.values())
+            tasks = [(batch, first, min(first + batch_size, start + count))
+                     for batch, first in enumerate(range(start, start + count, batch_size))]
+            for result in imap(_call, [(generate, task) for task in tasks]):
+                _insert(tables, result, inserted)
+            log('%-10s %8d rows in %.1fs' % (generate.__name__.strip('_'),
+                                             sum(inserted.values()) - before,
+                                             time.time() - begin))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    begin = time.time()
+    refresh_aggregates()
+    log('aggregates rebuilt in %.1fs' % (time.time() - begin))
+    return inserted
+
+
+def _call(args):
+    generate, task = args
+    return generate(*task)
+
+
+def refresh_aggregates():
+    """重建批量插入时没有维护的计数列、answer_topics、推送表格、热度排行、
+    全文索引和缓存"""
+    from . import db, cache, hot_ranking, top_answers, search_indexer
+    from .counters import recount_all
+    from .models import Answer, Feed
+    recount_all()
+    db.session.commit()
+    Answer.rebuild_topic_index()
+    Feed.rebuild()
+    hot_ranking.rebuild()
+    hot_ranking.persist()
+    top_answers.invalidate()
+    search_indexer.reindex()
+    cache.clear()
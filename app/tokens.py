@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from flask import current_app
+from itsdangerous import TimedJSONWebSignatureSerializer, Signer, BadSignature
+
+#令牌的用途，各自使用不同的salt，一种用途的令牌不能用于另一种
+PURPOSES = ('confirm', 'reset', 'change-email')
+
+
+class _KeyCachingSigner(Signer):
+    """只派生一次密钥的Signer"""
+
+    def derive_key(self):
+        key = getattr(self, '_derived_key', None)
+        if key is None:
+            key = self._derived_key = Signer.derive_key(self)
+        return key
+
+
+class _Serializer(TimedJSONWebSignatureSerializer):
+    """复用按 (salt, 算法) 创建的Signer，签名和校验时不再重新派生密钥"""
+    signer = _KeyCachingSigner
+
+    def __init__(self, *args, **kwargs):
+        TimedJSONWebSignatureSerializer.__init__(self, *args, **kwargs)
+        self._signers = {}
+
+    def make_signer(self, salt=None, algorithm=None):
+        key = (salt, algorithm)
+        signer = self._signers.get(key)
+        if signer is None:
+            signer = self._signers[key] = \
+                TimedJSONWebSignatureSerializer.make_signer(self, salt, algorithm)
+        return signer
+
+
+class TokenService(object):
+    """确认账户、重设密码、更改邮箱等流程的签名令牌。
+
+    每个app按 (用途, 有效期) 只创建一次序列化器，salt为 'zhihu.<用途>'，
+    密钥在第一次使用时派生后缓存。issue_many() 用同一个序列化器批量签发，
+    供"重新发送确认邮件"之类的批量任务使用。
+    """
+
+    def init_app(self, app):
+        app.extensions['zhihu_tokens'] = {}
+
+    def _serializer(self, purpose, expiration):
+        if purpose not in PURPOSES:
+            raise ValueError('Unknown token purpose: %r' % purpose)
+        serializers = current_app.extensions['zhihu_tokens']
+        key = (purpose, expiration)
+        serializer = serializers.get(key)
+        if serializer is None:
+            serializer = serializers[key] = _Serializer(
+                current_app.config['SECRET_KEY'], expiration, salt='zhihu.' + purpose)
+        return serializer
+
+    def dumps(self, purpose, data, expiration=3600):
+        return self._serializer(purpose, expiration).dumps(data)
+
+    def issue_many(self, purpose, payloads, expiration=3600):
+        """为每个payload签发一个令牌，返回令牌列表"""
+        serializer = self._serializer(purpose, expiration)
+        return [serializer.dumps(data) for data in payloads]
+
+    def loads(self, purpose, token):
+        """校验令牌，返回其中的数据；签名错误、过期或格式不正确时返回None"""
+        try:
+            data = self._serializer(purpose, None).loads(token)
+        except (BadSignature, ValueError, TypeError):
+            return None
+        return data if isinstance(data, dict) else None
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+from flask import g
+from sqlalchemy.orm.attributes import set_committed_value
+from flask_login import current_user
+from . import db, like_counter
+from .models import User, Question, Answer, Comment, Like, Topic, \
+    topics_questions, topics_users
+
+
+class AnswerView(object):
+    """渲染一条回答（main/_answer.html）所需的统计数据"""
+
+    def __init__(self, likes_count=0, comments_count=0, liked=False,
+                 topics=(), interested_topics=()):
+        self.likes_count = likes_count
+        self.comments_count = comments_count
+        self.liked = liked
+        self.topics = list(topics)
+        self.interested_topics = list(interested_topics)
+
+
+def _by_id(model, ids):
+    return dict((obj.id, obj) for obj in model.query.filter(model.id.in_(ids)))
+
+
+def _count_by_answer(model, answer_ids):
+    return dict(db.session.query(model.answer_id, db.func.count(model.id)).
+                filter(model.answer_id.in_(answer_ids)).
+                group_by(model.answer_id))
+
+
+def load_answer_views(answers, user=None):
+    """批量加载一页回答的作者、问题、话题、评论数和当前用户是否赞过，
+    查询次数与回答条数无关。结果存入g.answer_views，供模板中的answer_view()读取"""
+    if user is None:
+        user = current_user
+    answers = [answer for answer in answers if answer is not None]
+    views = getattr(g, 'answer_views', None)
+    if views is None:
+        views = g.answer_views = {}
+    if not answers:
+        return views
+    answer_ids = [answer.id for answer in answers]
+    question_ids = set(answer.question_id for answer in answers)
+
+    #直接填入关系属性，模板访问answer.author / answer.question时不再单独查询
+    authors = _by_id(User, set(answer.user_id for answer in answers))
+    questions = _by_id(Question, question_ids)
+    for answer in answers:
+        set_committed_value(answer, 'author', authors.get(answer.user_id))
+        set_committed_value(answer, 'question', questions.get(answer.question_id))
+
+    comments = _count_by_answer(Comment, answer_ids)
+    topics = {}
+    for question_id, topic in db.session.query(topics_questions.c.question_id, Topic).\
+            join(Topic, Topic.id == topics_questions.c.topic_id).\
+            filter(topics_questions.c.question_id.in_(question_ids)):
+        topics.setdefault(question_id, []).append(topic)
+    liked = set()
+    followed_topics = set()
+    if user.is_authenticated:
+        liked = set(answer_id for answer_id, in db.session.query(Like.answer_id).
+                    filter(Like.user_id == user.id, Like.answer_id.in_(answer_ids)))
+        followed_topics = set(topic_id for topic_id, in db.session.query(topics_users.c.topic_id).
+                              filter(topics_users.c.user_id == user.id))
+
+    for answer in answers:
+        question_topics = topics.get(answer.question_id, [])
+        views[answer.id] = AnswerView(
+            likes_count=(answer.likes_count or 0) + like_counter.pending(answer.id),
+            comments_count=comments.get(answer.id, 0),
+            liked=answer.id in liked,
+            topics=question_topics,
+            interested_topics=[t for t in question_topics if t.id in followed_topics])
+    return views
+
+
+def load_like_answers(likes):
+    """批量载入一页赞同对应的用户和回答，再为这些回答加载AnswerView"""
+    likes = list(likes)
+    if likes:
+        users = _by_id(User, set(like.user_id for like in likes))
+        answers = _by_id(Answer, set(like.answer_id for like in likes))
+        for like in likes:
+            set_committed_value(like, 'user', users.get(like.user_id))
+            set_committed_value(like, 'answer', answers.get(like.answer_id))
+    return load_answer_views([like.answer for like in likes])
+
+
+def answer_view(answer):
+    """模板中取一条回答的AnswerView；没有预先批量加载时单独加载这一条"""
+    views = getattr(g, 'answer_views', None)
+    if views is None or answer.id not in views:
+        views = load_answer_views([answer])
+    return views[answer.id]
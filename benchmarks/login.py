@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""测量 /auth/login 在多线程并发登录时的吞吐量和延迟。
+
+    $ python benchmarks/login.py --threads 8 --logins 400 --iterations 50000
+
+--old-iterations 给出与 --iterations 不同的值时，用户的密码先按旧参数散列，
+第一次登录时会重新散列，可以观察参数调整后登录高峰的额外开销。
+数据写入单独的SQLite文件，不会影响开发数据库。
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from app import create_app, db, password_hasher
+from app.models import Role, User
+
+
+def populate(args):
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    hashed = password_hasher.hash('password')
+    db.engine.execute(User.__table__.insert(),
+                      [{'id': i, 'username': 'user%d' % i, 'email': 'user%d@example.com' % i,
+                        'password_hash': hashed, 'confirmed': True}
+                       for i in range(1, args.users + 1)])
+
+
+def worker(app, args, index, latencies):
+    client = app.test_client()
+    for i in range(index, args.logins, args.threads):
+        begin = time.time()
+        response = client.post('/auth/login', data={
+            'email': 'user%d@example.com' % (i % args.users + 1), 'password': 'password'})
+        latencies.append(time.time() - begin)
+        assert response.status_code == 302, response.status_code
+        client.get('/auth/logout')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--method', default='pbkdf2:sha256')
+    parser.add_argument('--iterations', type=int, default=50000)
+    parser.add_argument('--old-iterations', type=int, default=None)
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--database', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'login.sqlite'))
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + args.database,
+                      SQLALCHEMY_RECORD_QUERIES=False,
+                      ZHIHU_PASSWORD_METHOD=args.method,
+                      ZHIHU_PASSWORD_ITERATIONS=args.old_iterations or args.iterations,
+                      ZHIHU_PASSWORD_POOL_SIZE=args.pool_size)
+    password_hasher.init_app(app)
+    with app.app_context():
+        populate(args)
+    app.config['ZHIHU_PASSWORD_ITERATIONS'] = args.iterations
+    password_hasher.init_app(app)
+
+    latencies = []
+    threads = [threading.Thread(target=worker, args=(app, args, i, latencies))
+               for i in range(args.threads)]
+    begin = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - begin
+    print('hasher       %s (pool %d)' % (password_hasher.method, args.pool_size))
+    print('logins       %d in %.2fs, %.1f/s' % (len(latencies), elapsed,
+                                                len(latencies) / elapsed))
+    print('latency      p50 %.1f ms, p95 %.1f ms' % (percentile(latencies, 0.5) * 1000,
+                                                     percentile(latencies, 0.95) * 1000))
+
+
+if __name__ == '__main__':
+    main()
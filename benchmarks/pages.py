@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""用测试客户端请求main蓝本的主要页面，输出每个页面的延迟和查询数（JSON）。
+
+    $ python benchmarks/pages.py --answers 50000 --output before.json
+    $ python benchmarks/pages.py --answers 50000 --output after.json
+
+数据由app.seed按固定种子生成，写入单独的SQLite文件；数据量参数不变时复用已有的
+数据库。每个页面先预热 --warmup 次，再按固定种子选取的参数请求 --requests 次，
+记录p50/p95延迟和每个请求的查询数。--cache null 关闭页面缓存，测量未命中时的代价。
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User, Topic, Question, Answer
+from app.seed import seed
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+#搜索用的词，来自forgery_py的lorem ipsum词库
+SEARCH_WORDS = ['lorem', 'ipsum', 'dolor', 'amet', 'integer', 'pede', 'vestibulum']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def populate(args):
+    db.drop_all()
+    db.create_all()
+    begin = time.time()
+    seed(users=args.users, topics=args.topics, questions=args.questions,
+         answers=args.answers, comments=args.answers // 2, likes=3, follows=20,
+         processes=args.processes, random_seed=args.seed)
+    print >> sys.stderr, 'seeded %d answers in %.1fs' % (args.answers, time.time() - begin)
+
+
+def targets(args):
+    """每个页面的名称和生成请求URL、cookies的函数"""
+    rnd = random.Random(args.seed)
+    question_ids = [id for id, in db.session.query(Question.id).limit(1000)]
+    answers = db.session.query(Answer.question_id, Answer.id).limit(1000).all()
+    topic_ids = [id for id, in db.session.query(Topic.id).limit(1000)]
+    usernames = [name for name, in db.session.query(User.username).limit(1000)]
+
+    def index(choice):
+        return lambda: ('/', {'choice': str(choice)})
+
+    return [
+        ('index_interested_topics', index(0)),
+        ('index_followings', index(1)),
+        ('index_likes_followings', index(2)),
+        ('index_top', index(3)),
+        ('question', lambda: ('/question/%d' % rnd.choice(question_ids), {})),
+        ('answer', lambda: ('/question/%d/answer/%d' % rnd.choice(answers), {})),
+        ('topic_dynamics', lambda: ('/topic/%d/hot' % rnd.choice(topic_ids), {})),
+        ('profile', lambda: ('/people/%s/activities' % rnd.choice(usernames), {})),
+        ('daily_hot', lambda: ('/explore/daily-hot', {})),
+        ('search_results', lambda: ('/search_results/%s' % rnd.choice(SEARCH_WORDS), {})),
+    ]
+
+
+def measure(client, make_request, args, queries):
+    latencies, counts = [], []
+    for i in range(args.warmup + args.requests):
+        url, cookies = make_request()
+        for name, value in cookies.items():
+            client.set_cookie('localhost', name, value)
+        del queries[:]
+        db.session.remove()
+        begin = time.time()
+        response = client.get(url)
+        elapsed = time.time() - begin
+        assert response.status_code == 200, (url, response.status_code)
+        if i >= args.warmup:
+            latencies.append(elapsed * 1000)
+            counts.append(len(queries))
+    return dict(p50_ms=round(percentile(latencies, 0.5), 2),
+                p95_ms=round(percentile(latencies, 0.95), 2),
+                mean_ms=round(sum(latencies) / len(latencies), 2),
+                queries_p50=percentile(counts, 0.5),
+                queries_max=max(counts))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--topics', type=int, default=100)
+    parser.add_argument('--questions', type=int, default=5000)
+    parser.add_argument('--answers', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--cache', default='lru', choices=['lru', 'null'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=2017)
+    parser.add_argument('--database', default=os.path.join(HERE, 'pages.sqlite'))
+    parser.add_argument('--output', default=None, help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + args.database,
+                      SQLALCHEMY_RECORD_QUERIES=False,
+                      WHOOSHEE_MEMORY_STORAGE=False,
+                      WHOOSHEE_DIR=os.path.splitext(args.database)[0] + '_whooshee',
+                      ZHIHU_CACHE_TYPE=args.cache,
+                      ZHIHU_QUERY_SAMPLE_RATE=0)
+    from app import cache
+    cache.init_app(app)
+    with app.app_context():
+        if not db.engine.has_table('answers') or Answer.query.count() != args.answers:
+            populate(args)
+        queries = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *a: queries.append(a[2]))
+
+        client = app.test_client(use_cookies=True)
+        user = User.query.order_by(User.id).first()
+        response = client.post('/auth/login', data={'email': user.email,
+                                                    'password': 'password'})
+        assert response.status_code == 302, 'login failed'
+
+        results = {}
+        for name, make_request in targets(args):
+            results[name] = measure(client, make_request, args, queries)
+            print >> sys.stderr, '%-26s p50 %8.2f ms  p95 %8.2f ms  %3d queries' % (
+                name, results[name]['p50_ms'], results[name]['p95_ms'],
+                results[name]['queries_p50'])
+
+    report = dict(revision=git_revision(), created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  config=dict((key, getattr(args, key)) for key in (
+                      'users', 'topics', 'questions', 'answers', 'requests', 'warmup',
+                      'cache', 'seed')),
+                  results=results)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""比较"关注的话题动态"旧查询（两层嵌套EXISTS）与answer_topics连接查询的耗时。
+
+    $ python benchmarks/topic_feed.py --answers 1000000
+
+数据写入单独的SQLite文件，不会影响开发数据库。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from app import create_app, db
+from app.models import User, Topic, Question, Answer, topics_users, \
+    topics_questions
+
+
+def old_answers_interested_topics(user):
+    return db.session.query(Answer).join(Question).filter(
+        Question.topics.any(Topic.followers.any(User.id ==
+                user.id))).order_by(Answer.timestamp.desc())
+
+
+def old_all_answers(topic):
+    return db.session.query(Answer).join(Question).filter(
+        Question.topics.any(Topic.id == topic.id)).order_by(
+        Answer.timestamp.desc())
+
+
+def populate(args):
+    rnd = random.Random(args.seed)
+    engine = db.engine
+    start = datetime(2017, 1, 1)
+    engine.execute(User.__table__.insert(),
+                   [{'id': i, 'username': 'user%d' % i, 'email': 'user%d@example.com' % i}
+                    for i in range(1, args.users + 1)])
+    engine.execute(Topic.__table__.insert(),
+                   [{'id': i, 'name': 'topic%d' % i} for i in range(1, args.topics + 1)])
+    engine.execute(Question.__table__.insert(),
+                   [{'id': i, 'title': 'question%d' % i, 'user_id': rnd.randint(1, args.users),
+                     'timestamp': start} for i in range(1, args.questions + 1)])
+    pairs = set()
+    for q in range(1, args.questions + 1):
+        for t in rnd.sample(range(1, args.topics + 1), rnd.randint(1, 3)):
+            pairs.add((t, q))
+    engine.execute(topics_questions.insert(),
+                   [{'topic_id': t, 'question_id': q} for t, q in pairs])
+    engine.execute(topics_users.insert(),
+                   [{'topic_id': t, 'user_id': u} for u in range(1, args.users + 1)
+                    for t in rnd.sample(range(1, args.topics + 1), 5)])
+    batch = 50000
+    for offset in range(0, args.answers, batch):
+        engine.execute(Answer.__table__.insert(),
+                       [{'id': i, 'body': 'answer', 'user_id': rnd.randint(1, args.users),
+                         'question_id': rnd.randint(1, args.questions), 'likes_count': 0,
+                         'timestamp': start + timedelta(seconds=rnd.randint(0, 3 * 10 ** 7))}
+                        for i in range(offset + 1, min(offset + batch, args.answers) + 1)])
+    Answer.rebuild_topic_index()
+
+
+def timed(label, query, repeat):
+    best = None
+    for i in range(repeat):
+        begin = time.time()
+        query()
+        elapsed = time.time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-40s %10.2f ms' % (label, best * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answers', type=int, default=1000000)
+    parser.add_argument('--questions', type=int, default=50000)
+    parser.add_argument('--topics', type=int, default=200)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=2017)
+    parser.add_argument('--database', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'topic_feed.sqlite'))
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.database
+    with app.app_context():
+        if not db.engine.has_table('answers') or Answer.query.count() != args.answers:
+            db.drop_all()
+            db.create_all()
+            begin = time.time()
+            populate(args)
+            print('populated %d answers in %.1fs' % (args.answers, time.time() - begin))
+
+        user = User.query.get(1)
+        topic = Topic.query.get(1)
+        print('%-40s %13s' % ('query', 'best of %d' % args.repeat))
+        timed('interested topics page 1 (old)',
+              lambda: old_answers_interested_topics(user).limit(10).all(), args.repeat)
+        timed('interested topics page 1 (answer_topics)',
+              lambda: user.answers_interested_topics.limit(10).all(), args.repeat)
+        timed('topic answers page 1 (old)',
+              lambda: old_all_answers(topic).limit(10).all(), args.repeat)
+        timed('topic answers page 1 (answer_topics)',
+              lambda: topic.all_answers.limit(10).all(), args.repeat)
+        timed('topic answers page 100 (old)',
+              lambda: old_all_answers(topic).offset(990).limit(10).all(), args.repeat)
+        timed('topic answers page 100 (answer_topics)',
+              lambda: topic.all_answers.offset(990).limit(10).all(), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
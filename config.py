@@ -9,7 +9,7 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'thisishardto guess..'
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_RECORD_QUERIES = True
+    SQLALCHEMY_RECORD_QUERIES = False
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_SERVER = 'smtp.163.com'
@@ -17,9 +17,70 @@ class Config(object):
     MAIL_USE_TLS = True
     ZHIHU_MAIL_SUBJECT_PREFIX = u'【知乎】'
     ZHIHU_MAIL_SENDER = 'Zhihu Admin <your_email@example.com>'
+    #邮件发送队列：保存在SQLite文件中，最多WORKERS个线程成批发送，失败后指数退避重试
+    ZHIHU_MAIL_QUEUE = os.environ.get('ZHIHU_MAIL_QUEUE') or \
+        os.path.join(basedir, 'mail_queue.sqlite')
+    ZHIHU_MAIL_WORKERS = 2
+    ZHIHU_MAIL_BATCH_SIZE = 20
+    ZHIHU_MAIL_MAX_ATTEMPTS = 5
+    ZHIHU_MAIL_RETRY_DELAY = 30
+    ZHIHU_MAIL_RETRY_MAX_DELAY = 3600
     ZHIHU_ADMIN = os.environ.get('ZHIHU_ADMIN')
     ZHIHU_SLOW_DB_QUERY_TIME = 0.5
+    #SQL查询统计：按比例抽取请求，同一语句在一个请求中超过N_PLUS_ONE次记为N+1
+    ZHIHU_QUERY_SAMPLE_RATE = float(os.environ.get('ZHIHU_QUERY_SAMPLE_RATE') or 1.0)
+    ZHIHU_QUERY_N_PLUS_ONE = 10
+    #赞同数写回缓冲：热门回答的连续赞同在内存中合并，定期批量更新likes_count
+    ZHIHU_LIKE_WRITE_BEHIND = os.environ.get('ZHIHU_LIKE_WRITE_BEHIND') == '1'
+    ZHIHU_LIKE_FLUSH_INTERVAL = 5
+    ZHIHU_LIKE_FLUSH_SIZE = 100
+    #问题浏览数写回缓冲：每个进程在内存中累加，定期和退出时批量写回view_count，
+    #ZHIHU_VIEW_WRITE_BEHIND=0时每次浏览直接更新；
+    #同一用户在去重窗口（秒）内重复浏览同一问题只计一次，0表示不去重
+    ZHIHU_VIEW_WRITE_BEHIND = os.environ.get('ZHIHU_VIEW_WRITE_BEHIND') != '0'
+    ZHIHU_VIEW_FLUSH_INTERVAL = 10
+    ZHIHU_VIEW_FLUSH_SIZE = 500
+    ZHIHU_VIEW_DEDUPE_WINDOW = 300
+    #热门回答排行：发布时间每晚GRAVITY秒，需要多十倍的赞同才能保持同样的排名
+    ZHIHU_HOT_GRAVITY = 45000
+    ZHIHU_HOT_MAX_DAYS = 31
+    ZHIHU_HOT_SNAPSHOT = os.environ.get('ZHIHU_HOT_SNAPSHOT')
+    ZHIHU_HOT_PERSIST_INTERVAL = 60
+    ZHIHU_HOT_REFRESH_INTERVAL = 600
+    #页面和片段缓存：lru / filesystem / memcached / null
+    ZHIHU_CACHE_TYPE = os.environ.get('ZHIHU_CACHE_TYPE') or 'lru'
+    ZHIHU_CACHE_DEFAULT_TIMEOUT = 300
+    ZHIHU_CACHE_MAX_SIZE = 1000
+    ZHIHU_CACHE_DIR = os.environ.get('ZHIHU_CACHE_DIR') or os.path.join(basedir, 'cache')
+    ZHIHU_CACHE_SERVERS = (os.environ.get('ZHIHU_CACHE_SERVERS') or '127.0.0.1:11211').split(',')
+    #回答正文的渲染：为True时提交后由后台线程渲染body_html；
+    #ZHIHU_RENDER_WORKER为False时不启动后台线程，由body_renderer.drain()渲染
+    ZHIHU_RENDER_DEFERRED = os.environ.get('ZHIHU_RENDER_DEFERRED') == '1'
+    ZHIHU_RENDER_WORKER = True
+    ZHIHU_RENDER_CACHE_SIZE = 1000
+    #用户关注列表（id集合）在缓存中保留的秒数，0表示只在单个请求内缓存
+    ZHIHU_FOLLOWING_CACHE_TIMEOUT = 60
+    #密码散列：pbkdf2:<摘要>或argon2（需要argon2-cffi），散列参数改变后用户下次登录时重新散列；
+    #散列在POOL_SIZE个线程中计算，限制登录高峰时同时占用CPU的请求数
+    ZHIHU_PASSWORD_METHOD = os.environ.get('ZHIHU_PASSWORD_METHOD') or 'pbkdf2:sha256'
+    ZHIHU_PASSWORD_ITERATIONS = int(os.environ.get('ZHIHU_PASSWORD_ITERATIONS') or 50000)
+    ZHIHU_PASSWORD_POOL_SIZE = 4
+    #登录用户的列快照在缓存中保留的秒数，user_loader命中时不查询users表，0表示不缓存
+    ZHIHU_USER_CACHE_TIMEOUT = 60
     WHOOSHEE_MIN_STRING_LEN = 1
+    #全文索引由search_indexer在提交后按批写入，不使用flask_whooshee的同步更新；
+    #ZHIHU_INDEX_ASYNC为False时在提交的线程中写入
+    WHOOSHEE_ENABLE_INDEXING = False
+    ZHIHU_INDEX_ASYNC = True
+    ZHIHU_INDEX_BATCH_SIZE = 500
+    ZHIHU_INDEX_BATCH_DELAY = 1.0
+    ZHIHU_INDEX_OPTIMIZE_INTERVAL = 3600
+    #搜索的分词方式：cjk（中日韩字符切成二元组）或jieba（需要安装jieba）；
+    #结果按BM25F相关度乘上热度（赞同数、关注数）和发布时间（半衰期HALF_LIFE天）的加权排序
+    ZHIHU_SEARCH_ANALYZER = os.environ.get('ZHIHU_SEARCH_ANALYZER') or 'cjk'
+    ZHIHU_SEARCH_POPULARITY_WEIGHT = 0.2
+    ZHIHU_SEARCH_RECENCY_WEIGHT = 0.3
+    ZHIHU_SEARCH_HALF_LIFE = 30
 
     @staticmethod
     def init_app(self):
@@ -27,6 +88,7 @@ class Config(object):
 
 class Development(Config):
     DEBUG = True
+    SQLALCHEMY_RECORD_QUERIES = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URI') or \
         'sqlite:///' + os.path.join(basedir, 'develop.sqlite')
 
@@ -34,6 +96,9 @@ class Production(Config):
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'produce.sqlite')
+    ZHIHU_HOT_SNAPSHOT = os.environ.get('ZHIHU_HOT_SNAPSHOT') or \
+        os.path.join(basedir, 'hot_ranking.json')
+    ZHIHU_QUERY_SAMPLE_RATE = float(os.environ.get('ZHIHU_QUERY_SAMPLE_RATE') or 0.05)
 
     @classmethod
     def init_app(cls, app):
@@ -59,9 +124,18 @@ class Production(Config):
 
 class Testing(Config):
     TESTING = True
+    SQLALCHEMY_RECORD_QUERIES = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI') or \
         'sqlite:///' + os.path.join(basedir, 'testing.sqlite')
     WTF_CSRF_ENABLED = False
+    ZHIHU_MAIL_QUEUE = ':memory:'
+    ZHIHU_MAIL_WORKERS = 0
+    ZHIHU_RENDER_WORKER = False
+    ZHIHU_VIEW_WRITE_BEHIND = False
+    ZHIHU_PASSWORD_ITERATIONS = 1000
+    #测试中索引保存在内存里，随应用一起丢弃，并在提交的线程中同步写入
+    WHOOSHEE_MEMORY_STORAGE = True
+    ZHIHU_INDEX_ASYNC = False
 
 class HerokuConfig(Production):
     @classmethod
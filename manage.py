@@ -5,7 +5,7 @@ from flask_migrate import MigrateCommand, Migrate
 from flask_script import Manager, Shell
 from app import create_app, db
 from app.models import User, Role, Topic, Comment, Permission, \
-    Question, Answer, Like, Follow
+    Question, Answer, Like, Follow, Feed
 
 
 COV = None
@@ -20,7 +20,7 @@ migrate = Migrate(app, db)
 
 
 def make_context_shell():
-    return dict(app=app, db=db, User=User, Role=Role,Answer=Answer,Like=Like,Follow=Follow,
+    return dict(app=app, db=db, User=User, Role=Role,Answer=Answer,Like=Like,Follow=Follow,Feed=Feed,
                 Comment=Comment, Permission=Permission, Topic=Topic, Question=Question)
 manager.add_command('shell', Shell(make_context=make_context_shell))
 manager.add_command('db', MigrateCommand)
@@ -53,6 +53,119 @@ def profile(length=25, profile_dir=None):
                                       profile_dir=profile_dir)
     app.run()
 
+@manager.option('-u', '--username', dest='username', default=None)
+def rebuild_feeds(username=None):
+    """Rebuild the fan-out feed table for one user or for everyone."""
+    user = None
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            print ("No such user: %s" % username)
+            return
+    Feed.rebuild(user)
+
+@manager.option('-a', '--all', dest='all', action='store_true', default=False,
+                help='Re-render every answer, not only those without body_html')
+@manager.option('-p', '--processes', dest='processes', type=int, default=None)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def render_answers(all=False, processes=None, batch_size=500):
+    """Render answer bodies to body_html in parallel and bulk-update them."""
+    from multiprocessing import Pool
+    from app import body_renderer, cache
+    from app.rendering import render_body
+
+    query = db.session.query(Answer.id, Answer.body).order_by(Answer.id)
+    if not all:
+        query = query.filter(Answer.body_html.is_(None), Answer.body.isnot(None))
+    pool = Pool(processes)
+    last_id, total = 0, 0
+    try:
+        while True:
+            rows = query.filter(Answer.id > last_id).limit(batch_size).all()
+            if not rows:
+                break
+            #同样的正文只渲染一次
+            bodies = list(set(body for _, body in rows))
+            rendered = dict(zip(bodies, pool.map(render_body, bodies, chunksize=20)))
+            db.session.bulk_update_mappings(Answer, [
+                {'id': answer_id, 'body_html': rendered[body]} for answer_id, body in rows])
+            db.session.commit()
+            for body, html in rendered.items():
+                body_renderer.remember(body, html)
+            cache.invalidate(*['answer:%d' % answer_id for answer_id, _ in rows])
+            last_id = rows[-1][0]
+            total += len(rows)
+            print ("Rendered %d answers" % total)
+    finally:
+        pool.close()
+        pool.join()
+    cache.invalidate('answers')
+
+@manager.command
+def recount():
+    """Recompute the denormalized follower/answer/question/like counters."""
+    from app.counters import recount_all
+    recount_all()
+    db.session.commit()
+
+@manager.option('--users', dest='users', type=int, default=1000)
+@manager.option('--topics', dest='topics', type=int, default=100)
+@manager.option('--questions', dest='questions', type=int, default=5000)
+@manager.option('--answers', dest='answers', type=int, default=50000)
+@manager.option('--comments', dest='comments', type=int, default=50000)
+@manager.option('--likes', dest='likes', type=int, default=3,
+                help='Average number of likes per answer')
+@manager.option('--follows', dest='follows', type=int, default=20,
+                help='Average number of users each user follows')
+@manager.option('-p', '--processes', dest='processes', type=int, default=None)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=2000)
+@manager.option('-s', '--seed', dest='random_seed', type=int, default=2017)
+def seed(users=1000, topics=100, questions=5000, answers=50000, comments=50000,
+         likes=3, follows=20, processes=None, batch_size=2000, random_seed=2017):
+    """Bulk-generate fake data for load testing."""
+    from app.seed import seed
+    def log(message):
+        print (message)
+    seed(users, topics, questions, answers, comments, likes, follows,
+         processes, batch_size, random_seed, log=log)
+
+@manager.option('-p', '--processes', dest='processes', type=int, default=None)
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+def reindex(processes=None, batch_size=1000):
+    """Rebuild the full-text search indexes from the database."""
+    from app import search_indexer
+    print ("Indexed %d documents" % search_indexer.reindex(processes, batch_size))
+
+@manager.command
+def send_mails():
+    """Send every queued mail that is due and print the queue statistics."""
+    from app import mail_queue
+    print ("Processed %d mails" % mail_queue.drain())
+    print (mail_queue.stats())
+
+@manager.option('-u', '--base-url', dest='base_url', default=None,
+                help='Site URL used in the confirmation links')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def resend_confirmations(base_url=None, batch_size=500):
+    """Queue a new confirmation mail for every unconfirmed user."""
+    from app import tokens
+    from app.emails import send_mail
+    base_url = base_url or 'http://%s/' % (app.config['SERVER_NAME'] or 'localhost')
+    last_id, total = 0, 0
+    with app.test_request_context(base_url=base_url):
+        while True:
+            users = User.query.filter(User.confirmed == False, User.id > last_id). \
+                order_by(User.id).limit(batch_size).all()
+            if not users:
+                break
+            issued = tokens.issue_many('confirm', [{'confirm': user.id} for user in users])
+            for user, token in zip(users, issued):
+                send_mail(user.email, u'确认您的账户', 'auth/email/confirm',
+                          user=user, token=token)
+            last_id = users[-1].id
+            total += len(users)
+            print ("Queued %d confirmation mails" % total)
+
 @manager.command
 def deploy():
 
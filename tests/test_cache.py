@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import shutil
+import tempfile
+import time
+import unittest
+from flask import render_template_string
+from app import create_app, db, cache
+from app.cache import LRUCache
+from app.models import User, Role, Topic, Question, Answer, Comment
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['ZHIHU_CACHE_TYPE'] = 'lru'
+        cache.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lru_eviction_and_timeout(self):
+        lru = LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        lru.set('d', 4, timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(lru.get('d'))
+        self.assertFalse(lru.add('a', 5))
+
+    def test_tags(self):
+        cache.set('x', 1, tags=['t1', 't2'])
+        cache.set('y', 2, tags=['t2'])
+        self.assertEqual(cache.get('x', ['t1', 't2']), 1)
+        cache.invalidate('t1')
+        self.assertIsNone(cache.get('x', ['t1', 't2']))
+        self.assertEqual(cache.get('y', ['t2']), 2)
+
+    def test_filesystem_backend(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.app.config.update(ZHIHU_CACHE_TYPE='filesystem', ZHIHU_CACHE_DIR=path)
+            cache.init_app(self.app)
+            cache.set('x', {'a': 1}, tags=['t'])
+            self.assertEqual(cache.get('x', ['t']), {'a': 1})
+            cache.invalidate('t')
+            self.assertIsNone(cache.get('x', ['t']))
+        finally:
+            shutil.rmtree(path)
+
+    def test_invalidate_on_commit(self):
+        topic = Topic(name='history')
+        db.session.add(topic)
+        db.session.commit()
+        cache.set('topics', 'old', tags=['topics'])
+        topic.description = 'changed'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(cache.get('topics', ['topics']), 'old')
+        topic.description = 'changed'
+        db.session.commit()
+        self.assertIsNone(cache.get('topics', ['topics']))
+
+    def test_fragment(self):
+        template = "{% cache 'f', None, ['t'] %}{{ value }}{% endcache %}"
+        with self.app.test_request_context():
+            self.assertEqual(render_template_string(template, value='<a>'), '&lt;a&gt;')
+            self.assertEqual(render_template_string(template, value='b'), '&lt;a&gt;')
+            cache.invalidate('t')
+            self.assertEqual(render_template_string(template, value='b'), 'b')
+
+    def test_invalidate_while_rendering(self):
+        template = "{% cache 'f', None, ['t'] %}{{ value() }}{% endcache %}"
+
+        #渲染期间标签失效，渲染结果不能被当作最新的内容
+        def stale():
+            cache.invalidate('t')
+            return 'old'
+        with self.app.test_request_context():
+            self.assertEqual(render_template_string(template, value=stale), 'old')
+            self.assertEqual(render_template_string(template, value=lambda: 'new'), 'new')
+
+    def test_answer_tags_are_scoped(self):
+        user = User(email='john@example.com', username='john', password='cat')
+        topic = Topic(name='history')
+        question = Question(title='how are you?', author=user)
+        question.topics.append(topic)
+        a1 = Answer(body='fine', author=user, question=question)
+        a2 = Answer(body='good', author=user, question=question)
+        db.session.add_all([user, topic, question, a1, a2])
+        db.session.commit()
+        cache.set('a1', 1, tags=a1.fragment_tags())
+        cache.set('index', 1, tags=['answers'])
+        cache.set('topic', 1, tags=['topic:%d' % topic.id])
+        #评论只影响所属的回答
+        db.session.add(Comment(body='nice', author=user, answer=a2))
+        db.session.commit()
+        self.assertEqual(cache.get('a1', a1.fragment_tags()), 1)
+        self.assertEqual(cache.get('index', ['answers']), 1)
+        self.assertEqual(cache.get('topic', ['topic:%d' % topic.id]), 1)
+        #作者修改资料后回答的片段失效
+        user.description = 'historian'
+        db.session.commit()
+        self.assertIsNone(cache.get('a1', a1.fragment_tags()))
+        cache.set('a1', 1, tags=a1.fragment_tags())
+        #新增回答使首页和所属话题的列表失效
+        db.session.add(Answer(body='bad', author=user, question=question))
+        db.session.commit()
+        self.assertEqual(cache.get('a1', a1.fragment_tags()), 1)
+        self.assertIsNone(cache.get('index', ['answers']))
+        self.assertIsNone(cache.get('topic', ['topic:%d' % topic.id]))
+
+    def test_top_answers_page(self):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i)
+                 for i in range(3)]
+        question = Question(title='how are you?')
+        answers = [Answer(body='answer%02d' % i, author=users[0], question=question)
+                   for i in range(12)]
+        db.session.add_all(users + [question] + answers)
+        db.session.commit()
+        for answer in answers[:11]:
+            answer.like(users[0])
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn('answer11', data)
+        #不在首页的回答排进最高赞时首页失效
+        answers[11].like(users[1])
+        answers[11].like(users[2])
+        db.session.commit()
+        self.assertIn('answer11', self.client.get('/').get_data(as_text=True))
+
+    def test_cached_pages(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True)
+        topic = Topic(name='history')
+        question = Question(title='how are you?', author=user)
+        question.topics.append(topic)
+        answer = Answer(body='fine', author=user, question=question)
+        db.session.add_all([user, topic, question, answer])
+        db.session.commit()
+        self.client.post('/auth/login', data={'email': 'john@example.com',
+                                              'password': 'cat'})
+
+        response = self.client.get('/topics')
+        self.assertIn(b'history', response.data)
+        db.session.add(Topic(name='science'))
+        db.session.commit()
+        self.assertIn(b'science', self.client.get('/topics').data)
+
+        url = '/topic/%d/hot' % topic.id
+        self.assertIn(b'fine', self.client.get(url).data)
+        db.session.add(Comment(body='good', author=user, answer=answer))
+        db.session.commit()
+        self.assertIn(u'1条评论'.encode('utf-8'), self.client.get(url).data)
+        self.client.get('/topic/%d/follow' % topic.id)
+        #测试中请求共用测试的应用上下文，不会在请求结束时自动提交
+        db.session.commit()
+        self.assertIn(u'取消关注'.encode('utf-8'), self.client.get(url).data)
+
+        self.client.get('/answer/%d/like' % answer.id)
+        response = self.client.get('/question/%d' % question.id)
+        self.assertIn(b'liked', response.data)
+        self.client.get('/answer/%d/dislike' % answer.id)
+        response = self.client.get('/question/%d' % question.id)
+        self.assertNotIn(b'thumbs-up liked', response.data)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import unittest
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db, cache
+from app.models import User, Role, Topic, Question, Answer, Comment, Like
+
+
+class FlaskClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, email, password):
+        return self.client.post('/auth/login', data={
+            'email': email, 'password': password})
+
+    def add_answers(self, count, users, question):
+        for i in range(count):
+            author = users[i % len(users)]
+            answer = Answer(body='answer %d' % i, author=author, question=question)
+            db.session.add(answer)
+            db.session.add(Comment(body='comment', author=users[0], answer=answer))
+            db.session.add(Like(user=users[-1], answer=answer))
+        db.session.commit()
+
+    def count_queries(self, url):
+        db.session.remove()
+        cache.clear()
+        del get_debug_queries()[:]
+        response = self.client.get(url, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        return len(get_debug_queries())
+
+    def test_answer_list_queries_are_constant(self):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat', confirmed=True) for i in range(4)]
+        topic = Topic(name='history')
+        question = Question(title='how are you?', author=users[0])
+        question.topics.append(topic)
+        db.session.add_all(users + [topic, question])
+        db.session.commit()
+        users[0].follow_topic(topic)
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        self.login('user0@example.com', 'cat')
+
+        urls = ['/all-answers', '/answers-interested-topics', '/answers-followings',
+                '/likes-followings', '/people/user1/answers', '/people/user3/activities',
+                '/topic/%d/hot' % topic.id]
+        #每个作者至少有一个回答：没有回答的用户主页不查询擅长话题，查询数本来就少一次
+        self.add_answers(3, users[1:], question)
+        few = [self.count_queries(url) for url in urls]
+        self.add_answers(9, users[1:], question)
+        many = [self.count_queries(url) for url in urls]
+        self.assertEqual(few, many)
+        self.assertTrue(max(many) <= 20)
+
+    def test_follower_list_queries_are_constant(self):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat', confirmed=True) for i in range(23)]
+        topic = Topic(name='history')
+        question = Question(title='how are you?', author=users[0])
+        question.topics.append(topic)
+        db.session.add_all(users + [topic, question])
+        db.session.commit()
+        self.login('user0@example.com', 'cat')
+        urls = ['/people/user0/followers', '/people/user1/followerings',
+                '/topic/%d/followers' % topic.id, '/question/%d/followers' % question.id]
+
+        user_ids = [user.id for user in users]
+        topic_id, question_id = topic.id, question.id
+
+        def add_followers(follower_ids):
+            u0, u1 = User.query.get(user_ids[0]), User.query.get(user_ids[1])
+            for user in User.query.filter(User.id.in_(follower_ids)):
+                user.follow(u0)
+                u1.follow(user)
+                u0.follow(user)
+                user.follow_topic(Topic.query.get(topic_id))
+                user.follow_question(Question.query.get(question_id))
+            db.session.commit()
+
+        add_followers(user_ids[2:3])
+        few = [self.count_queries(url) for url in urls]
+        add_followers(user_ids[3:])
+        many = [self.count_queries(url) for url in urls]
+        self.assertEqual(few, many)
+        response = self.client.get('/people/user0/followers')
+        self.assertIn(b'cursor=', response.data)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import unittest
+import threading
+import time
+from sqlalchemy.exc import IntegrityError, OperationalError
+from app import create_app, db, like_counter, view_counter, recent_views
+from app.models import User, Role, Question, Answer, Like
+
+
+class CounterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_users_and_answer(self, count):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i)
+                 for i in range(count)]
+        question = Question(title='how are you?')
+        answer = Answer(body='fine', question=question)
+        db.session.add_all(users + [question, answer])
+        db.session.commit()
+        return [u.id for u in users], answer.id
+
+    def hammer(self, user_ids, answer_id, repeat):
+        """每个线程代表一个用户，在自己的会话中反复赞同同一个回答"""
+        errors = []
+
+        def worker(user_id):
+            with self.app.app_context():
+                try:
+                    for i in range(repeat):
+                        while True:
+                            try:
+                                answer = Answer.query.get(answer_id)
+                                answer.like(User.query.get(user_id))
+                                db.session.commit()
+                                break
+                            except IntegrityError:
+                                db.session.rollback()
+                                break
+                            except OperationalError:
+                                #SQLite的写锁冲突，重试
+                                db.session.rollback()
+                                time.sleep(0.01)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=worker, args=(user_id,))
+                   for user_id in user_ids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_like_and_unlike(self):
+        user_ids, answer_id = self.add_users_and_answer(2)
+        answer = Answer.query.get(answer_id)
+        u1, u2 = User.query.get(user_ids[0]), User.query.get(user_ids[1])
+        self.assertEqual(answer.likes_count, 0)
+        self.assertTrue(answer.like(u1))
+        self.assertFalse(answer.like(u1))
+        self.assertTrue(answer.like(u2))
+        db.session.commit()
+        self.assertEqual(answer.likes_count, 2)
+        self.assertTrue(answer.unlike(u1))
+        self.assertFalse(answer.unlike(u1))
+        db.session.commit()
+        self.assertEqual(answer.likes_count, 1)
+        self.assertEqual(answer.likes.count(), 1)
+        with self.assertRaises(IntegrityError):
+            db.session.add(Like(answer_id=answer_id, user_id=u2.id))
+            db.session.commit()
+        db.session.rollback()
+
+    def test_concurrent_likes(self):
+        user_ids, answer_id = self.add_users_and_answer(20)
+        self.hammer(user_ids, answer_id, repeat=5)
+        answer = Answer.query.get(answer_id)
+        self.assertEqual(answer.likes.count(), 20)
+        self.assertEqual(answer.likes_count, 20)
+
+    def test_write_behind_likes(self):
+        self.app.config['ZHIHU_LIKE_WRITE_BEHIND'] = True
+        self.app.config['ZHIHU_LIKE_FLUSH_SIZE'] = 1000
+        self.app.config['ZHIHU_LIKE_FLUSH_INTERVAL'] = 3600
+        user_ids, answer_id = self.add_users_and_answer(20)
+        self.hammer(user_ids, answer_id, repeat=3)
+        self.assertEqual(like_counter.pending(answer_id), 20)
+        self.assertEqual(Answer.query.get(answer_id).likes_count, 0)
+        self.assertEqual(like_counter.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(like_counter.pending(answer_id), 0)
+        self.assertEqual(Answer.query.get(answer_id).likes_count, 20)
+
+    def test_failed_flush_keeps_deltas(self):
+        self.app.config['ZHIHU_LIKE_WRITE_BEHIND'] = True
+        self.app.config['ZHIHU_LIKE_FLUSH_SIZE'] = 1
+        user_ids, answer_id = self.add_users_and_answer(1)
+        answer, user = Answer.query.get(answer_id), User.query.get(user_ids[0])
+
+        def fail(deltas):
+            raise OperationalError('UPDATE', {}, Exception('database is locked'))
+        like_counter._execute = fail
+        try:
+            #提交后的写回失败不影响已经提交的赞同
+            answer.like(user)
+            db.session.commit()
+        finally:
+            del like_counter._execute
+        self.assertEqual(answer.likes.count(), 1)
+        self.assertEqual(like_counter.pending(answer_id), 1)
+        self.assertEqual(like_counter.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(Answer.query.get(answer_id).likes_count, 1)
+
+    def test_question_views(self):
+        self.app.config['ZHIHU_VIEW_WRITE_BEHIND'] = True
+        self.app.config['ZHIHU_VIEW_FLUSH_SIZE'] = 1000
+        self.app.config['ZHIHU_VIEW_FLUSH_INTERVAL'] = 3600
+        self.app.config['ZHIHU_VIEW_DEDUPE_WINDOW'] = 60
+        recent_views.clear()
+        user_ids, answer_id = self.add_users_and_answer(3)
+        q1 = Question.query.get(Answer.query.get(answer_id).question_id)
+        q2 = Question(title='who are you?')
+        db.session.add(q2)
+        db.session.commit()
+        users = User.query.all()
+        for user in users:
+            self.assertTrue(q1.add_view(user))
+            self.assertFalse(q1.add_view(user))
+        self.assertTrue(q2.add_view(users[0]))
+        self.assertTrue(q2.add_view())
+        self.assertEqual(q1.views, 3)
+        self.assertEqual(q1.view_count, 0)
+        self.assertEqual(view_counter.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual((q1.view_count, q2.view_count), (3, 2))
+        self.assertEqual(q1.views, 3)
+
+        self.app.config['ZHIHU_VIEW_WRITE_BEHIND'] = False
+        self.app.config['ZHIHU_VIEW_DEDUPE_WINDOW'] = 0
+        q1.add_view(users[0])
+        db.session.commit()
+        self.assertEqual(q1.view_count, 4)
+
+    def test_flush_at_exit(self):
+        self.app.config['ZHIHU_VIEW_WRITE_BEHIND'] = True
+        self.app.config['ZHIHU_VIEW_FLUSH_SIZE'] = 1000
+        self.app.config['ZHIHU_VIEW_FLUSH_INTERVAL'] = 3600
+        question = Question(title='how are you?')
+        db.session.add(question)
+        db.session.commit()
+        view_counter.add(question.id, 2)
+        #退出时由atexit写回，后台线程来不及写回的增量不会丢失
+        view_counter._flush_at_exit()
+        self.assertEqual(view_counter.pending(question.id), 0)
+        db.session.expire_all()
+        self.assertEqual(question.view_count, 2)
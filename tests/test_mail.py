@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import asyncore
+import json
+import smtpd
+import socket
+import threading
+import unittest
+from flask_mail import Message
+from app import create_app, db, mail, mail_queue
+from flask import render_template
+from app.emails import send_mail, build_message, mail_templates
+from app.models import Role, User
+
+
+class RecordingSMTPServer(smtpd.SMTPServer):
+    """本地SMTP服务器，记录收到的邮件和连接数"""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        mail_templates.clear()
+        self.server = RecordingSMTPServer()
+        self.loop = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.loop.daemon = True
+        self.loop.start()
+        self.use_server(self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.join(5)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def use_server(self, port):
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port,
+                               MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False)
+        mail.init_app(self.app)
+
+    def test_batch_uses_one_connection(self):
+        with self.app.test_request_context():
+            for i in range(3):
+                send_mail('user%d@example.com' % i, u'确认您的账户', 'auth/email/confirm',
+                          user=User(username='user%d' % i), token='token%d' % i)
+        self.assertEqual(mail_queue.pending(), 3)
+        self.assertEqual(mail_queue.drain(), 3)
+        self.assertEqual(mail_queue.pending(), 0)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sorted(rcpt[0] for _, rcpt, _ in self.server.messages),
+                         ['user0@example.com', 'user1@example.com', 'user2@example.com'])
+        self.assertIn('token1', self.server.messages[1][2])
+        stats = mail_queue.stats()
+        self.assertEqual((stats['queued'], stats['sent'], stats['batches']), (3, 3, 1))
+
+    def test_skeleton(self):
+        user = User(username=u'<b>张三</b>', email='john@example.com')
+        with self.app.test_request_context():
+            for template in ('auth/email/confirm', 'auth/email/reset_password',
+                             'auth/email/change_email'):
+                send_mail('john@example.com', u'测试', template, user=user, token='abc.def')
+                body = render_template(template + '.txt', user=user, token='abc.def')
+                html = render_template(template + '.html', user=user, token='abc.def')
+                rows = mail_queue._claim()
+                msg = build_message(json.loads(rows[0][1]))
+                self.assertEqual((msg.body, msg.html), (body, html))
+                self.assertIn('abc.def', msg.body)
+        #同一模板只渲染一次骨架
+        with self.app.test_request_context():
+            send_mail('jane@example.com', u'测试', 'auth/email/confirm',
+                      user=User(username='jane'), token='xyz')
+        self.assertEqual(len(mail_templates._skeletons), 3)
+        msg = build_message(json.loads(mail_queue._claim()[0][1]))
+        self.assertIn('jane', msg.body)
+        self.assertIn('http://localhost/auth/confirm/xyz', msg.html)
+        self.assertEqual(len(mail_templates._skeletons), 3)
+
+    def test_retry_with_backoff(self):
+        self.app.config['ZHIHU_MAIL_MAX_ATTEMPTS'] = 2
+        mail_queue.enqueue(Message('hello', sender='admin@example.com',
+                                   recipients=['john@example.com'], body='hi'))
+        #没有服务器在监听，这一批稍后重试
+        self.use_server(free_port())
+        mail_queue.drain()
+        self.assertEqual(mail_queue.stats()['retried'], 1)
+        self.assertEqual(mail_queue.pending(), 1)
+        #还没到重试时间
+        self.assertEqual(mail_queue.drain(), 0)
+
+        mail_queue._execute('UPDATE outbox SET next_attempt = 0')
+        mail_queue.drain()
+        stats = mail_queue.stats()
+        self.assertEqual((stats['failed'], stats['pending'], stats['dead']), (1, 0, 1))
+
+        mail_queue._execute("UPDATE outbox SET status = 'queued', attempts = 0, "
+                            "next_attempt = 0")
+        self.use_server(self.server.port)
+        self.assertEqual(mail_queue.drain(), 1)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(mail_queue.stats()['dead'], 0)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import json
+import unittest
+from app import create_app, db, query_profiler
+from app.models import User, Role
+from app.profiler import fingerprint
+
+
+class QueryProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['ZHIHU_ADMIN'] = 'admin@example.com'
+        self.app.add_url_rule('/n-plus-one', 'n_plus_one', self.n_plus_one)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @staticmethod
+    def n_plus_one():
+        for i in range(12):
+            db.session.query(User.username).filter(User.id == i).all()
+        return 'ok'
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM users WHERE id IN (?, ?,?)\n  AND name = 'x'"),
+                         'SELECT * FROM users WHERE id IN (?) AND name = ?')
+        self.assertEqual(fingerprint('SELECT anon_1.id FROM t LIMIT 10 OFFSET 20'),
+                         'SELECT anon_1.id FROM t LIMIT ? OFFSET ?')
+
+    def test_stats(self):
+        self.client.get('/n-plus-one')
+        self.client.get('/n-plus-one')
+        stats = query_profiler.stats()
+        endpoint = stats['endpoints']['n_plus_one']
+        self.assertEqual(endpoint['requests'], 2)
+        self.assertEqual(endpoint['queries'], 24)
+        self.assertEqual(sum(endpoint['query_histogram']), 2)
+        self.assertEqual(list(endpoint['n_plus_one'].values()), [12])
+        statement = stats['statements'][0]
+        self.assertEqual(statement['count'], 24)
+        self.assertEqual(statement['endpoints'], {'n_plus_one': 24})
+
+        #不抽样时不记录
+        query_profiler.reset()
+        self.app.config['ZHIHU_QUERY_SAMPLE_RATE'] = 0
+        self.client.get('/n-plus-one')
+        self.assertEqual(query_profiler.stats()['endpoints'], {})
+
+    def test_admin_only(self):
+        db.session.add_all([
+            User(email='john@example.com', username='john', password='cat', confirmed=True),
+            User(email='admin@example.com', username='admin', password='cat', confirmed=True)])
+        db.session.commit()
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        self.assertEqual(self.client.get('/admin/query-stats').status_code, 403)
+        self.client.get('/auth/logout')
+        self.client.post('/auth/login', data={'email': 'admin@example.com', 'password': 'cat'})
+        response = self.client.get('/admin/query-stats')
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.get_data(as_text=True))
+        self.assertIn('auth.login', stats['endpoints'])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db, hot_ranking, top_answers
+from app.models import User, Role, Question, Answer
+from app.pagination import KeysetPagination
+
+
+class HotRankingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.users = [User(email='user%d@example.com' % i, username='user%d' % i)
+                      for i in range(5)]
+        self.question = Question(title='how are you?')
+        db.session.add_all(self.users + [self.question])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_answer(self, age, likes):
+        answer = Answer(body='fine', question=self.question,
+                        timestamp=datetime.utcnow() - age)
+        db.session.add(answer)
+        db.session.commit()
+        for user in self.users[:likes]:
+            answer.like(user)
+            db.session.commit()
+        return answer.id
+
+    def test_order_and_window(self):
+        old = self.add_answer(timedelta(days=3), 5)
+        popular = self.add_answer(timedelta(hours=2), 3)
+        fresh = self.add_answer(timedelta(minutes=5), 1)
+        self.add_answer(timedelta(hours=1), 0)
+        self.assertEqual(hot_ranking.top(timedelta(days=1)), [popular, fresh])
+        self.assertEqual(hot_ranking.top(timedelta(days=30)), [popular, fresh, old])
+        self.assertEqual(hot_ranking.top(timedelta(days=30), offset=1, limit=1), [fresh])
+
+    def test_unlike_and_delete(self):
+        first = self.add_answer(timedelta(hours=1), 2)
+        second = self.add_answer(timedelta(hours=1), 3)
+        self.assertEqual(hot_ranking.top(timedelta(days=1)), [second, first])
+        answer = Answer.query.get(second)
+        for user in self.users[:3]:
+            answer.unlike(user)
+            db.session.commit()
+        self.assertEqual(hot_ranking.top(timedelta(days=1)), [first])
+        self.assertEqual(hot_ranking.likes(second), 0)
+        db.session.delete(Answer.query.get(first))
+        db.session.commit()
+        self.assertEqual(hot_ranking.top(timedelta(days=1)), [])
+
+    def test_rollback_is_ignored(self):
+        answer_id = self.add_answer(timedelta(hours=1), 1)
+        Answer.query.get(answer_id).like(self.users[1])
+        db.session.rollback()
+        self.assertEqual(hot_ranking.likes(answer_id), 1)
+
+    def test_rebuild_matches_incremental(self):
+        ids = [self.add_answer(timedelta(hours=i), i % 4 + 1) for i in range(8)]
+        incremental = hot_ranking.top(timedelta(days=1))
+        self.assertEqual(sorted(incremental), sorted(ids))
+        hot_ranking.rebuild()
+        self.assertEqual(hot_ranking.top(timedelta(days=1)), incremental)
+
+    def test_refresh_outside_requests(self):
+        answer_id = self.add_answer(timedelta(hours=1), 1)
+        self.app.config['ZHIHU_HOT_REFRESH_INTERVAL'] = 0
+        #其他进程写入的赞同数不在请求中合并，由后台的refresh()重建时读取
+        db.session.execute(Answer.__table__.update().values(likes_count=5))
+        db.session.commit()
+        self.add_answer(timedelta(hours=2), 1)
+        self.assertEqual(hot_ranking.likes(answer_id), 1)
+        hot_ranking.refresh()
+        self.assertEqual(hot_ranking.likes(answer_id), 5)
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(path)
+        try:
+            self.app.config['ZHIHU_HOT_SNAPSHOT'] = path
+            first = self.add_answer(timedelta(hours=1), 1)
+            second = self.add_answer(timedelta(hours=2), 4)
+            hot_ranking.persist()
+            ranking = hot_ranking.top(timedelta(days=1))
+            #从快照恢复时不再读取数据库
+            hot_ranking.init_app(self.app)
+            Answer.query.delete()
+            db.session.commit()
+            self.assertEqual(hot_ranking.top(timedelta(days=1)), ranking)
+            self.assertEqual(ranking, [second, first])
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TopAnswersTestCase(HotRankingTestCase):
+    def paginate(self, cursor=None):
+        return KeysetPagination(Answer.query,
+                                [(Answer.likes_count, True), (Answer.timestamp, True),
+                                 (Answer.id, True)],
+                                cursor=cursor, per_page=2, cache=top_answers)
+
+    def collect(self):
+        ids, cursor = [], None
+        while True:
+            pagination = self.paginate(cursor)
+            ids.extend(answer.id for answer in pagination.items)
+            if not pagination.has_next:
+                return ids
+            cursor = pagination.next_cursor
+
+    def test_pages_match_query(self):
+        self.app.config['ZHIHU_TOP_CACHE_PAGES'] = 2
+        ids = [self.add_answer(timedelta(hours=i), i % 3) for i in range(7)]
+        expected = [a.id for a in Answer.query.order_by(
+            Answer.likes_count.desc(), Answer.timestamp.desc(), Answer.id.desc())]
+        self.assertEqual(sorted(ids), sorted(expected))
+        self.assertEqual(self.collect(), expected)
+        #从缓存外的一页往回翻
+        pagination = self.paginate(self.paginate().next_cursor)
+        pagination = self.paginate(pagination.next_cursor)
+        back = self.paginate(pagination.prev_cursor)
+        self.assertEqual([a.id for a in back.items], expected[2:4])
+        self.assertTrue(back.has_prev)
+
+    def test_ranks(self):
+        self.app.config['ZHIHU_TOP_CACHE_PAGES'] = 1
+        ids = [self.add_answer(timedelta(hours=i), 3 - i % 4) for i in range(6)]
+        #还没有加载过，任何赞同都可能改变排序
+        self.assertTrue(top_answers.ranks(ids[3], 1))
+        top = [answer.id for answer in self.paginate().items]
+        self.assertEqual(top, [ids[0], ids[4]])
+        #失效之后仍按最近一次加载的范围判断
+        top_answers.invalidate()
+        self.assertTrue(top_answers.ranks(ids[4], 2))
+        self.assertTrue(top_answers.ranks(ids[3], 3))
+        self.assertFalse(top_answers.ranks(ids[3], 1))
+
+    def test_cached_first_page_skips_sort(self):
+        for i in range(3):
+            self.add_answer(timedelta(hours=i), i)
+        self.paginate()
+        before = len(get_debug_queries())
+        self.paginate()
+        statements = [q.statement for q in get_debug_queries()[before:]]
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('ORDER BY', statements[0])
+
+    def test_invalidated_by_like(self):
+        first = self.add_answer(timedelta(hours=1), 2)
+        second = self.add_answer(timedelta(hours=2), 1)
+        self.assertEqual([a.id for a in self.paginate().items], [first, second])
+        answer = Answer.query.get(second)
+        for user in self.users[1:4]:
+            answer.like(user)
+            db.session.commit()
+        self.assertEqual([a.id for a in self.paginate().items], [second, first])
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import unittest
+from app import create_app, db, body_renderer
+from app.models import Role, Question, Answer
+
+
+class RenderingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render(self):
+        html = body_renderer.render(u'**hi** <script>x</script> http://example.com')
+        self.assertIn('<strong>hi</strong>', html)
+        self.assertNotIn('<script>', html)
+        self.assertIn('href="http://example.com"', html)
+        #同样的正文直接取缓存
+        self.assertIs(body_renderer.render(u'**hi** <script>x</script> http://example.com'), html)
+        answer = Answer(body=u'*fine*')
+        self.assertEqual(answer.body_html, '<p><em>fine</em></p>')
+
+    def test_deferred(self):
+        self.app.config['ZHIHU_RENDER_DEFERRED'] = True
+        answer = Answer(body=u'*fine*', question=Question(title='how are you?'))
+        db.session.add(answer)
+        db.session.commit()
+        self.assertIsNone(answer.body_html)
+        body_renderer.drain()
+        db.session.expire_all()
+        self.assertEqual(answer.body_html, '<p><em>fine</em></p>')
+
+        answer.body = u'**changed**'
+        db.session.commit()
+        self.assertIsNone(answer.body_html)
+        body_renderer.drain()
+        db.session.expire_all()
+        self.assertEqual(answer.body_html, '<p><strong>changed</strong></p>')
+
+        #回滚的修改不会进入队列
+        answer.body = u'**rolled back**'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(body_renderer.drain(), 0)
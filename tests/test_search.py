@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import json
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db, search_indexer
+from app.models import User, Role, Topic, Question, Answer
+from app.search import cjk_analyzer
+
+
+class SearchIndexerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @staticmethod
+    def search(words):
+        return set(search_indexer.search(Answer, words, 0, 100))
+
+    @staticmethod
+    def generation():
+        return search_indexer.index(Answer._whoosheer_).latest_generation()
+
+    def test_index_after_commit(self):
+        a1 = Answer(body='apple banana')
+        a2 = Answer(body='cherry')
+        db.session.add_all([a1, a2])
+        db.session.flush()
+        #未提交的修改不进入索引
+        self.assertEqual(self.search('apple'), set())
+        db.session.commit()
+        self.assertEqual(self.search('apple'), {a1.id})
+
+        #只有被索引的字段变化时才写入索引
+        generation = self.generation()
+        a1.likes_count = 5
+        db.session.commit()
+        self.assertEqual(self.generation(), generation)
+
+        a1.body = 'durian'
+        db.session.commit()
+        self.assertEqual(self.search('apple'), set())
+        self.assertEqual(self.search('durian'), {a1.id})
+
+        db.session.delete(a2)
+        db.session.commit()
+        self.assertEqual(self.search('cherry'), set())
+
+    def test_rollback(self):
+        db.session.add(Answer(body='apple'))
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(search_indexer.pending(), 0)
+        self.assertEqual(self.search('apple'), set())
+
+    def test_batch_coalesces_changes(self):
+        whoosheer = Answer._whoosheer_
+        search_indexer._queue.extend([
+            (whoosheer, 1, {'id': 1, 'body': u'apple'}),
+            (whoosheer, 1, {'id': 1, 'body': u'banana'}),
+            (whoosheer, 2, {'id': 2, 'body': u'apple'}),
+            (whoosheer, 2, None)])
+        self.assertEqual(search_indexer.drain(), 2)
+        self.assertEqual(search_indexer.pending(), 0)
+        self.assertEqual(search_indexer.index(whoosheer).doc_count(), 1)
+        self.assertEqual(self.search('apple'), set())
+        self.assertEqual(self.search('banana'), {1})
+
+    def test_reindex(self):
+        #批量插入绕过会话，不会进入索引
+        db.session.execute(Answer.__table__.insert(), [
+            {'id': i, 'body': 'apple %d' % i, 'likes_count': 0} for i in range(1, 8)])
+        db.session.commit()
+        self.assertEqual(self.search('apple'), set())
+        self.assertEqual(search_indexer.reindex(batch_size=3), 7)
+        self.assertEqual(self.search('apple'), set(range(1, 8)))
+        #重建时替换原有的文档
+        self.assertEqual(search_indexer.reindex(), 7)
+        self.assertEqual(search_indexer.index(Answer._whoosheer_).doc_count(), 7)
+
+    def test_cjk_analyzer(self):
+        analyzer = cjk_analyzer()
+        self.assertEqual([t.text for t in analyzer(u'学习Flask框架 v2', mode='index')],
+                         [u'学', u'学习', u'习', u'flask', u'框', u'框架', u'架', u'v2'])
+        self.assertEqual([t.text for t in analyzer(u'学习Flask框架 v2', mode='query')],
+                         [u'学习', u'flask', u'框架', u'v2'])
+        self.assertEqual([t.text for t in analyzer(u'猫', mode='query')], [u'猫'])
+
+    def test_chinese_search(self):
+        a1 = Answer(body=u'如何系统地学习Python编程？')
+        a2 = Answer(body=u'今天天气很好，适合出去学游泳')
+        db.session.add_all([a1, a2])
+        db.session.commit()
+        self.assertEqual(self.search(u'学习'), {a1.id})
+        self.assertEqual(self.search(u'天气'), {a2.id})
+        self.assertEqual(self.search(u'PYTHON'), {a1.id})
+        self.assertEqual(self.search(u'学'), {a1.id, a2.id})
+        self.assertEqual(self.search(u'习天'), set())
+
+    def test_ranking(self):
+        now = datetime.utcnow()
+        plain = Answer(body=u'苹果 apple', timestamp=now)
+        liked = Answer(body=u'苹果 apple', timestamp=now, likes_count=50)
+        old = Answer(body=u'苹果 apple', timestamp=now - timedelta(days=365))
+        relevant = Answer(body=u'苹果 apple 苹果 apple', timestamp=now)
+        db.session.add_all([plain, liked, old, relevant])
+        db.session.commit()
+        ids = search_indexer.search(Answer, u'苹果', 0, 10)
+        self.assertEqual(ids[0], liked.id)
+        self.assertEqual(ids[-1], old.id)
+        self.assertLess(ids.index(relevant.id), ids.index(plain.id))
+        #多个词的查询同样按相关度和赞同数排序
+        ids = search_indexer.search(Answer, u'苹果 香蕉', 0, 10)
+        self.assertEqual(ids[0], liked.id)
+        self.assertLess(ids.index(relevant.id), ids.index(plain.id))
+        #分页取出的是同一个排序中的位置
+        self.assertEqual(search_indexer.search(Answer, u'苹果', 1, 2), ids[1:3])
+
+    def test_like_refreshes_index(self):
+        user = User(email='john@example.com', username='john', password='cat')
+        a1 = Answer(body=u'apple')
+        a2 = Answer(body=u'apple')
+        db.session.add_all([user, a1, a2])
+        db.session.commit()
+        self.assertEqual(search_indexer.search(Answer, u'apple'), [a1.id, a2.id])
+        a2.like(user)
+        db.session.commit()
+        self.assertEqual(search_indexer.search(Answer, u'apple'), [a2.id, a1.id])
+
+    def test_follow_refreshes_index(self):
+        john = User(email='john@example.com', username='john', description=u'Python')
+        susan = User(email='susan@example.com', username='susan', description=u'Python')
+        t1, t2 = Topic(name=u'Python 2'), Topic(name=u'Python 3')
+        q1, q2 = Question(title=u'Python 2'), Question(title=u'Python 3')
+        db.session.add_all([john, susan, t1, t2, q1, q2])
+        #BM25中出现在一半以上文档里的词没有区分度，另外加入一些不相关的文档
+        for name in (u'Go', u'Rust', u'Java'):
+            db.session.add_all([User(email='%s@example.com' % name, username=name,
+                                     description=name),
+                                Topic(name=name), Question(title=name)])
+        db.session.commit()
+        self.assertEqual(search_indexer.search(Topic, u'python'), [t1.id, t2.id])
+        self.assertEqual(search_indexer.search(User, u'python'), [john.id, susan.id])
+        #关注数在SQL中累加，提交后重新写入索引
+        john.follow_topic(t2)
+        john.follow_question(q2)
+        john.follow(susan)
+        db.session.commit()
+        self.assertEqual(search_indexer.search(Topic, u'python'), [t2.id, t1.id])
+        self.assertEqual(search_indexer.search(Question, u'python'), [q2.id, q1.id])
+        self.assertEqual(search_indexer.search(User, u'python'), [susan.id, john.id])
+
+    def test_search_results_pagination(self):
+        user = User(email='john@example.com', username='john', password='cat', confirmed=True)
+        question = Question(title=u'水果', author=user)
+        db.session.add_all([user, question] + [
+            Answer(body=u'苹果 %d' % i, author=user, question=question) for i in range(25)])
+        db.session.commit()
+        client = self.app.test_client(use_cookies=True)
+        client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        data = client.get(u'/search_results/苹果').get_data(as_text=True)
+        self.assertEqual(data.count(u'苹果 '), 20)
+        self.assertIn('cursor=20', data)
+        data = client.get(u'/search_results/苹果?cursor=20').get_data(as_text=True)
+        self.assertEqual(data.count(u'苹果 '), 5)
+        self.assertNotIn('cursor=40', data)
+
+    def test_federated(self):
+        john = User(email='john@example.com', username='john', password='cat',
+                    description=u'Python开发者')
+        topic = Topic(name=u'Python', description=u'一种编程语言')
+        question = Question(title=u'如何学习Python？', body=u'零基础', author=john)
+        db.session.add_all([john, topic, question])
+        db.session.commit()
+        results = search_indexer.federated(u'python', [Question, Topic, User])
+        self.assertEqual(list(results), ['questions', 'topics', 'users'])
+        self.assertEqual(results['questions'], [question])
+        self.assertEqual(results['topics'], [topic])
+        self.assertEqual(results['users'], [john])
+        self.assertEqual(search_indexer.federated(u'编程', [Topic])['topics'], [topic])
+
+        #只有被索引的字段变化时才写入用户索引
+        generation = search_indexer.index(User._whoosheer_).latest_generation()
+        john.location = u'Beijing'
+        db.session.commit()
+        self.assertEqual(search_indexer.index(User._whoosheer_).latest_generation(), generation)
+        john.description = u'Go开发者'
+        db.session.commit()
+        self.assertEqual(search_indexer.federated(u'python', [User])['users'], [])
+
+    def test_prefix(self):
+        q1 = Question(title=u'如何学习Python编程')
+        q2 = Question(title=u'Pycharm好用吗')
+        q3 = Question(title=u'今天吃什么')
+        db.session.add_all([q1, q2, q3])
+        db.session.commit()
+        self.assertEqual(search_indexer.search(Question, u'py'), [])
+        self.assertEqual(set(search_indexer.search(Question, u'py', prefix=True)),
+                         {q1.id, q2.id})
+        self.assertEqual(search_indexer.search(Question, u'如何学习Pyt', prefix=True), [q1.id])
+        self.assertEqual(search_indexer.search(Question, u'如何学', prefix=True), [q1.id])
+
+    def test_suggest(self):
+        user = User(email='john@example.com', username='john', password='cat', confirmed=True)
+        question = Question(title=u'如何学习Python', author=user)
+        db.session.add_all([user, question, Topic(name=u'编程')])
+        db.session.commit()
+        client = self.app.test_client(use_cookies=True)
+        client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        response = client.get(u'/search/suggest?q=如何学习Pyth&types=questions&prefix=1')
+        data = json.loads(response.get_data(as_text=True))
+        self.assertEqual(data, {'questions': [{'id': question.id, 'title': u'如何学习Python',
+                                               'url': '/question/%d' % question.id}]})
+        data = json.loads(client.get(u'/search/suggest?q=jo').get_data(as_text=True))
+        self.assertEqual(sorted(data), ['questions', 'topics', 'users'])
+        self.assertEqual(data['users'], [])
+        data = json.loads(client.get(u'/search/suggest?q=jo&prefix=1').get_data(as_text=True))
+        self.assertEqual([user['username'] for user in data['users']], ['john'])
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import unittest
+from app import create_app, db
+from app.models import User, Role, Topic, Question, Answer, Comment, Like, Follow
+from app.seed import seed
+
+
+class SeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def snapshot(self):
+        return (db.session.query(Answer.id, Answer.user_id, Answer.question_id,
+                                 Answer.body).order_by(Answer.id).all(),
+                db.session.query(Like.answer_id, Like.user_id).order_by(Like.id).all(),
+                db.session.query(User.username).order_by(User.id).all())
+
+    def test_seed(self):
+        inserted = seed(users=20, topics=5, questions=30, answers=100, comments=50,
+                        likes=3, follows=4, processes=0, batch_size=16)
+        self.assertEqual(User.query.count(), 20)
+        self.assertEqual(Answer.query.count(), 100)
+        self.assertEqual(Comment.query.count(), 50)
+        self.assertEqual(inserted['likes'], Like.query.count())
+        self.assertEqual(inserted['follows'], Follow.query.count())
+        #最后的汇总重建了计数列
+        self.assertEqual(db.session.query(db.func.sum(Answer.likes_count)).scalar(),
+                         Like.query.count())
+        self.assertEqual(db.session.query(db.func.sum(User.answers_count)).scalar(), 100)
+        self.assertEqual(db.session.query(db.func.sum(Question.answers_count)).scalar(), 100)
+        self.assertEqual(db.session.query(db.func.sum(User.followers_count)).scalar(),
+                         Follow.query.count())
+        self.assertTrue(Topic.query.first().all_answers.count() > 0)
+        first = self.snapshot()
+
+        #相同的种子，无论进程数多少都生成相同的数据
+        db.drop_all()
+        db.create_all()
+        seed(users=20, topics=5, questions=30, answers=100, comments=50,
+             likes=3, follows=4, processes=2, batch_size=16)
+        self.assertEqual(self.snapshot(), first)
@@ -4,9 +4,13 @@
 import unittest
 import time
 from datetime import datetime
+from flask import g
+from flask_sqlalchemy import get_debug_queries
 from app import create_app, db
 from app.models import User, Role, Permission, Follow, Topic, Question, \
-    Answer, Like
+    Answer, Like, Feed
+from app.pagination import KeysetPagination
+from app.counters import recount
 
 class UserModelTestCase(unittest.TestCase):
     def setUp(self):
@@ -35,11 +39,39 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(u.verify_password('cat'))
         self.assertFalse(u.verify_password('dog'))
 
+    def test_password_rehash(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.config['ZHIHU_PASSWORD_ITERATIONS'] = 2000
+        old_hash = u.password_hash
+        self.assertFalse(u.verify_password('dog'))
+        self.assertEqual(u.password_hash, old_hash)
+        self.assertTrue(u.verify_password('cat'))
+        db.session.commit()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.verify_password('cat'))
+
     def test_password_salts_are_random(self):
         u1 = User(password='cat')
         u2 = User(password='cat')
         self.assertTrue(u1.password_hash != u2.password_hash)
 
+    def test_token_purposes(self):
+        from app import tokens
+        u = User(password='cat')
+        db.session.add(u)
+        db.session.commit()
+        #重设密码的令牌不能用来确认账户
+        self.assertFalse(u.confirm(u.generate_reset_password_token()))
+        self.assertFalse(u.confirm('not-a-token'))
+        issued = tokens.issue_many('confirm', [{'confirm': u.id}, {'confirm': u.id + 1}])
+        self.assertEqual(len(issued), 2)
+        self.assertEqual(tokens.loads('confirm', issued[1]), {'confirm': u.id + 1})
+        self.assertTrue(u.confirm(issued[0]))
+        self.assertIs(tokens._serializer('confirm', 3600), tokens._serializer('confirm', 3600))
+
     def test_valid_confirmation_token(self):
         u = User(password='cat')
         db.session.add(u)
@@ -117,6 +149,61 @@ class UserModelTestCase(unittest.TestCase):
         self.assertTrue(u.can(Permission.WRITE_ARTICLES))
         self.assertFalse(u.can(Permission.MODERATE_COMMENTS))
 
+    def test_role_table(self):
+        from sqlalchemy import event
+        u = User(email='xyz@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        u = User.query.get(u.id)
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            User(email='abc@example.com', password='dog')
+            self.assertTrue(u.can(Permission.COMMENT))
+            self.assertFalse(u.is_administer())
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, [])
+        #修改角色提交后重新加载
+        role = Role.query.filter_by(name='User').first()
+        role.permissions = Permission.FOLLOW
+        db.session.commit()
+        self.assertFalse(u.can(Permission.COMMENT))
+        Role.insert_roles()
+        self.assertTrue(u.can(Permission.COMMENT))
+
+    def test_load_user_snapshot(self):
+        from sqlalchemy import event
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+        self.assertEqual(User.load(user_id).username, 'john')
+        db.session.remove()
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            u = User.load(user_id)
+            self.assertEqual(u.username, 'john')
+            self.assertFalse(u.confirmed)
+            self.assertTrue(u.can(Permission.COMMENT))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(statements, [])
+        #不在快照中的列用到时再加载
+        self.assertTrue(u.verify_password('cat'))
+        self.assertEqual(u.followers_count, 0)
+        #修改后提交，快照失效
+        u.username = 'jack'
+        u.confirmed = True
+        db.session.commit()
+        db.session.remove()
+        u = User.load(user_id)
+        self.assertEqual((u.username, u.confirmed), ('jack', True))
+
     def test_follow_users(self):
         u1 = User(email='cat@example.com', password='cat')
         u2 = User(email='dog@jd.com', password='dog')
@@ -143,6 +230,29 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(u1.is_following(u2))
         self.assertFalse(u2.is_followedby(u1))
 
+    def test_following_ids_among(self):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i)
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0 = users[0]
+        ids = [u.id for u in users]
+        self.assertEqual(u0.following_ids_among(ids), set())
+        u0.follow(users[1])
+        u0.follow(users[2])
+        db.session.commit()
+        self.assertEqual(u0.following_ids_among(ids), set(ids[1:3]))
+        self.assertEqual(u0.following_ids_among(ids[2:]), set([ids[2]]))
+        #其他会话中的关注变化提交后，缓存中的关注列表失效
+        g.pop('following_ids')
+        db.session.delete(Follow.query.get((u0.id, users[1].id)))
+        db.session.commit()
+        g.pop('following_ids', None)
+        self.assertEqual(u0.following_ids_among(ids), set([ids[2]]))
+        u0.unfollow(users[2])
+        db.session.commit()
+        self.assertEqual(u0.following_ids_among(ids), set())
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -202,3 +312,211 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(u in question.followers)
 
 
+
+    def test_followings_feed(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.com', password='dog')
+        q = Question(title='how are you?')
+        db.session.add_all([u1, u2, q])
+        db.session.commit()
+        a1 = Answer(body='fine', author=u2, question=q,
+                    timestamp=datetime(2017, 1, 1))
+        db.session.add(a1)
+        db.session.commit()
+        self.assertEqual(u1.answers_followings.count(), 0)
+
+        #关注时补上已有回答，之后的新回答直接推送
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.answers_followings.all(), [a1])
+        a2 = Answer(body='great', author=u2, question=q)
+        db.session.add(a2)
+        db.session.commit()
+        pagination = KeysetPagination(u1.answers_followings,
+                        [(Feed.timestamp, True), (Feed.answer_id, True)],
+                        per_page=1, key=lambda a: [a.timestamp, a.id])
+        self.assertEqual(pagination.items, [a2])
+        self.assertTrue(pagination.has_next)
+        pagination = KeysetPagination(u1.answers_followings,
+                        [(Feed.timestamp, True), (Feed.answer_id, True)],
+                        cursor=pagination.next_cursor, per_page=1,
+                        key=lambda a: [a.timestamp, a.id])
+        self.assertEqual(pagination.items, [a1])
+        self.assertFalse(pagination.has_next)
+        self.assertTrue(pagination.has_prev)
+        pagination = KeysetPagination(u1.answers_followings,
+                        [(Feed.timestamp, True), (Feed.answer_id, True)],
+                        cursor=pagination.prev_cursor, per_page=1,
+                        key=lambda a: [a.timestamp, a.id])
+        self.assertEqual(pagination.items, [a2])
+        self.assertFalse(pagination.has_prev)
+        self.assertTrue(pagination.has_next)
+
+        db.session.delete(a2)
+        db.session.commit()
+        self.assertEqual(u1.answers_followings.all(), [a1])
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.answers_followings.count(), 0)
+        u1.follow(u2)
+        db.session.commit()
+        Feed.query.delete()
+        Feed.rebuild()
+        self.assertEqual(u1.answers_followings.all(), [a1])
+
+    #SQLite默认不检查外键，打开后与生产环境的数据库行为一致
+    def enforce_foreign_keys(self):
+        def on_connect(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA foreign_keys=ON')
+        db.session.commit()
+        db.engine.dispose()
+        db.event.listen(db.engine, 'connect', on_connect)
+        self.addCleanup(db.event.remove, db.engine, 'connect', on_connect)
+
+    def test_delete_answer_with_foreign_keys(self):
+        self.enforce_foreign_keys()
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.com', password='dog')
+        topic = Topic(name='history')
+        q = Question(title='how are you?')
+        q.topics.append(topic)
+        db.session.add_all([u1, u2, topic, q])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        answer = Answer(body='fine', author=u2, question=q)
+        db.session.add(answer)
+        db.session.commit()
+        self.assertEqual(u1.answers_followings.all(), [answer])
+        self.assertEqual(topic.all_answers.all(), [answer])
+        db.session.delete(answer)
+        db.session.commit()
+        self.assertEqual(Answer.query.count(), 0)
+        self.assertEqual(Feed.query.count(), 0)
+        self.assertEqual(topic.all_answers.count(), 0)
+
+    def test_topic_answers_index(self):
+        u = User(email='john@example.com', password='cat')
+        t1 = Topic(name='history')
+        t2 = Topic(name='music')
+        q = Question(title='how are you?')
+        q.topics.append(t1)
+        db.session.add_all([u, t1, t2, q])
+        db.session.commit()
+        a1 = Answer(body='fine', author=u, question=q,
+                    timestamp=datetime(2017, 1, 1))
+        a2 = Answer(body='great', author=u, question=q)
+        db.session.add_all([a1, a2])
+        db.session.commit()
+        self.assertEqual(t1.all_answers.all(), [a2, a1])
+        self.assertEqual(t2.all_answers.count(), 0)
+
+        #问题新增/移除话题时同步已有回答
+        q.topics.append(t2)
+        db.session.commit()
+        self.assertEqual(t2.all_answers.all(), [a2, a1])
+        u.follow_topic(t1)
+        u.follow_topic(t2)
+        db.session.commit()
+        self.assertEqual([row.answer_id for row in u.answers_interested_topics],
+                         [a2.id, a1.id])
+        q.topics.remove(t1)
+        db.session.commit()
+        self.assertEqual(t1.all_answers.count(), 0)
+        self.assertEqual([row.answer_id for row in u.answers_interested_topics],
+                         [a2.id, a1.id])
+
+        db.session.delete(a2)
+        db.session.commit()
+        self.assertEqual(t2.all_answers.all(), [a1])
+        Answer.rebuild_topic_index()
+        self.assertEqual(t2.all_answers.all(), [a1])
+        self.assertEqual(t1.all_answers.count(), 0)
+
+    def test_counters(self):
+        u1 = User(email='cat@example.com', username='cat')
+        u2 = User(email='dog@example.com', username='dog')
+        topic = Topic(name='history')
+        question = Question(title='how are you?', author=u1)
+        db.session.add_all([u1, u2, topic, question])
+        u1.follow(u2)
+        u2.follow_topic(topic)
+        u2.follow_question(question)
+        db.session.add(Answer(body='fine', author=u2, question=question))
+        db.session.commit()
+        self.assertEqual((u1.followings_count, u1.followers_count, u1.questions_count),
+                         (1, 0, 1))
+        self.assertEqual((u2.followers_count, u2.answers_count), (1, 1))
+        self.assertEqual((question.answers_count, question.followers_count), (1, 1))
+        self.assertEqual(topic.followers_count, 1)
+
+        u1.unfollow(u2)
+        u2.unfollow_topic(topic)
+        u2.unfollow_question(question)
+        db.session.delete(u2.answers.first())
+        db.session.commit()
+        self.assertEqual((u1.followings_count, u2.followers_count, u2.answers_count),
+                         (0, 0, 0))
+        self.assertEqual((question.answers_count, question.followers_count), (0, 0))
+        self.assertEqual(topic.followers_count, 0)
+
+        #回滚的修改不计入
+        u2.follow(u1)
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(u1.followers_count, 0)
+
+    def test_recount(self):
+        u1 = User(email='cat@example.com', username='cat')
+        u2 = User(email='dog@example.com', username='dog')
+        question = Question(title='how are you?', author=u1)
+        db.session.add_all([u1, u2, question])
+        db.session.commit()
+        db.session.execute(Follow.__table__.insert().values(
+            follower_id=u1.id, followed_id=u2.id))
+        db.session.execute(Answer.__table__.insert().values(
+            body='fine', user_id=u2.id, question_id=question.id))
+        db.session.execute(User.__table__.update().values(questions_count=5))
+        recount(User, 'followings_count', Follow.follower_id)
+        recount(User, 'followers_count', Follow.followed_id)
+        recount(User, 'answers_count', Answer.user_id)
+        recount(User, 'questions_count', Question.user_id)
+        recount(Question, 'answers_count', Answer.question_id)
+        db.session.commit()
+        self.assertEqual((u1.followings_count, u1.questions_count, u2.questions_count),
+                         (1, 1, 0))
+        self.assertEqual((u2.followers_count, u2.answers_count), (1, 1))
+        self.assertEqual(question.answers_count, 1)
+
+    def test_answer_counts_by_topic(self):
+        u = User(email='cat@example.com', username='cat')
+        other = User(email='dog@example.com', username='dog')
+        history, science = Topic(name='history'), Topic(name='science')
+        q1 = Question(title='why?')
+        q1.topics.append(history)
+        q1.topics.append(science)
+        q2 = Question(title='how?')
+        q2.topics.append(history)
+        db.session.add_all([u, other, history, science, q1, q2])
+        db.session.add_all([Answer(body='a', author=u, question=q1),
+                            Answer(body='b', author=u, question=q2),
+                            Answer(body='c', author=other, question=q2)])
+        db.session.commit()
+        self.assertEqual(u.answer_counts_by_topic(), {history.id: 2, science.id: 1})
+        self.assertEqual(u.answers_of_topic(science), 1)
+        self.assertEqual(u.top_topics(), [(history, 2), (science, 1)])
+        #各话题的回答数已在缓存中，只需取出话题
+        del get_debug_queries()[:]
+        self.assertEqual(u.top_topics(limit=1), [(history, 2)])
+        self.assertEqual(len(get_debug_queries()), 1)
+        self.assertEqual(history.answer_counts_of([u.id, other.id]), {u.id: 2, other.id: 1})
+        db.session.delete(u.answers.filter_by(question_id=q1.id).first())
+        db.session.commit()
+        self.assertEqual(u.answer_counts_by_topic(), {history.id: 1})
+        #问题的话题变化同样使回答者的统计失效
+        q2.topics.append(science)
+        db.session.commit()
+        self.assertEqual(u.answer_counts_by_topic(), {history.id: 1, science.id: 1})
+        q2.topics.remove(history)
+        db.session.commit()
+        self.assertEqual(u.answer_counts_by_topic(), {science.id: 1})